@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+'''
+MockIGD - https://github.com/MikeWang000000/Natter
+Copyright (C) 2023  MikeWang000000
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import natter
+
+__version__ = natter.__version__
+
+SERVICE_TYPE = "urn:schemas-upnp-org:service:WANIPConnection:1"
+
+IGD_XML = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:InternetGatewayDevice:1</deviceType>
+    <friendlyName>Natter Mock IGD</friendlyName>
+    <deviceList>
+      <device>
+        <deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>
+        <deviceList>
+          <device>
+            <deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>
+            <serviceList>
+              <service>
+                <serviceType>%s</serviceType>
+                <serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>
+                <SCPDURL>/WANIPCn.xml</SCPDURL>
+                <controlURL>/ctl/IPConn</controlURL>
+                <eventSubURL>/evt/IPConn</eventSubURL>
+              </service>
+            </serviceList>
+          </device>
+        </deviceList>
+      </device>
+    </deviceList>
+  </device>
+</root>
+''' % SERVICE_TYPE
+
+NOISE_XML = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType>
+    <friendlyName>Natter Mock Media Device %d</friendlyName>
+    <serviceList>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:RenderingControl:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:RenderingControl</serviceId>
+        <SCPDURL>/noise/%d/rc.xml</SCPDURL>
+        <controlURL>/noise/%d/ctl</controlURL>
+        <eventSubURL>/noise/%d/evt</eventSubURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+'''
+
+SOAP_RESPONSE = '''<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <u:%sResponse xmlns:u="%s">
+%s    </u:%sResponse>
+  </s:Body>
+</s:Envelope>
+'''
+
+SOAP_FAULT = '''<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <s:Fault>
+      <faultcode>s:Client</faultcode>
+      <faultstring>UPnPError</faultstring>
+      <detail>
+        <UPnPError xmlns="urn:schemas-upnp-org:control-1-0">
+          <errorCode>%d</errorCode>
+          <errorDescription>%s</errorDescription>
+        </UPnPError>
+      </detail>
+    </s:Fault>
+  </s:Body>
+</s:Envelope>
+'''
+
+
+class MockIGD(object):
+    def __init__(self, ip="127.0.0.1", http_port=0, ssdp_addr=None, external_ip="203.0.113.10",
+                 latency=0.0, desc_latency=0.0, fail_rate=0.0, noise=0, noise_latency=0.5,
+                 flush_interval=0, no_get_entry=False):
+        self.ip = ip
+        self.http_port = http_port
+        self.ssdp_addr = ssdp_addr
+        self.external_ip = external_ip
+        self.latency = latency
+        self.desc_latency = desc_latency
+        self.fail_rate = fail_rate
+        self.noise = noise
+        self.noise_latency = noise_latency
+        self.flush_interval = flush_interval
+        self.no_get_entry = no_get_entry
+        self.mappings = {}      # (remote_host, ext_port, proto) => (client, port, desc, expire_at)
+        self.stats = {}         # action => count
+        self._lock = threading.Lock()
+        self._flushed_at = time.time()
+        self.httpd = None
+        self.ssdp_sock = None
+
+    def start(self):
+        igd = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                http.server.BaseHTTPRequestHandler.setup(self)
+                igd._count("connection")
+
+            def do_GET(self):
+                igd._handle_get(self)
+
+            def do_POST(self):
+                igd._handle_post(self)
+
+            def log_message(self, fmt, *args):
+                natter.Logger.debug("mock-igd: %s" % (fmt % args))
+
+        self.httpd = http.server.ThreadingHTTPServer((self.ip, self.http_port), Handler)
+        self.httpd.daemon_threads = True
+        self.http_port = self.httpd.server_address[1]
+        natter.start_daemon_thread(self.httpd.serve_forever)
+        self.ssdp_sock = self._ssdp_socket()
+        natter.start_daemon_thread(self._ssdp_serve)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.ssdp_sock.close()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _ssdp_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        natter.socket_set_opt(sock, reuse=True)
+        if self.ssdp_addr is None:
+            # real multicast SSDP
+            sock.bind(("", 1900))
+            mreq = struct.pack("4s4s", socket.inet_aton("239.255.255.250"), socket.inet_aton(self.ip))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            self.ssdp_addr = ("239.255.255.250", 1900)
+        else:
+            sock.bind(self.ssdp_addr)
+            self.ssdp_addr = sock.getsockname()
+        return sock
+
+    def _locations(self):
+        base = "http://%s:%d" % (self.ip, self.http_port)
+        return ["%s/noise/%d/desc.xml" % (base, i) for i in range(self.noise)] + \
+            ["%s/rootDesc.xml" % base]
+
+    def _ssdp_serve(self):
+        while True:
+            try:
+                buff, addr = self.ssdp_sock.recvfrom(4096)
+            except (OSError, socket.error):
+                return
+            if not buff.startswith(b"M-SEARCH"):
+                continue
+            self._count("M-SEARCH")
+            for location in self._locations():
+                self.ssdp_sock.sendto((
+                    "HTTP/1.1 200 OK\r\n"
+                    "CACHE-CONTROL: max-age=120\r\n"
+                    "ST: upnp:rootdevice\r\n"
+                    "USN: uuid:natter-mock-igd::upnp:rootdevice\r\n"
+                    "EXT:\r\n"
+                    "SERVER: Natter/%s UPnP/1.1 MockIGD\r\n"
+                    "LOCATION: %s\r\n"
+                    "\r\n" % (__version__, location)
+                ).encode(), addr)
+
+    def _reply(self, req, code, body, content_type="text/xml"):
+        data = body.encode()
+        req.send_response(code)
+        req.send_header("Content-Type", content_type + "; charset=\"utf-8\"")
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    def _handle_get(self, req):
+        self._count("GET")
+        m = re.match(r"^/noise/([0-9]+)/desc.xml$", req.path)
+        if m:
+            time.sleep(self.noise_latency)
+            i = int(m.group(1))
+            return self._reply(req, 200, NOISE_XML % (i, i, i, i))
+        if req.path == "/rootDesc.xml":
+            time.sleep(self.desc_latency)
+            return self._reply(req, 200, IGD_XML)
+        self._reply(req, 404, "Not Found", "text/plain")
+
+    def _handle_post(self, req):
+        body = req.rfile.read(int(req.headers.get("Content-Length", 0))).decode("utf-8", "ignore")
+        action = req.headers.get("SOAPAction", "").strip("\"").rsplit("#", 1)[-1]
+        self._count(action)
+        time.sleep(self.latency)
+        if req.path != "/ctl/IPConn":
+            return self._reply(req, 404, "Not Found", "text/plain")
+        if self.fail_rate and random.random() < self.fail_rate:
+            return self._reply(req, 500, SOAP_FAULT % (501, "ActionFailed"))
+        args = dict(re.findall(r"<(New[A-Za-z]+)\s*>([^<]*?)</New[A-Za-z]+\s*>", body))
+        func = {
+            "GetExternalIPAddress":         self._get_external_ip,
+            "AddPortMapping":               self._add_port_mapping,
+            "GetSpecificPortMappingEntry":  self._get_specific_entry,
+            "DeletePortMapping":            self._delete_port_mapping
+        }.get(action)
+        if self.no_get_entry and action == "GetSpecificPortMappingEntry":
+            func = None
+        if func is None:
+            return self._reply(req, 500, SOAP_FAULT % (401, "Invalid Action"))
+        try:
+            out = func(args)
+        except LookupError:
+            return self._reply(req, 500, SOAP_FAULT % (714, "NoSuchEntryInArray"))
+        except ValueError:
+            return self._reply(req, 500, SOAP_FAULT % (402, "Invalid Args"))
+        self._reply(req, 200, SOAP_RESPONSE % (
+            action, SERVICE_TYPE,
+            "".join("      <%s>%s</%s>\n" % (k, v, k) for k, v in out),
+            action
+        ))
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            if self.flush_interval and now - self._flushed_at >= self.flush_interval:
+                # simulate a router reboot
+                self.mappings.clear()
+                self._flushed_at = now
+            for key, value in list(self.mappings.items()):
+                if value[3] and value[3] <= now:
+                    del self.mappings[key]
+
+    def _key(self, args):
+        return args.get("NewRemoteHost", ""), int(args["NewExternalPort"]), args["NewProtocol"]
+
+    def _get_external_ip(self, args):
+        return [("NewExternalIPAddress", self.external_ip)]
+
+    def _add_port_mapping(self, args):
+        self._expire()
+        lease = int(args.get("NewLeaseDuration") or 0)
+        with self._lock:
+            self.mappings[self._key(args)] = (
+                args["NewInternalClient"], int(args["NewInternalPort"]),
+                args.get("NewPortMappingDescription", ""),
+                time.time() + lease if lease else 0
+            )
+        return []
+
+    def _get_specific_entry(self, args):
+        self._expire()
+        with self._lock:
+            client, port, desc, expire_at = self.mappings[self._key(args)]
+        remaining = int(max(0, expire_at - time.time())) if expire_at else 0
+        return [
+            ("NewInternalPort",             port),
+            ("NewInternalClient",           client),
+            ("NewEnabled",                  1),
+            ("NewPortMappingDescription",   desc),
+            ("NewLeaseDuration",            remaining)
+        ]
+
+    def _delete_port_mapping(self, args):
+        with self._lock:
+            del self.mappings[self._key(args)]
+        return []
+
+
+def self_test(igd, rounds):
+    # Time Natter's UPnP client against the mock, fully offline, with a
+    # throwaway cache directory so earlier runs do not skew the timings
+    cache_dir = tempfile.mkdtemp(prefix="natter-mock-igd-")
+    os.environ["XDG_CACHE_HOME"] = cache_dir
+    try:
+        _self_test(igd, rounds)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _self_test(igd, rounds):
+    def timed(text, func):
+        ts = time.time()
+        ret = func()
+        print("%-40s %8.1f ms" % (text, (time.time() - ts) * 1000))
+        return ret
+
+    client = natter.UPnPClient(bind_ip=igd.ip)
+    client.ssdp_addr = igd.ssdp_addr
+    router = timed("discover (SSDP)", client.discover_router)
+    if not router:
+        raise RuntimeError("Mock IGD was not discovered")
+    client = natter.UPnPClient(bind_ip=igd.ip)
+    client.ssdp_addr = igd.ssdp_addr
+    timed("discover (cached)", client.discover_router)
+    timed("forward", lambda: client.forward("", 40000, "192.168.1.100", 40000, duration=30))
+    client.check_interval = 0
+
+    def repeat(text, force_renew):
+        failures = 0
+        ts = time.time()
+        for _ in range(rounds):
+            if force_renew:
+                client._renew_at = 0
+            try:
+                client.renew()
+            except (OSError, ValueError) as ex:
+                failures += 1
+        print("%-40s %8.1f ms  (%d failed)" % (
+            "%s x %d (avg)" % (text, rounds), (time.time() - ts) * 1000 / rounds, failures
+        ))
+
+    repeat("renew", True)
+    repeat("verify", False)
+    print()
+    for key in sorted(igd.stats):
+        print("%-40s %8d" % (key, igd.stats[key]))
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description="Mock UPnP Internet Gateway Device for testing Natter offline."
+    )
+    argp.add_argument("--ip", default="127.0.0.1", help="IP address to serve on")
+    argp.add_argument("--http-port", type=int, default=0, help="HTTP port (default: random)")
+    argp.add_argument(
+        "--ssdp-port", type=int, default=None,
+        help="answer SSDP by unicast on this port instead of joining 239.255.255.250:1900"
+    )
+    argp.add_argument("--external-ip", default="203.0.113.10", help="reported external IP")
+    argp.add_argument("--latency", type=float, default=0.0, help="seconds of delay per SOAP call")
+    argp.add_argument("--desc-latency", type=float, default=0.0,
+                      help="seconds of delay serving the IGD description")
+    argp.add_argument("--fail-rate", type=float, default=0.0,
+                      help="probability of a SOAP call failing with 501 ActionFailed")
+    argp.add_argument("--noise", type=int, default=0,
+                      help="number of extra non-IGD devices announced before the IGD")
+    argp.add_argument("--noise-latency", type=float, default=0.5,
+                      help="seconds of delay serving each extra device description")
+    argp.add_argument("--flush-interval", type=float, default=0,
+                      help="drop all mappings every N seconds, like a router reboot")
+    argp.add_argument("--no-get-entry", action="store_true",
+                      help="answer GetSpecificPortMappingEntry with 401 Invalid Action")
+    argp.add_argument("--self-test", type=int, metavar="<rounds>", default=0,
+                      help="run Natter's UPnP client against the mock and print timings")
+    argp.add_argument("-v", action="store_true", help="verbose mode, printing debug messages")
+    args = argp.parse_args()
+
+    if args.v:
+        natter.Logger.set_level(natter.Logger.DEBUG)
+    ssdp_addr = None
+    if args.ssdp_port is not None:
+        ssdp_addr = (args.ip, args.ssdp_port)
+    elif args.self_test:
+        ssdp_addr = (args.ip, 0)
+    igd = MockIGD(
+        args.ip, args.http_port, ssdp_addr, args.external_ip, args.latency, args.desc_latency,
+        args.fail_rate, args.noise, args.noise_latency, args.flush_interval, args.no_get_entry
+    ).start()
+    print("> MockIGD v%s\n" % __version__)
+    print("HTTP: http://%s:%d/rootDesc.xml" % (igd.ip, igd.http_port))
+    print("SSDP: %s:%d\n" % igd.ssdp_addr)
+    sys.stdout.flush()
+
+    if args.self_test:
+        self_test(igd, args.self_test)
+        return
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        igd.stop()
+
+
+if __name__ == "__main__":
+    main()
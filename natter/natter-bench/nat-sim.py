@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+
+'''
+NatSim - https://github.com/MikeWang000000/Natter
+Copyright (C) 2023  MikeWang000000
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import shlex
+import random
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import natter
+
+__version__ = natter.__version__
+
+NAT_TYPES = ("full-cone", "restricted", "port-restricted", "symmetric")
+
+
+class NatEntry(object):
+    # One NAT mapping: internal endpoint <=> public endpoint
+    def __init__(self, sim, internal):
+        self.sim = sim
+        self.internal = internal
+        self.contacted = set()
+        self.last_active = time.time()
+        self.dead = False
+        self.conns = []         # sockets to close when the mapping goes away
+        self.sessions = {}      # UDP peer => socket towards the internal endpoint
+        self._lock = threading.Lock()
+        self.sock = socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM if sim.udp else socket.SOCK_STREAM
+        )
+        self.sock.bind((sim.public_ip, 0))
+        self.external = self.sock.getsockname()
+        if sim.udp:
+            natter.start_daemon_thread(self._serve_udp)
+        else:
+            self.sock.listen(16)
+            natter.start_daemon_thread(self._serve_tcp)
+
+    def touch(self, dest=None):
+        self.last_active = time.time()
+        if dest is not None:
+            self.contacted.add(dest)
+
+    def track(self, sock):
+        with self._lock:
+            if self.dead:
+                return False
+            self.conns.append(sock)
+            return True
+
+    def allowed(self, peer):
+        nat_type = self.sim.nat_type
+        if nat_type == "full-cone":
+            return True
+        elif nat_type == "restricted":
+            return peer[0] in [addr[0] for addr in self.contacted]
+        return peer in self.contacted
+
+    def close(self):
+        with self._lock:
+            self.dead = True
+            socks = [self.sock] + self.conns + list(self.sessions.values())
+            self.conns = []
+            self.sessions = {}
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            sock.close()
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, peer = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            if not self.allowed(peer):
+                # a listening socket cannot drop a SYN, reset the connection instead
+                natter.Logger.debug("nat-sim: filtered %s -> %s" % (
+                    natter.addr_to_str(peer), natter.addr_to_str(self.external)
+                ))
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                conn.close()
+                continue
+            self.touch()
+            natter.start_daemon_thread(self._relay_tcp, args=(conn,))
+
+    def _relay_tcp(self, conn):
+        inner = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        inner.settimeout(3)
+        try:
+            inner.connect(self.internal)
+        except (OSError, socket.error):
+            conn.close()
+            inner.close()
+            return
+        inner.settimeout(None)
+        if not (self.track(conn) and self.track(inner)):
+            conn.close()
+            inner.close()
+            return
+        natter.start_daemon_thread(self._pipe, args=(inner, conn))
+        self._pipe(conn, inner)
+
+    def _pipe(self, src, dst):
+        try:
+            while True:
+                buff = src.recv(65536)
+                if not buff:
+                    break
+                self.touch()
+                dst.sendall(buff)
+            dst.shutdown(socket.SHUT_WR)
+        except (OSError, socket.error):
+            pass
+
+    def _serve_udp(self):
+        while True:
+            try:
+                buff, peer = self.sock.recvfrom(65536)
+            except (OSError, socket.error):
+                return
+            if not self.allowed(peer):
+                continue
+            self.touch()
+            with self._lock:
+                if self.dead:
+                    return
+                session = self.sessions.get(peer)
+                if session is None:
+                    session = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    session.connect(self.internal)
+                    self.sessions[peer] = session
+                    natter.start_daemon_thread(self._reply_udp, args=(session, peer))
+            try:
+                session.send(buff)
+            except (OSError, socket.error):
+                pass
+
+    def _reply_udp(self, session, peer):
+        while True:
+            try:
+                buff = session.recv(65536)
+                self.touch()
+                self.sock.sendto(buff, peer)
+            except (OSError, socket.error):
+                return
+
+
+class NatSimulator(object):
+    # User-space NAT in front of a local STUN responder and keep-alive server.
+    # Natter is pointed at the servers with -s/-h; the servers see its real
+    # source address and answer as if the traffic had gone through a NAT.
+    def __init__(self, nat_type="full-cone", udp=False, server_ip="127.0.0.2",
+                 public_ip="127.0.0.3", timeout=120, remap_interval=0):
+        if nat_type not in NAT_TYPES:
+            raise ValueError("Unknown NAT type: %s" % nat_type)
+        self.nat_type = nat_type
+        self.udp = udp
+        self.server_ip = server_ip
+        self.public_ip = public_ip
+        self.timeout = timeout
+        self.remap_interval = remap_interval
+        self.entries = {}       # internal, or (internal, dest) if symmetric => NatEntry
+        self.stats = {}         # key => count
+        self.servers = []
+        self._lock = threading.Lock()
+        self._remapped_at = time.time()
+
+    def start(self):
+        sock_type = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
+        for _ in range(3):
+            sock = socket.socket(socket.AF_INET, sock_type)
+            sock.bind((self.server_ip, 0))
+            self.servers.append(sock)
+        stun1, stun2, keepalive = self.servers
+        if self.udp:
+            natter.start_daemon_thread(self._serve_udp, args=(stun1, self._stun_reply))
+            natter.start_daemon_thread(self._serve_udp, args=(stun2, self._stun_reply))
+            natter.start_daemon_thread(self._serve_udp, args=(keepalive, self._dns_reply))
+        else:
+            for sock, handler in ((stun1, self._stun_tcp), (stun2, self._stun_tcp),
+                                  (keepalive, self._http_tcp)):
+                sock.listen(16)
+                natter.start_daemon_thread(self._serve_tcp, args=(sock, handler))
+        natter.start_daemon_thread(self._expire_loop)
+        return self
+
+    def stop(self):
+        for sock in self.servers:
+            sock.close()
+        self._drop()
+
+    def stun_servers(self):
+        return [natter.addr_to_str(sock.getsockname()) for sock in self.servers[:2]]
+
+    def keepalive_server(self):
+        return natter.addr_to_str(self.servers[2].getsockname())
+
+    def remap(self):
+        # forget every mapping and drop the connections through them, like a NAT reboot
+        self._remapped_at = time.time()
+        count = self._drop()
+        self._count("remap")
+        natter.Logger.debug("nat-sim: dropped %d mapping(s)" % count)
+
+    def _drop(self):
+        with self._lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        for entry in entries:
+            entry.close()
+        return len(entries)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _map(self, internal, dest):
+        key = (internal, dest) if self.nat_type == "symmetric" else internal
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = NatEntry(self, internal)
+                self.entries[key] = entry
+                self.stats["mapping"] = self.stats.get("mapping", 0) + 1
+                natter.Logger.debug("nat-sim: new mapping %s -> %s" % (
+                    natter.addr_to_str(internal), natter.addr_to_str(entry.external)
+                ))
+        entry.touch(dest)
+        return entry
+
+    def _expire_loop(self):
+        while True:
+            time.sleep(0.2)
+            now = time.time()
+            if self.remap_interval and now - self._remapped_at >= self.remap_interval:
+                self.remap()
+                continue
+            with self._lock:
+                expired = [
+                    (key, entry) for key, entry in self.entries.items()
+                    if now - entry.last_active >= self.timeout
+                ]
+                for key, _ in expired:
+                    del self.entries[key]
+            for _, entry in expired:
+                self._count("expired")
+                entry.close()
+
+    def _stun_reply(self, request, internal, dest):
+        # ref: https://www.rfc-editor.org/rfc/rfc5389
+        if len(request) < 20:
+            return None
+        msg_type, _, cookie = struct.unpack("!HHL", request[:8])
+        if msg_type != 0x0001 or cookie != 0x2112a442:
+            return None
+        self._count("stun")
+        entry = self._map(internal, dest)
+        ip, port = entry.external
+        ip = struct.unpack("!L", socket.inet_aton(ip))[0]
+        attrs = struct.pack("!HHBBHL", 0x0001, 8, 0, 1, port, ip) + \
+            struct.pack("!HHBBHL", 0x0020, 8, 0, 1, port ^ 0x2112, ip ^ 0x2112a442)
+        return struct.pack("!HHL", 0x0101, len(attrs), cookie) + request[8:20] + attrs
+
+    def _dns_reply(self, request, internal, dest):
+        if len(request) < 12:
+            return None
+        self._count("keep-alive")
+        self._map(internal, dest)
+        txid, flags = struct.unpack("!HH", request[:4])
+        # NXDOMAIN, question echoed back
+        return struct.pack("!HHHHHH", txid, 0x8183 | (flags & 0x0100), 1, 0, 0, 0) + request[12:]
+
+    def _serve_udp(self, sock, handler):
+        dest = sock.getsockname()
+        while True:
+            try:
+                buff, internal = sock.recvfrom(1500)
+            except (OSError, socket.error):
+                return
+            reply = handler(buff, internal, dest)
+            if reply:
+                sock.sendto(reply, internal)
+
+    def _serve_tcp(self, sock, handler):
+        dest = sock.getsockname()
+        while True:
+            try:
+                conn, internal = sock.accept()
+            except (OSError, socket.error):
+                return
+            natter.start_daemon_thread(handler, args=(conn, internal, dest))
+
+    def _stun_tcp(self, conn, internal, dest):
+        try:
+            conn.settimeout(3)
+            buff = b""
+            while len(buff) < 20:
+                data = conn.recv(1500)
+                if not data:
+                    return
+                buff += data
+            reply = self._stun_reply(buff, internal, dest)
+            if reply:
+                conn.sendall(reply)
+        except (OSError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def _http_tcp(self, conn, internal, dest):
+        # keep-alive server, answers every request on a persistent connection
+        entry = self._map(internal, dest)
+        if not entry.track(conn):
+            conn.close()
+            return
+        buff = b""
+        try:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                buff += data
+                while b"\r\n\r\n" in buff:
+                    _, buff = buff.split(b"\r\n\r\n", 1)
+                    if entry.dead:
+                        # the NAT has forgotten this connection
+                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                        return
+                    self._count("keep-alive")
+                    entry.touch(dest)
+                    conn.sendall(
+                        b"HTTP/1.1 204 No Content\r\n"
+                        b"Server: NatSim\r\n"
+                        b"Connection: keep-alive\r\n"
+                        b"\r\n"
+                    )
+        except (OSError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+class RecoveryBench(object):
+    # Runs natter.py behind the simulator, forces remaps and times
+    #   detect:  remap -> Natter reports the new mapped address
+    #   recover: remap -> the test server answers through the new address
+    def __init__(self, sim, natter_args, peer_ip="127.0.0.4", deadline=120, verbose=False):
+        self.sim = sim
+        self.natter_args = natter_args
+        self.peer_ip = peer_ip
+        self.deadline = deadline
+        self.verbose = verbose
+        self.proc = None
+        self.events = queue.Queue()
+        self.outer = None
+        self.cache_dir = None
+
+    def start(self):
+        cmd = [
+            sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "natter.py"),
+            "-s", self.sim.stun_servers()[0], "-s", self.sim.stun_servers()[1],
+            "-h", self.sim.keepalive_server(), "-m", "test", "--json-events"
+        ]
+        if self.sim.udp:
+            cmd.append("-u")
+        cmd += self.natter_args
+        # a fresh cache, so a cached STUN server choice does not skew the result
+        self.cache_dir = tempfile.mkdtemp(prefix="natter-nat-sim-")
+        env = dict(os.environ, XDG_CACHE_HOME=self.cache_dir)
+        natter.Logger.debug("nat-sim: %s" % " ".join(shlex.quote(x) for x in cmd))
+        self.proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=None if self.verbose else subprocess.DEVNULL,
+            env=env, universal_newlines=True
+        )
+        natter.start_daemon_thread(self._read_events)
+        event = self._wait(lambda e: e["event"] == "mapping_acquired", self.deadline)
+        if event is None:
+            raise RuntimeError("Natter did not acquire a mapping")
+        self.outer = event["outer"]
+        if not self.sim.udp:
+            # startup port tests are done once the WAN test is reported
+            self._wait(lambda e: e["event"] == "port_test" and e["scope"] == "wan", self.deadline)
+        return self
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.cache_dir = None
+
+    def _read_events(self):
+        for line in self.proc.stdout:
+            try:
+                self.events.put(json.loads(line))
+            except ValueError:
+                continue
+        self.events.put(None)
+
+    def _wait(self, match, timeout):
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                event = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if event is None:
+                raise RuntimeError("Natter has exited")
+            natter.Logger.debug("nat-sim: event %s" % json.dumps(event, sort_keys=True))
+            if match(event):
+                return event
+
+    def probe(self, outer):
+        ip, port = outer.rsplit(":", 1)
+        sock_type = socket.SOCK_DGRAM if self.sim.udp else socket.SOCK_STREAM
+        sock = socket.socket(socket.AF_INET, sock_type)
+        try:
+            sock.bind((self.peer_ip, 0))
+            sock.settimeout(0.5)
+            sock.connect((ip, int(port)))
+            if self.sim.udp:
+                sock.send(b"nat-sim\r\n")
+            else:
+                sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            return b"It works!" in sock.recv(4096)
+        except (OSError, socket.error):
+            return False
+        finally:
+            sock.close()
+
+    def round(self):
+        # returns detect, recover in seconds, None for what did not happen in time
+        ts = time.time()
+        self.sim.remap()
+        previous = self.outer
+        detect = recover = None
+        event = self._wait(
+            lambda e: e["event"] in ("mapping_changed", "mapping_acquired") and e["outer"] != previous,
+            self.deadline
+        )
+        if event is None:
+            return detect, recover
+        detect = time.time() - ts
+        self.outer = event["outer"]
+        while time.time() - ts < self.deadline:
+            if self.probe(self.outer):
+                recover = time.time() - ts
+                break
+            time.sleep(0.05)
+        return detect, recover
+
+    def run(self, rounds, settle=1, jitter=5):
+        results = []
+        for i in range(rounds):
+            # remap at a random point of Natter's keep-alive loop
+            time.sleep(settle + random.random() * jitter)
+            detect, recover = self.round()
+            results.append({"round": i + 1, "detect": detect, "recover": recover})
+            print("round %-3d  detect %s  recover %s" % (i + 1, fmt(detect), fmt(recover)))
+            sys.stdout.flush()
+        return results
+
+
+def fmt(value):
+    return "%8.2f s" % value if value is not None else "%8s  " % "-"
+
+
+def summarize(results):
+    out = {"rounds": len(results)}
+    for key in ("detect", "recover"):
+        samples = [r[key] for r in results if r[key] is not None]
+        out[key] = {
+            "ok": len(samples),
+            "p50": percentile(samples, 50),
+            "max": max(samples) if samples else None
+        }
+    return out
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description="User-space NAT with a local STUN responder for testing Natter offline."
+    )
+    argp.add_argument("--nat", choices=NAT_TYPES, default="full-cone", help="NAT behaviour")
+    argp.add_argument("-u", action="store_true", help="UDP mode")
+    argp.add_argument("--server-ip", default="127.0.0.2", help="IP address of the STUN and keep-alive servers")
+    argp.add_argument("--public-ip", default="127.0.0.3", help="public IP address of the NAT")
+    argp.add_argument("--peer-ip", default="127.0.0.4", help="IP address the benchmark connects from")
+    argp.add_argument("--timeout", type=float, default=120,
+                      help="seconds before an idle mapping expires")
+    argp.add_argument("--remap-interval", type=float, default=0,
+                      help="drop all mappings every N seconds, like a NAT reboot")
+    argp.add_argument("--bench", type=int, metavar="<rounds>", default=0,
+                      help="run natter.py behind the NAT, force remaps and time the recovery")
+    argp.add_argument("--deadline", type=float, default=120,
+                      help="seconds to wait for each benchmark round")
+    argp.add_argument("--natter-args", default="-k 5", help="extra options for natter.py in benchmark")
+    argp.add_argument("--json", action="store_true", help="print the benchmark summary as JSON")
+    argp.add_argument("-v", action="store_true", help="verbose mode, printing debug messages")
+    args = argp.parse_args()
+
+    if args.v:
+        natter.Logger.set_level(natter.Logger.DEBUG)
+    sim = NatSimulator(
+        args.nat, args.u, args.server_ip, args.public_ip, args.timeout,
+        0 if args.bench else args.remap_interval
+    ).start()
+    print("> NatSim v%s (%s, %s)\n" % (__version__, args.nat, "udp" if args.u else "tcp"))
+    print("STUN:       %s" % ", ".join(sim.stun_servers()))
+    print("Keep-alive: %s" % sim.keepalive_server())
+    print("Public IP:  %s\n" % sim.public_ip)
+    sys.stdout.flush()
+
+    if args.bench:
+        bench = RecoveryBench(sim, shlex.split(args.natter_args), args.peer_ip, args.deadline, args.v)
+        try:
+            bench.start()
+            results = bench.run(args.bench)
+        finally:
+            bench.stop()
+            sim.stop()
+        summary = summarize(results)
+        summary["stats"] = sim.stats
+        if args.json:
+            print(json.dumps(summary, indent=2, sort_keys=True))
+            return
+        print()
+        for key in ("detect", "recover"):
+            s = summary[key]
+            print("%-8s %d/%d ok  p50 %s  max %s" % (key, s["ok"], summary["rounds"], fmt(s["p50"]), fmt(s["max"])))
+        print()
+        for key in sorted(sim.stats):
+            print("%-20s %8d" % (key, sim.stats[key]))
+        return
+
+    print("Run: python3 natter.py %s-s %s -s %s -h %s" % (
+        "-u " if args.u else "", sim.stun_servers()[0], sim.stun_servers()[1], sim.keepalive_server()
+    ))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
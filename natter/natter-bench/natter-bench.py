@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+'''
+NatterBench - https://github.com/MikeWang000000/Natter
+Copyright (C) 2023  MikeWang000000
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import natter
+
+__version__ = natter.__version__
+
+
+FORWARD_METHODS = {
+    "socket":               natter.ForwardSocket,
+    "socat":                natter.ForwardSocat,
+    "gost":                 natter.ForwardGost,
+    "iptables":             natter.ForwardIptables,
+    "iptables-snat":        natter.ForwardIptablesSnat,
+    "nftables":             natter.ForwardNftables,
+    "nftables-snat":        natter.ForwardNftablesSnat,
+    "nftables-flowtable":   natter.ForwardNftablesFlowtable
+}
+
+TESTS = ["tcp-stream", "tcp-rr", "tcp-crr", "udp-flood", "udp-rr"]
+
+# Echo server protocol (TCP): the first byte selects the mode
+MODE_ECHO = b"E"
+MODE_SINK = b"S"
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    idx = min(len(samples) - 1, int(len(samples) * pct / 100.0))
+    return samples[idx]
+
+
+def wait_ready(proc):
+    line = proc.stdout.readline().decode().strip()
+    if line != "READY":
+        raise RuntimeError("Helper process failed: %s" % (line or proc.wait()))
+
+
+class EchoServer(object):
+    def __init__(self, ip, port, udp=False):
+        self.ip = ip
+        self.port = port
+        self.udp = udp
+        self.buff_size = 65536
+
+    def serve(self):
+        sock_type = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
+        sock = socket.socket(socket.AF_INET, sock_type)
+        natter.socket_set_opt(sock, reuse=True, bind_addr=(self.ip, self.port))
+        if self.udp:
+            natter.start_daemon_thread(self._serve_udp, args=(sock,))
+        else:
+            sock.listen(128)
+            natter.start_daemon_thread(self._serve_tcp, args=(sock,))
+
+    def _serve_tcp(self, sock):
+        while True:
+            conn, _ = sock.accept()
+            natter.start_daemon_thread(self._handle_tcp, args=(conn,))
+
+    def _handle_tcp(self, conn):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            mode = conn.recv(1)
+            while True:
+                buff = conn.recv(self.buff_size)
+                if not buff:
+                    break
+                if mode == MODE_ECHO:
+                    conn.sendall(buff)
+        except (OSError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def _serve_udp(self, sock):
+        while True:
+            buff, addr = sock.recvfrom(self.buff_size)
+            sock.sendto(buff, addr)
+
+
+class LoadGenerator(object):
+    def __init__(self, ip, port, streams=4, duration=5.0, size=1400):
+        self.ip = ip
+        self.port = port
+        self.streams = streams
+        self.duration = duration
+        self.size = size
+        self.buff_size = 65536
+        self.timeout = 3
+        self._lock = threading.Lock()
+
+    def run(self, test):
+        func = {
+            "tcp-stream":   self._tcp_stream,
+            "tcp-rr":       self._tcp_rr,
+            "tcp-crr":      self._tcp_crr,
+            "udp-flood":    self._udp_flood,
+            "udp-rr":       self._udp_rr
+        }[test]
+        self.result = {"bytes": 0, "ops": 0, "errors": 0, "sent": 0, "samples": []}
+        deadline = time.time() + self.duration
+        threads = [
+            natter.start_daemon_thread(func, args=(deadline,)) for _ in range(self.streams)
+        ]
+        ts = time.time()
+        for th in threads:
+            th.join(self.duration + self.timeout * 2)
+        elapsed = time.time() - ts
+        r = self.result
+        samples = r.pop("samples")
+        r["elapsed"] = elapsed
+        r["throughput"] = r["bytes"] / elapsed
+        r["rate"] = r["ops"] / elapsed
+        r["p50"] = percentile(samples, 50)
+        r["p99"] = percentile(samples, 99)
+        if r["sent"]:
+            r["loss"] = 1 - float(r["ops"]) / r["sent"]
+        return r
+
+    def _add(self, **kwargs):
+        with self._lock:
+            for key, value in kwargs.items():
+                if key == "samples":
+                    self.result["samples"].extend(value)
+                else:
+                    self.result[key] += value
+
+    def _tcp_connect(self, mode):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        sock.connect((self.ip, self.port))
+        sock.sendall(mode)
+        return sock
+
+    def _tcp_stream(self, deadline):
+        chunk = b"\0" * self.buff_size
+        sent = 0
+        try:
+            sock = self._tcp_connect(MODE_SINK)
+        except (OSError, socket.error):
+            self._add(errors=1)
+            return
+        try:
+            while time.time() < deadline:
+                sock.sendall(chunk)
+                sent += len(chunk)
+        except (OSError, socket.error):
+            self._add(errors=1)
+        finally:
+            sock.close()
+        self._add(bytes=sent)
+
+    def _tcp_rr(self, deadline):
+        samples = []
+        try:
+            sock = self._tcp_connect(MODE_ECHO)
+        except (OSError, socket.error):
+            self._add(errors=1)
+            return
+        try:
+            while time.time() < deadline:
+                ts = time.time()
+                sock.sendall(b"x")
+                if not sock.recv(1):
+                    raise OSError("Connection closed")
+                samples.append(time.time() - ts)
+        except (OSError, socket.error):
+            self._add(errors=1)
+        finally:
+            sock.close()
+        self._add(ops=len(samples), bytes=len(samples), samples=samples)
+
+    def _tcp_crr(self, deadline):
+        samples = []
+        errors = 0
+        while time.time() < deadline:
+            ts = time.time()
+            try:
+                sock = self._tcp_connect(MODE_ECHO)
+                try:
+                    sock.sendall(b"x")
+                    if not sock.recv(1):
+                        raise OSError("Connection closed")
+                finally:
+                    sock.close()
+                samples.append(time.time() - ts)
+            except (OSError, socket.error):
+                errors += 1
+        self._add(ops=len(samples), errors=errors, samples=samples)
+
+    def _udp_flood(self, deadline):
+        packet = b"\0" * self.size
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((self.ip, self.port))
+        stop = threading.Event()
+        recv = [0]
+        def receiver():
+            sock.settimeout(0.5)
+            while not stop.is_set():
+                try:
+                    sock.recv(self.buff_size)
+                    recv[0] += 1
+                except socket.timeout:
+                    continue
+                except (OSError, socket.error):
+                    return
+        th = natter.start_daemon_thread(receiver)
+        sent = 0
+        try:
+            while time.time() < deadline:
+                for _ in range(64):
+                    sock.send(packet)
+                sent += 64
+        except (OSError, socket.error):
+            self._add(errors=1)
+        time.sleep(0.5)
+        stop.set()
+        th.join()
+        sock.close()
+        self._add(sent=sent, ops=recv[0], bytes=recv[0] * self.size)
+
+    def _udp_rr(self, deadline):
+        samples = []
+        errors = 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        sock.connect((self.ip, self.port))
+        while time.time() < deadline:
+            ts = time.time()
+            try:
+                sock.send(b"x")
+                sock.recv(self.buff_size)
+                samples.append(time.time() - ts)
+            except (OSError, socket.error):
+                errors += 1
+        sock.close()
+        self._add(ops=len(samples), bytes=len(samples), errors=errors, samples=samples)
+
+
+class ProcStat(object):
+    # CPU and memory of a process tree and the whole system, from procfs
+    def __init__(self, pid):
+        self.pid = pid
+        self.clk_tck = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.available = os.path.isdir("/proc/%d" % pid)
+        self.rss_peak = 0
+        self._stop = threading.Event()
+        self._th = None
+
+    def _tree(self):
+        ppid_d = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                fin = open("/proc/%s/stat" % name, "r")
+                fields = fin.read().rsplit(")", 1)[1].split()
+                fin.close()
+            except (OSError, IOError, IndexError):
+                continue
+            ppid_d.setdefault(int(fields[1]), []).append(int(name))
+        pids = [self.pid]
+        for pid in pids:
+            pids.extend(ppid_d.get(pid, []))
+        return pids
+
+    def _cpu_ticks(self):
+        ticks = 0
+        for pid in self._tree():
+            try:
+                fin = open("/proc/%d/stat" % pid, "r")
+                fields = fin.read().rsplit(")", 1)[1].split()
+                fin.close()
+            except (OSError, IOError, IndexError):
+                continue
+            # utime, stime, cutime, cstime
+            ticks += sum(int(v) for v in fields[11:15])
+        return ticks
+
+    def _rss(self):
+        rss = 0
+        for pid in self._tree():
+            try:
+                fin = open("/proc/%d/status" % pid, "r")
+                lines = fin.read().splitlines()
+                fin.close()
+            except (OSError, IOError):
+                continue
+            for line in lines:
+                if line.startswith("VmRSS:"):
+                    rss += int(line.split()[1]) * 1024
+        return rss
+
+    def _sys_ticks(self):
+        fin = open("/proc/stat", "r")
+        fields = [int(v) for v in fin.readline().split()[1:]]
+        fin.close()
+        idle = fields[3] + fields[4]
+        softirq = fields[6] if len(fields) > 6 else 0
+        return sum(fields), idle, softirq
+
+    def _sample_rss(self):
+        while not self._stop.wait(0.2):
+            self.rss_peak = max(self.rss_peak, self._rss())
+
+    def start(self):
+        if not self.available:
+            return
+        self.rss_peak = self._rss()
+        self._ts = time.time()
+        self._cpu0 = self._cpu_ticks()
+        self._sys0 = self._sys_ticks()
+        self._th = natter.start_daemon_thread(self._sample_rss)
+
+    def stop(self):
+        if not self.available:
+            return {}
+        elapsed = time.time() - self._ts
+        cpu1 = self._cpu_ticks()
+        sys1 = self._sys_ticks()
+        self._stop.set()
+        self._th.join()
+        total = float(sys1[0] - self._sys0[0]) or 1.0
+        ncpu = os.cpu_count() or 1
+        return {
+            "cpu": (cpu1 - self._cpu0) / float(self.clk_tck) / elapsed,
+            "sys_cpu": (total - (sys1[1] - self._sys0[1])) / total * ncpu,
+            "softirq": (sys1[2] - self._sys0[2]) / total * ncpu,
+            "rss": self.rss_peak
+        }
+
+
+class NetNs(object):
+    # client ns <-> host (forwarder) <-> target ns, so kernel methods really forward
+    CLIENT = "natter-bench-c"
+    TARGET = "natter-bench-t"
+
+    def __init__(self):
+        self.client_ip = "10.253.0.2"
+        self.host_ip = "10.253.0.1"
+        self.target_ip = "10.254.0.2"
+        self.host_target_ip = "10.254.0.1"
+        self.ip_forward = None
+
+    def _ip(self, *args):
+        subprocess.check_output(["ip"] + list(args), stderr=subprocess.STDOUT)
+
+    def setup(self):
+        if os.getuid() != 0:
+            raise OSError("--netns requires root")
+        self.teardown()
+        for ns, peer, host_ip, ns_ip in (
+            (self.CLIENT, "nb-c", self.host_ip, self.client_ip),
+            (self.TARGET, "nb-t", self.host_target_ip, self.target_ip)
+        ):
+            self._ip("netns", "add", ns)
+            self._ip("link", "add", peer, "type", "veth", "peer", "name", peer + "-ns")
+            self._ip("link", "set", peer + "-ns", "netns", ns)
+            self._ip("addr", "add", host_ip + "/24", "dev", peer)
+            self._ip("link", "set", peer, "up")
+            self._ip("-n", ns, "addr", "add", ns_ip + "/24", "dev", peer + "-ns")
+            self._ip("-n", ns, "link", "set", peer + "-ns", "up")
+            self._ip("-n", ns, "link", "set", "lo", "up")
+            self._ip("-n", ns, "route", "add", "default", "via", host_ip)
+        fin = open("/proc/sys/net/ipv4/ip_forward", "r")
+        self.ip_forward = fin.read().strip()
+        fin.close()
+        self._set_ip_forward("1")
+
+    def _set_ip_forward(self, value):
+        fout = open("/proc/sys/net/ipv4/ip_forward", "w")
+        fout.write(value)
+        fout.close()
+
+    def teardown(self):
+        for ns, peer in ((self.CLIENT, "nb-c"), (self.TARGET, "nb-t")):
+            for args in (("link", "del", peer), ("netns", "del", ns)):
+                try:
+                    self._ip(*args)
+                except (OSError, subprocess.CalledProcessError):
+                    pass
+        if self.ip_forward is not None:
+            self._set_ip_forward(self.ip_forward)
+            self.ip_forward = None
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.script = os.path.abspath(__file__)
+        self.netns = NetNs() if args.netns else None
+        self.results = []
+
+    def _helper(self, ns, *args):
+        cmd = [sys.executable, self.script] + list(args)
+        if ns:
+            cmd = ["ip", "netns", "exec", ns] + cmd
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _stop_helper(self, proc):
+        try:
+            proc.stdin.close()
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def run(self):
+        if self.netns:
+            self.netns.setup()
+            target_ip, fwd_ip = self.netns.target_ip, self.netns.host_ip
+            client_ns, target_ns = NetNs.CLIENT, NetNs.TARGET
+        else:
+            target_ip = fwd_ip = "127.0.0.1"
+            client_ns = target_ns = None
+        try:
+            for udp in (False, True):
+                tests = [t for t in self.args.tests if t.startswith("udp") == udp]
+                if tests:
+                    self._run_proto(udp, tests, target_ip, fwd_ip, client_ns, target_ns)
+        finally:
+            if self.netns:
+                self.netns.teardown()
+        return self.results
+
+    def _run_proto(self, udp, tests, target_ip, fwd_ip, client_ns, target_ns):
+        echo_port = natter.get_free_port(udp)
+        udp_arg = ["--udp"] if udp else []
+        echo = self._helper(target_ns, "--role", "echo", "--bind", target_ip,
+                            "--port", str(echo_port), *udp_arg)
+        try:
+            wait_ready(echo)
+            for method in self.args.methods:
+                fwd_port = natter.get_free_port(udp)
+                fwd = self._helper(None, "--role", "forward", "--method", method,
+                                   "--bind", fwd_ip, "--port", str(fwd_port),
+                                   "--to", target_ip, "--to-port", str(echo_port), *udp_arg)
+                try:
+                    wait_ready(fwd)
+                except RuntimeError as ex:
+                    sys.stderr.write("%s: %s\n" % (method, ex))
+                    self._stop_helper(fwd)
+                    continue
+                try:
+                    for test in tests:
+                        self._run_test(method, test, fwd, fwd_ip, fwd_port, client_ns)
+                finally:
+                    self._stop_helper(fwd)
+        finally:
+            self._stop_helper(echo)
+
+    def _run_test(self, method, test, fwd, fwd_ip, fwd_port, client_ns):
+        a = self.args
+        stat = ProcStat(fwd.pid)
+        load = self._helper(client_ns, "--role", "load", "--test", test,
+                            "--bind", fwd_ip, "--port", str(fwd_port),
+                            "--streams", str(a.streams), "--duration", str(a.duration),
+                            "--size", str(a.size))
+        stat.start()
+        out, _ = load.communicate()
+        result = {"method": method, "test": test}
+        result.update(stat.stop())
+        try:
+            result.update(json.loads(out.decode()))
+        except ValueError:
+            result["errors"] = -1
+        self.results.append(result)
+        if not a.json:
+            print_result(result)
+
+
+def fmt(value, scale=1.0, spec="%.2f"):
+    return "-" if value is None else spec % (value * scale)
+
+
+def print_header():
+    sys.stdout.write("%-20s %-10s %12s %12s %10s %10s %7s %7s %8s %7s %6s\n" % (
+        "method", "test", "MB/s", "ops/s", "p50(ms)", "p99(ms)",
+        "cpu%", "sys%", "rss(MB)", "loss%", "err"
+    ))
+    sys.stdout.flush()
+
+
+def print_result(r):
+    sys.stdout.write("%-20s %-10s %12s %12s %10s %10s %7s %7s %8s %7s %6s\n" % (
+        r["method"], r["test"],
+        fmt(r.get("throughput"), 1.0 / 1048576), fmt(r.get("rate"), spec="%.0f"),
+        fmt(r.get("p50"), 1000, "%.3f"), fmt(r.get("p99"), 1000, "%.3f"),
+        fmt(r.get("cpu"), 100, "%.1f"), fmt(r.get("sys_cpu"), 100, "%.1f"),
+        fmt(r.get("rss"), 1.0 / 1048576, "%.1f"), fmt(r.get("loss"), 100, "%.1f"),
+        r.get("errors", "-")
+    ))
+    sys.stdout.flush()
+
+
+def role_echo(args):
+    EchoServer(args.bind, args.port, args.udp).serve()
+    sys.stdout.write("READY\n")
+    sys.stdout.flush()
+    sys.stdin.read()
+
+
+def role_forward(args):
+    natter.Logger.set_level(natter.Logger.WARN)
+    try:
+        forwarder = FORWARD_METHODS[args.method]()
+        forwarder.start_forward(args.bind, args.port, args.to, args.to_port, udp=args.udp)
+    except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+        sys.stdout.write("%s\n" % ex)
+        sys.stdout.flush()
+        return
+    try:
+        sys.stdout.write("READY\n")
+        sys.stdout.flush()
+        sys.stdin.read()
+    finally:
+        forwarder.stop_forward()
+
+
+def role_load(args):
+    gen = LoadGenerator(args.bind, args.port, args.streams, args.duration, args.size)
+    sys.stdout.write(json.dumps(gen.run(args.test)))
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description="Benchmark Natter forward methods on this host."
+    )
+    argp.add_argument(
+        "--methods", default="socket,socat,gost,iptables,nftables",
+        help="comma separated forward methods, one of: %s" % ", ".join(sorted(FORWARD_METHODS))
+    )
+    argp.add_argument(
+        "--tests", default=",".join(TESTS),
+        help="comma separated tests, one of: %s" % ", ".join(TESTS)
+    )
+    argp.add_argument("--streams", type=int, default=4, help="concurrent streams/workers")
+    argp.add_argument("--duration", type=float, default=5.0, help="seconds per test")
+    argp.add_argument("--size", type=int, default=1400, help="UDP packet size")
+    argp.add_argument(
+        "--netns", action="store_true",
+        help="run client and target in network namespaces, so traffic is really forwarded (root)"
+    )
+    argp.add_argument("--json", action="store_true", help="print results as JSON")
+    # internal helper roles
+    argp.add_argument("--role", choices=["echo", "forward", "load"], help=argparse.SUPPRESS)
+    argp.add_argument("--method", help=argparse.SUPPRESS)
+    argp.add_argument("--test", help=argparse.SUPPRESS)
+    argp.add_argument("--bind", help=argparse.SUPPRESS)
+    argp.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    argp.add_argument("--to", help=argparse.SUPPRESS)
+    argp.add_argument("--to-port", type=int, help=argparse.SUPPRESS)
+    argp.add_argument("--udp", action="store_true", help=argparse.SUPPRESS)
+    args = argp.parse_args()
+
+    if args.role == "echo":
+        return role_echo(args)
+    if args.role == "forward":
+        return role_forward(args)
+    if args.role == "load":
+        return role_load(args)
+
+    args.methods = [m for m in args.methods.split(",") if m]
+    args.tests = [t for t in args.tests.split(",") if t]
+    for m in args.methods:
+        if m not in FORWARD_METHODS:
+            raise ValueError("Unknown method name: %s" % m)
+    for t in args.tests:
+        if t not in TESTS:
+            raise ValueError("Unknown test name: %s" % t)
+
+    if not args.json:
+        print("> NatterBench v%s\n" % __version__)
+        print_header()
+    results = Bench(args).run()
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
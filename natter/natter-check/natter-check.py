@@ -20,10 +20,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import sys
+import json
 import time
+import queue
 import socket
 import struct
 import codecs
+import argparse
+import threading
 
 __version__ = "2.1.1"
 
@@ -51,6 +55,42 @@ def new_socket_reuse(family, type):
     return sock
 
 
+def start_daemon_thread(target, args=()):
+    th = threading.Thread(target=target, args=args)
+    th.daemon = True
+    th.start()
+    return th
+
+
+def run_parallel(funcs, timeout):
+    # Run each function in a thread, results in order, None for the ones
+    # still running when the timeout expires.
+    results = [None] * len(funcs)
+    def run(i):
+        results[i] = funcs[i]()
+    threads = [start_daemon_thread(run, args=(i,)) for i in range(len(funcs))]
+    deadline = time.time() + timeout
+    for th in threads:
+        th.join(max(0, deadline - time.time()))
+    return results
+
+
+def iter_parallel(funcs, timeout):
+    # Run each function in a thread, yield results as they complete.
+    q = queue.Queue()
+    for func in funcs:
+        start_daemon_thread(lambda func=func: q.put(func()))
+    deadline = time.time() + timeout
+    for _ in funcs:
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            return
+        try:
+            yield q.get(timeout=time_left)
+        except queue.Empty:
+            return
+
+
 def check_docker_network():
     if not sys.platform.startswith("linux"):
         return
@@ -68,6 +108,44 @@ def check_docker_network():
         exit(-1)
 
 
+def cache_path(name):
+    # same place as natter.py keeps its cache, so natter can read the result
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "natter", name)
+
+
+def load_result(fpath, max_age):
+    try:
+        with open(fpath, "r") as fin:
+            dat = json.load(fin)
+    except (OSError, IOError, ValueError):
+        return None
+    if not isinstance(dat, dict) or dat.get("version") != __version__:
+        return None
+    if not isinstance(dat.get("timestamp"), (int, float)):
+        return None
+    if not 0 <= time.time() - dat["timestamp"] <= max_age:
+        return None
+    # the cached printout reads these, a hand-edited file may lack them
+    for proto in ["tcp", "udp"]:
+        entry = dat.get(proto)
+        if not isinstance(entry, dict) or entry.get("status") not in ["NA", "OK", "COMPAT", "FAIL"]:
+            return None
+    return dat
+
+
+def save_result(fpath, dat):
+    tmp_path = "%s.%d.tmp" % (fpath, os.getpid())
+    try:
+        if os.path.dirname(fpath) and not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(tmp_path, "w") as fout:
+            json.dump(dat, fout, indent=2)
+        os.rename(tmp_path, fpath)
+    except (OSError, IOError) as ex:
+        sys.stderr.write("Warning: Cannot write %s: %s\n" % (fpath, ex))
+
+
 class Status(object):
     NA      = 0
     OK      = 1
@@ -82,6 +160,15 @@ class Status(object):
             Status.FAIL:    "[  FAIL  ]"
         }[status]
 
+    @staticmethod
+    def name(status):
+        return {
+            Status.NA:      "NA",
+            Status.OK:      "OK",
+            Status.COMPAT:  "COMPAT",
+            Status.FAIL:    "FAIL"
+        }[status]
+
 
 class StunTest(object):
     # Note: IPv4 Only.
@@ -123,6 +210,8 @@ class StunTest(object):
     CHANGE_IP       = 0x0004
     ATTRIB_MAPPED_ADDRESS      = 0x0001
     ATTRIB_CHANGE_REQUEST      = 0x0003
+    ATTRIB_CHANGED_ADDRESS     = 0x0005
+    ATTRIB_OTHER_ADDRESS       = 0x802c
     ATTRIB_XOR_MAPPED_ADDRESS  = 0x0020
     NAT_UNKNOWN          = -1
     NAT_OPEN_INTERNET    = 0
@@ -132,14 +221,36 @@ class StunTest(object):
     NAT_SYMMETRIC        = 4
     NAT_SYM_UDP_FIREWALL = 5
 
-    def __init__(self, source_ip = "0.0.0.0"):
+    NAT_NAMES = {
+        NAT_UNKNOWN:            "unknown",
+        NAT_OPEN_INTERNET:      "open-internet",
+        NAT_FULL_CONE:          "full-cone",
+        NAT_RESTRICTED:         "restricted",
+        NAT_PORT_RESTRICTED:    "port-restricted",
+        NAT_SYMMETRIC:          "symmetric",
+        NAT_SYM_UDP_FIREWALL:   "symmetric-udp-firewall"
+    }
+
+    def __init__(self, source_ip = "0.0.0.0", resolve_timeout = 5):
         self.source_ip = source_ip
         self.stun_ip_tcp = []
         self.stun_ip_udp = []
-        for hostname in self.stun_server_tcp:
-            self.stun_ip_tcp.extend(self._resolve_hostname(hostname))
-        for hostname in self.stun_server_udp:
-            self.stun_ip_udp.extend(self._resolve_hostname(hostname))
+        # {"tcp": {ip: ms}, "udp": {ip: ms}}, best RTT seen for each server
+        self.rtt = {"tcp": {}, "udp": {}}
+        # {"tcp": ..., "udp": ...}, "endpoint-independent" or "endpoint-dependent"
+        self.mapping = {}
+        # {ip: ip}, the alternate IP a UDP server answers change requests from
+        self.changed_ip = {}
+        # resolve all hostnames at once, a hostname slower than the timeout is skipped
+        hostnames = self.stun_server_tcp + self.stun_server_udp
+        results = run_parallel(
+            [lambda h=h: self._resolve_hostname(h) for h in hostnames], resolve_timeout
+        )
+        for i, ip_addresses in enumerate(results):
+            if i < len(self.stun_server_tcp):
+                self.stun_ip_tcp.extend(ip_addresses or [])
+            else:
+                self.stun_ip_udp.extend(ip_addresses or [])
         if not self.stun_ip_tcp or not self.stun_ip_udp:
             raise RuntimeError("cannot resolve hostname")
 
@@ -195,6 +306,18 @@ class StunTest(object):
                     return ip, port
         return None
 
+    def _extract_changed_ip(self, payload):
+        # CHANGED-ADDRESS (rfc3489) or OTHER-ADDRESS (rfc5780)
+        while payload:
+            attrib_type, attrib_length = struct.unpack("!HH", payload[:4])
+            attrib_value = payload[4:4 + attrib_length]
+            payload = payload[4 + attrib_length:]
+            if attrib_type in (self.ATTRIB_CHANGED_ADDRESS, self.ATTRIB_OTHER_ADDRESS):
+                _, family, port = struct.unpack("!BBH", attrib_value[:4])
+                if family == self.FAMILY_IPV4:
+                    return socket.inet_ntoa(attrib_value[4:8])
+        return None
+
     def tcp_test(self, stun_host, source_port, timeout = 3):
         # rfc5389 and rfc8489 only
         tran_id = self._random_tran_id(use_magic_cookie = True)
@@ -205,10 +328,12 @@ class StunTest(object):
             sock.bind((self.source_ip, source_port))
             sock.connect((stun_host, self.STUN_PORT))
             data = self._pack_stun_message(self.BIND_REQUEST, tran_id)
+            time_sent = time.time()
             sock.sendall(data)
             buf = sock.recv(self.MTU)
             msg_type, msg_id, payload = self._unpack_stun_message(buf)
             if tran_id == msg_id and msg_type == self.BIND_RESPONSE:
+                self._record_rtt("tcp", stun_host, time.time() - time_sent)
                 source_addr  = sock.getsockname()
                 mapped_addr = self._extract_mapped_addr(payload)
                 ret = source_addr, mapped_addr
@@ -221,30 +346,45 @@ class StunTest(object):
             ret = None
         return ret
 
+    def _record_rtt(self, proto, stun_host, rtt):
+        rtt_ms = round(rtt * 1000, 1)
+        if rtt_ms < self.rtt[proto].get(stun_host, rtt_ms + 1):
+            self.rtt[proto][stun_host] = rtt_ms
+
     def udp_test(self, stun_host, source_port, change_ip = False, change_port = False, timeout = 3, repeat = 3):
+        return self.udp_tests([(stun_host, change_ip, change_port)], source_port, timeout, repeat)[0]
+
+    def udp_tests(self, requests, source_port, timeout = 3, repeat = 3):
+        # Send several (stun_host, change_ip, change_port) requests from one socket
+        # at once. Replies are told apart by transaction ID: sockets sharing a UDP
+        # port would not reliably get their own replies.
         time_start = time.time()
-        tran_id = self._random_tran_id()
+        results = [None] * len(requests)
+        pending = {}
         sock = new_socket_reuse(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(timeout)
         try:
             sock.bind((self.source_ip, source_port))
-            flags = 0
-            if change_ip:
-                flags |= self.CHANGE_IP
-            if change_port:
-                flags |= self.CHANGE_PORT
-            if flags:
-                payload = struct.pack("!HHL", self.ATTRIB_CHANGE_REQUEST, 0x4, flags)
-                data = self._pack_stun_message(self.BIND_REQUEST, tran_id, payload)
-            else:
-                data = self._pack_stun_message(self.BIND_REQUEST, tran_id)
-            # Send packets repeatedly to avoid packet loss.
-            for _ in range(repeat):
-                sock.sendto(data, (stun_host, self.STUN_PORT))
-            while True:
+            time_sent = time.time()
+            for i, (stun_host, change_ip, change_port) in enumerate(requests):
+                tran_id = self._random_tran_id()
+                pending[tran_id] = i
+                flags = 0
+                if change_ip:
+                    flags |= self.CHANGE_IP
+                if change_port:
+                    flags |= self.CHANGE_PORT
+                if flags:
+                    payload = struct.pack("!HHL", self.ATTRIB_CHANGE_REQUEST, 0x4, flags)
+                    data = self._pack_stun_message(self.BIND_REQUEST, tran_id, payload)
+                else:
+                    data = self._pack_stun_message(self.BIND_REQUEST, tran_id)
+                # Send packets repeatedly to avoid packet loss.
+                for _ in range(repeat):
+                    sock.sendto(data, (stun_host, self.STUN_PORT))
+            while pending:
                 time_left = time_start + timeout - time.time()
                 if time_left <= 0:
-                    return None
+                    break
                 sock.settimeout(time_left)
                 buf, recv_addr = sock.recvfrom(self.MTU)
                 recv_host, recv_port = recv_addr
@@ -252,31 +392,33 @@ class StunTest(object):
                 if len(buf) < 20:
                     continue
                 msg_type, msg_id, payload = self._unpack_stun_message(buf)
-                if tran_id != msg_id or msg_type != self.BIND_RESPONSE:
+                if msg_id not in pending or msg_type != self.BIND_RESPONSE:
                     continue
+                i = pending.pop(msg_id)
+                if not requests[i][1] and not requests[i][2]:
+                    self._record_rtt("udp", requests[i][0], time.time() - time_sent)
+                changed_ip = self._extract_changed_ip(payload)
+                if changed_ip:
+                    self.changed_ip[requests[i][0]] = changed_ip
                 source_addr  = sock.getsockname()
                 mapped_addr  = self._extract_mapped_addr(payload)
-                ip_changed   = (recv_host != stun_host)
+                ip_changed   = (recv_host != requests[i][0])
                 port_changed = (recv_port != self.STUN_PORT)
-                return source_addr, mapped_addr, ip_changed, port_changed
+                results[i] = source_addr, mapped_addr, ip_changed, port_changed
         except Exception:
-            return None
+            pass
         finally:
             sock.close()
+        return results
 
-    def get_tcp_mapping(self, source_port = 0):
-        server_ip = first = self.stun_ip_tcp[0]
-        while True:
-            ret = self.tcp_test(server_ip, source_port)
-            if ret is None:
-                # server unavailable, put it at the end of the list
-                self.stun_ip_tcp.append(self.stun_ip_tcp.pop(0))
-                server_ip = self.stun_ip_tcp[0]
-                if server_ip == first:
-                    raise RuntimeError("No STUN server avaliable")
-            else:
+    def get_tcp_mapping(self, source_port = 0, timeout = 3):
+        # ask all servers at once, the first answer wins
+        funcs = [lambda ip=ip: self.tcp_test(ip, source_port, timeout) for ip in self.stun_ip_tcp]
+        for ret in iter_parallel(funcs, timeout + 1):
+            if ret is not None:
                 source_addr, mapped_addr = ret
                 return source_addr, mapped_addr
+        raise RuntimeError("No STUN server avaliable")
 
     def get_udp_mapping(self, source_port = 0):
         server_ip = first = self.stun_ip_udp[0]
@@ -292,22 +434,24 @@ class StunTest(object):
                 source_addr, mapped_addr, ip_changed, port_changed = ret
                 return source_addr, mapped_addr
 
-    def _check_tcp_cone(self, source_port = 0):
+    def _check_tcp_cone(self, source_port = 0, timeout = 3):
         # Detect NAT behavior for TCP. Requires at least three STUN servers for accuracy.
         if source_port == 0:
             source_port = self._get_free_port()
         mapped_addr_first = None
         count = 0
-        for server_ip in self.stun_ip_tcp:
-            if count >= 3:
-                return 1
-            ret = self.tcp_test(server_ip, source_port)
+        funcs = [lambda ip=ip: self.tcp_test(ip, source_port, timeout) for ip in self.stun_ip_tcp]
+        for ret in iter_parallel(funcs, timeout + 1):
             if ret is not None:
                 source_addr, mapped_addr = ret
                 if mapped_addr_first is not None and mapped_addr != mapped_addr_first:
+                    self.mapping["tcp"] = "endpoint-dependent"
                     return -1
                 mapped_addr_first = ret[1]
                 count += 1
+                if count >= 3:
+                    self.mapping["tcp"] = "endpoint-independent"
+                    return 1
         return 0
 
     def _check_tcp_fullcone(self, source_port = 0):
@@ -322,19 +466,30 @@ class StunTest(object):
             srv_sock.close()
             return 0
         ka_sock = new_socket_reuse(socket.AF_INET, socket.SOCK_STREAM)
-        # Make keep-alive & get NAPT mapping
-        try:
-            ka_sock.bind((self.source_ip, source_port))
-            ka_sock.connect((self.keep_alive_server, 80))
-            ka_sock.sendall((
-                "GET /~ HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n" % self.keep_alive_server
-            ).encode())
-            source_addr, mapped_addr = self.get_tcp_mapping(source_port)
-            public_port = mapped_addr[1]
-        except (OSError, socket.error):
+        ka_sock.settimeout(8)
+        # Make keep-alive & get NAPT mapping, both at once
+        def keep_alive():
+            try:
+                ka_sock.bind((self.source_ip, source_port))
+                ka_sock.connect((self.keep_alive_server, 80))
+                ka_sock.sendall((
+                    "GET /~ HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n" % self.keep_alive_server
+                ).encode())
+                return True
+            except (OSError, socket.error):
+                return False
+        def stun():
+            try:
+                return self.get_tcp_mapping(source_port)
+            except RuntimeError:
+                return None
+        ka_ok, ret = run_parallel([keep_alive, stun], 10)
+        if not ka_ok or not ret:
             srv_sock.close()
             ka_sock.close()
             return 0
+        source_addr, mapped_addr = ret
+        public_port = mapped_addr[1]
         # Check if is open Internet
         if source_addr == mapped_addr:
             return 2
@@ -374,30 +529,39 @@ class StunTest(object):
     def check_udp_nat_type(self, source_port = 0):
         # Like classic STUN (rfc3489). Detect NAT behavior for UDP.
         # Modified from rfc3489. Requires at least two STUN servers.
-        ret_test1_1 = None
-        ret_test1_2 = None
-        ret_test2 = None
-        ret_test3 = None
+        # The servers that answer are found first, with test I sent to all of
+        # them at once from a throwaway port. The test itself runs on its own
+        # port and contacts only the two servers it uses, so the NAT's filter
+        # holds no other addresses that could let a reply through.
+        servers = self.stun_ip_udp
+        probe = self.udp_tests([(ip, False, False) for ip in servers], self._get_free_port(udp=True))
+        answered = [servers[i] for i in range(len(servers)) if probe[i] is not None]
+        if len(answered) < 2:
+            return StunTest.NAT_UNKNOWN
         if source_port == 0:
             source_port = self._get_free_port(udp=True)
 
-        for server_ip in self.stun_ip_udp:
-            ret = self.udp_test(server_ip, source_port, change_ip=False, change_port=False)
-            if ret is None:
-                # Try another STUN server
+        server_1 = answered[0]
+        ret_test1_1 = self.udp_test(server_1, source_port)
+        if ret_test1_1 is None:
+            return StunTest.NAT_UNKNOWN
+        for server_2 in answered[1:]:
+            if self.changed_ip.get(server_2) == server_1:
+                # a reply from server 2's alternate IP would pass as server 1
                 continue
-            if ret_test1_1 is None:
-                ret_test1_1 = ret
+            ret_test1_2 = self.udp_test(server_2, source_port)
+            if ret_test1_2 is None:
                 continue
-            ret_test1_2 = ret
-            ret = self.udp_test(server_ip, source_port, change_ip=True, change_port=True)
-            if ret is not None:
-                source_addr, mapped_addr, ip_changed, port_changed = ret
+            # Test II and III both go to server 2 only, sending them together
+            # adds nothing to the NAT's filter.
+            ret_test2, ret_test3 = self.udp_tests(
+                [(server_2, True, True), (server_2, False, True)], source_port
+            )
+            if ret_test2 is not None:
+                source_addr, mapped_addr, ip_changed, port_changed = ret_test2
                 if not ip_changed or not port_changed:
                     # Try another STUN server
                     continue
-            ret_test2 = ret
-            ret_test3 = self.udp_test(server_ip, source_port, change_ip=False, change_port=True)
             break
         else:
             return StunTest.NAT_UNKNOWN
@@ -405,7 +569,9 @@ class StunTest(object):
         source_addr_1_1, mapped_addr_1_1, _, _ = ret_test1_1
         source_addr_1_2, mapped_addr_1_2, _, _ = ret_test1_2
         if mapped_addr_1_1 != mapped_addr_1_2:
+            self.mapping["udp"] = "endpoint-dependent"
             return StunTest.NAT_SYMMETRIC
+        self.mapping["udp"] = "endpoint-independent"
         if source_addr_1_1 == mapped_addr_1_1:
             if ret_test2 is not None:
                 return StunTest.NAT_OPEN_INTERNET
@@ -423,14 +589,18 @@ class StunTest(object):
     def check_tcp_nat_type(self, source_port = 0):
         if source_port == 0:
             source_port = self._get_free_port()
+        # the cone check gives the mapping behavior, and the type if the port is closed
+        cone = []
+        th = start_daemon_thread(lambda: cone.append(self._check_tcp_cone()))
         ret = self._check_tcp_fullcone(source_port)
+        th.join()
         if ret == 2:
             return StunTest.NAT_OPEN_INTERNET
         elif ret == 1:
             return StunTest.NAT_FULL_CONE
         elif ret == 0:
             return StunTest.NAT_UNKNOWN
-        ret = self._check_tcp_cone()
+        ret = cone[0] if cone else 0
         if ret == 1:
             return StunTest.NAT_PORT_RESTRICTED
         elif ret == -1:
@@ -440,22 +610,56 @@ class StunTest(object):
 
 
 class Check(object):
-    def __init__(self):
+    def __init__(self, timeout = 30):
         self.stun_test = None
-
-    def do_check(self):
-        self._print_info("Checking TCP NAT...", self._check_tcp_nat)
-        self._print_info("Checking UDP NAT...", self._check_udp_nat)
-
-    def _print_info(self, text, func):
-        sys.stdout.write("%-36s " % text)
-        sys.stdout.flush()
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def do_check(self, verbose = True):
+        # Both checks run at once, results are printed in order.
+        # Returns the results as a dict, see README.md for the format.
+        checks = [
+            ("tcp", "Checking TCP NAT...", self._check_tcp_nat),
+            ("udp", "Checking UDP NAT...", self._check_udp_nat)
+        ]
+        results = [[] for _ in checks]
+        threads = [
+            start_daemon_thread(lambda func=func, out=out: out.append(self._run(func)))
+            for (_, _, func), out in zip(checks, results)
+        ]
+        deadline = time.time() + self.timeout
+        dat = {"version": __version__, "timestamp": int(time.time())}
+        for (proto, text, _), th, out in zip(checks, threads, results):
+            if verbose:
+                sys.stdout.write("%-36s " % text)
+                sys.stdout.flush()
+            th.join(max(0, deadline - time.time()))
+            status, info, nat_type = out[0] if out else (Status.NA, "Timed out", StunTest.NAT_UNKNOWN)
+            if verbose:
+                sys.stdout.write("%s ... %s\n" % (Status.rep(status), info))
+                sys.stdout.flush()
+            dat[proto] = {
+                "status":       Status.name(status),
+                "info":         info,
+                "nat_type":     nat_type,
+                "nat_name":     StunTest.NAT_NAMES[nat_type],
+                "mapping":      self.stun_test.mapping.get(proto, "unknown") if self.stun_test else "unknown",
+                "stun_rtt_ms":  dict(self.stun_test.rtt[proto]) if self.stun_test else {}
+            }
+        return dat
+
+    def _run(self, func):
         try:
-            status, info = func()
+            return func()
         except Exception as ex:
-            status, info = Status.FAIL, str(ex)
-        sys.stdout.write("%s ... %s\n" % (Status.rep(status), info))
-        sys.stdout.flush()
+            return Status.FAIL, str(ex), StunTest.NAT_UNKNOWN
+
+    def _get_stun_test(self):
+        # shared by both checks, hostnames are resolved once
+        with self._lock:
+            if self.stun_test is None:
+                self.stun_test = StunTest()
+            return self.stun_test
 
     def _get_free_port(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -469,9 +673,7 @@ class Check(object):
         return ret
 
     def _check_tcp_nat(self):
-        if self.stun_test is None:
-            self.stun_test = StunTest()
-        type = self.stun_test.check_tcp_nat_type()
+        type = self._get_stun_test().check_tcp_nat_type()
         info = "NAT Type: %s" % type
         if type in [StunTest.NAT_OPEN_INTERNET, StunTest.NAT_FULL_CONE]:
             status = Status.OK
@@ -479,12 +681,10 @@ class Check(object):
             status = Status.NA
         else:
             status = Status.FAIL
-        return status, info
+        return status, info, type
 
     def _check_udp_nat(self):
-        if self.stun_test is None:
-            self.stun_test = StunTest()
-        type = self.stun_test.check_udp_nat_type()
+        type = self._get_stun_test().check_udp_nat_type()
         info = "NAT Type: %s" % type
         if type in [StunTest.NAT_OPEN_INTERNET, StunTest.NAT_FULL_CONE]:
             status = Status.OK
@@ -492,15 +692,49 @@ class Check(object):
             status = Status.NA
         else:
             status = Status.FAIL
-        return status, info
+        return status, info, type
 
 
 def main():
+    argp = argparse.ArgumentParser(description="Check the NAT type of the current network for Natter.")
+    argp.add_argument("--timeout", type=float, default=30, help="seconds to wait for all checks")
+    argp.add_argument("--json", action="store_true", help="print the result as JSON")
+    argp.add_argument(
+        "--cache", nargs="?", const=cache_path("natter-check.json"), metavar="PATH",
+        help="save the result to PATH, default %s" % cache_path("natter-check.json")
+    )
+    argp.add_argument(
+        "--max-age", type=float, default=0, metavar="SECONDS",
+        help="use the cached result if it is newer than this, requires --cache"
+    )
+    args = argp.parse_args()
     fix_codecs()
+    if args.cache and args.max_age > 0:
+        dat = load_result(args.cache, args.max_age)
+        if dat is not None:
+            if args.json:
+                print(json.dumps(dat, indent=2))
+            else:
+                print("> NatterCheck v%s (cached result from %s)\n" % (
+                    __version__, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dat["timestamp"]))
+                ))
+                for proto in ["tcp", "udp"]:
+                    status = getattr(Status, dat[proto]["status"])
+                    sys.stdout.write("%-36s %s ... %s\n" % (
+                        "Checking %s NAT..." % proto.upper(), Status.rep(status), dat[proto].get("info", "")
+                    ))
+            return
     check_docker_network()
-    print("> NatterCheck v%s\n" % __version__)
-    check = Check()
-    check.do_check()
+    if not args.json:
+        print("> NatterCheck v%s\n" % __version__)
+    check = Check(args.timeout)
+    dat = check.do_check(verbose = not args.json)
+    if args.json:
+        print(json.dumps(dat, indent=2))
+    # nothing worth keeping if neither check got a NAT type, e.g. offline
+    if args.cache and (dat["tcp"]["nat_type"] != StunTest.NAT_UNKNOWN or
+                       dat["udp"]["nat_type"] != StunTest.NAT_UNKNOWN):
+        save_result(args.cache, dat)
 
 
 if __name__ == "__main__":
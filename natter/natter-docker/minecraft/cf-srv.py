@@ -3,9 +3,6 @@ import urllib.request
 import json
 import sys
 
-# Natter notification script arguments
-protocol, private_ip, private_port, public_ip, public_port = sys.argv[1:6]
-
 cf_srv_service = "_minecraft"
 cf_domain      = "mc.example.com"
 cf_auth_email  = "email@example.com"
@@ -13,12 +10,27 @@ cf_auth_key    = "d41d8cd98f00b204e9800998ecf8427e"
 
 
 def main():
-    cf = CloudFlareDNS(cf_auth_email, cf_auth_key)
+    # Natter notification script arguments
+    protocol, private_ip, private_port, public_ip, public_port = sys.argv[1:6]
+    on_mapping(protocol, (private_ip, int(private_port)), (public_ip, int(public_port)))
+
+
+_cf = None
+
+
+def on_mapping(protocol, inner, outer):
+    # Natter plugin entry (`-e plugin:<path to this file>`): the client and its
+    # zone ID cache stay alive between calls
+    global _cf
+    if _cf is None:
+        _cf = CloudFlareDNS(cf_auth_email, cf_auth_key)
+    cf = _cf
+    public_ip, public_port = outer
 
-    print(f"Setting {cf_domain} A record to {public_ip}...")
+    print(f"Setting {cf_domain} A record to {public_ip}...", file=sys.stderr)
     cf.set_a_record(cf_domain, public_ip)
 
-    print(f"Setting {cf_domain} SRV record to {protocol} port {public_port}...")
+    print(f"Setting {cf_domain} SRV record to {protocol} port {public_port}...", file=sys.stderr)
     cf.set_srv_record(cf_domain, public_port, service=cf_srv_service, protocol=f"_{protocol}")
 
 
@@ -30,6 +42,7 @@ class CloudFlareDNS:
             ("X-Auth-Key",      auth_key),
             ("Content-Type",    "application/json")
         ]
+        self.zone_ids = {}
 
     def set_a_record(self, name, ipaddr):
         zone_id = self._find_zone_id(name)
@@ -73,6 +86,8 @@ class CloudFlareDNS:
 
     def _find_zone_id(self, name):
         name = name.lower()
+        if name in self.zone_ids:
+            return self.zone_ids[name]
         data = self._url_req(
             f"https://api.cloudflare.com/client/v4/zones"
         )
@@ -80,6 +95,7 @@ class CloudFlareDNS:
             zone_name = zone_data["name"]
             if name == zone_name or name.endswith("." + zone_name):
                 zone_id = zone_data["id"]
+                self.zone_ids[name] = zone_id
                 return zone_id
         return None
 
@@ -3,9 +3,6 @@ import urllib.request
 import json
 import sys
 
-# Natter notification script arguments
-protocol, private_ip, private_port, public_ip, public_port = sys.argv[1:6]
-
 cf_redirect_to_https    = False
 cf_redirect_host        = "redirect.example.com"
 cf_direct_host          = "direct.example.com"
@@ -14,15 +11,30 @@ cf_auth_key             = "d41d8cd98f00b204e9800998ecf8427e"
 
 
 def main():
-    cf = CloudFlareRedir(cf_auth_email, cf_auth_key)
+    # Natter notification script arguments
+    protocol, private_ip, private_port, public_ip, public_port = sys.argv[1:6]
+    on_mapping(protocol, (private_ip, int(private_port)), (public_ip, int(public_port)))
+
+
+_cf = None
+
+
+def on_mapping(protocol, inner, outer):
+    # Natter plugin entry (`-e plugin:<path to this file>`): the client and its
+    # zone ID cache stay alive between calls
+    global _cf
+    if _cf is None:
+        _cf = CloudFlareRedir(cf_auth_email, cf_auth_key)
+    cf = _cf
+    public_ip, public_port = outer
 
-    print(f"Setting [ {cf_redirect_host} ] DNS to [ {public_ip} ] proxied by CloudFlare...")
+    print(f"Setting [ {cf_redirect_host} ] DNS to [ {public_ip} ] proxied by CloudFlare...", file=sys.stderr)
     cf.set_a_record(cf_redirect_host, public_ip, proxied=True)
 
-    print(f"Setting [ {cf_direct_host} ] DNS to [ {public_ip} ] directly...")
+    print(f"Setting [ {cf_direct_host} ] DNS to [ {public_ip} ] directly...", file=sys.stderr)
     cf.set_a_record(cf_direct_host, public_ip, proxied=False)
 
-    print(f"Setting [ {cf_redirect_host} ] redirecting to [ {cf_direct_host}:{public_port} ], https={cf_redirect_to_https}...")
+    print(f"Setting [ {cf_redirect_host} ] redirecting to [ {cf_direct_host}:{public_port} ], https={cf_redirect_to_https}...", file=sys.stderr)
     cf.set_redirect_rule(cf_redirect_host, cf_direct_host, public_port, cf_redirect_to_https)
 
 
@@ -34,6 +46,7 @@ class CloudFlareRedir:
             ("X-Auth-Key",      auth_key),
             ("Content-Type",    "application/json")
         ]
+        self.zone_ids = {}
 
     def set_a_record(self, name, ipaddr, proxied=False):
         zone_id = self._find_zone_id(name)
@@ -76,6 +89,8 @@ class CloudFlareRedir:
 
     def _find_zone_id(self, name):
         name = name.lower()
+        if name in self.zone_ids:
+            return self.zone_ids[name]
         data = self._url_req(
             f"https://api.cloudflare.com/client/v4/zones"
         )
@@ -83,6 +98,7 @@ class CloudFlareRedir:
             zone_name = zone_data["name"]
             if name == zone_name or name.endswith("." + zone_name):
                 zone_id = zone_data["id"]
+                self.zone_ids[name] = zone_id
                 return zone_id
         return None
 
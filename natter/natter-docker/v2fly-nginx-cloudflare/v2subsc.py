@@ -4,9 +4,6 @@ import json
 import sys
 import re
 
-# Natter notification script arguments
-protocol, private_ip, private_port, public_ip, public_port = sys.argv[1:6]
-
 v2ray_json_template = '{"v":"2","ps":"Home","add":"{{public_ip}}","port":"{{public_port}}","id":"{{client_id}}","type":"none","aid":"0","net":"tcp"}'
 
 clash_template = '''\
@@ -34,16 +31,25 @@ rules:
 
 
 def main():
+    # Natter notification script arguments
+    protocol, private_ip, private_port, public_ip, public_port = sys.argv[1:6]
+    on_mapping(protocol, (private_ip, int(private_port)), (public_ip, int(public_port)))
+
+
+def on_mapping(protocol, inner, outer):
+    # Natter plugin entry (`-e plugin:<path to this file>`): the v2ray config is
+    # read again on every call, so a changed client ID is picked up
+    public_ip, public_port = outer
     config_path = "/etc/v2ray/config.json"
     client_id = get_client_id(config_path)
 
     v2ray_subsc_path = f"/usr/share/nginx/html/{client_id}.txt"
     write_v2ray_subscription(v2ray_subsc_path, v2ray_json_template, public_ip, public_port, client_id)
-    print(f"V2ray subscription [{client_id}.txt] written successfully")
+    print(f"V2ray subscription [{client_id}.txt] written successfully", file=sys.stderr)
 
     clash_subsc_path = f"/usr/share/nginx/html/{client_id}.yml"
     write_clash_subscription(clash_subsc_path, clash_template, public_ip, public_port, client_id)
-    print(f"Clash subscription [{client_id}.yml] written successfully")
+    print(f"Clash subscription [{client_id}.yml] written successfully", file=sys.stderr)
 
 
 def get_client_id(config_path):
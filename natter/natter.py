@@ -23,12 +23,14 @@ import re
 import sys
 import json
 import time
+import bisect
 import errno
 import atexit
 import codecs
 import random
 import signal
 import socket
+import select
 import struct
 import argparse
 import threading
@@ -51,40 +53,139 @@ class Logger(object):
         RESET = "\033[0m"
     else:
         GREY = YELLOW_BOLD = RED_BOLD = RESET = ""
+    local = threading.local()
 
     @staticmethod
     def set_level(level):
         Logger.level = level
 
+    @staticmethod
+    def set_tag(tag):
+        # per-thread prefix, used to tell mappings apart in multi-mapping mode
+        Logger.local.tag = "[%s] " % tag if tag else ""
+
+    @staticmethod
+    def tag():
+        return getattr(Logger.local, "tag", "")
+
     @staticmethod
     def debug(text=""):
         if Logger.level <= Logger.DEBUG:
             sys.stderr.write((Logger.GREY + "%s [%s] %s\n" + Logger.RESET) % (
-                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.DEBUG], text
+                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.DEBUG], Logger.tag() + text
             ))
 
     @staticmethod
     def info(text=""):
         if Logger.level <= Logger.INFO:
             sys.stderr.write(("%s [%s] %s\n") % (
-                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.INFO], text
+                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.INFO], Logger.tag() + text
             ))
 
     @staticmethod
     def warning(text=""):
         if Logger.level <= Logger.WARN:
             sys.stderr.write((Logger.YELLOW_BOLD + "%s [%s] %s\n" + Logger.RESET) % (
-                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.WARN], text
+                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.WARN], Logger.tag() + text
             ))
 
     @staticmethod
     def error(text=""):
         if Logger.level <= Logger.ERROR:
             sys.stderr.write((Logger.RED_BOLD + "%s [%s] %s\n" + Logger.RESET) % (
-                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.ERROR], text
+                time.strftime("%Y-%m-%d %H:%M:%S"), Logger.rep[Logger.ERROR], Logger.tag() + text
             ))
 
 
+class EventStream(object):
+    # one compact JSON object per line, for programs that consume Natter's state
+    fo = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def open(target):
+        if EventStream.fo is not None:
+            return
+        if target in ("-", "stdout"):
+            # Keep the real stdout for events only. Anything else printing to
+            # stdout (notification scripts, plugins, forwarder processes)
+            # goes to stderr instead of breaking the line-by-line JSON.
+            sys.stdout.flush()
+            fd = os.dup(1)
+            os.dup2(2, 1)
+            EventStream.fo = os.fdopen(fd, "w")
+        elif target == "stderr":
+            EventStream.fo = sys.stderr
+        elif target.isdigit():
+            EventStream.fo = os.fdopen(int(target), "w")
+        else:
+            EventStream.fo = open(target, "a")
+
+    @staticmethod
+    def emit(event, **fields):
+        if EventStream.fo is None:
+            return
+        fields["event"] = event
+        fields["time"] = round(time.time(), 3)
+        line = json.dumps(fields, separators=(",", ":"), sort_keys=True)
+        with EventStream.lock:
+            try:
+                EventStream.fo.write(line + "\n")
+                EventStream.fo.flush()
+            except (OSError, ValueError) as ex:
+                # reader has gone away, keep running without events
+                EventStream.fo = None
+                Logger.error("json-events: cannot write event: %s" % ex)
+
+
+class Histogram(object):
+    # Prometheus-style histogram, bucket bounds in seconds
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def expose(self, name, labels):
+        # buckets, sum and count from the same moment
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        lines = []
+        acc = 0
+        for bound, cnt in zip(self.bounds + (float("inf"),), counts):
+            acc += cnt
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("%s_bucket%s %d" % (name, metric_labels(labels, le=le), acc))
+        lines.append("%s_sum%s %s" % (name, metric_labels(labels), repr(total)))
+        lines.append("%s_count%s %d" % (name, metric_labels(labels), count))
+        return lines
+
+
+class StartupTrace(object):
+    # --startup-trace: time spent in each startup phase
+    def __init__(self, enabled=False, start=None):
+        self.enabled = enabled
+        self.start = self.last = start or time.time()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = time.time()
+        Logger.info("startup: %-12s %8.1f ms (total %8.1f ms)" % (
+            phase, (now - self.last) * 1000, (now - self.start) * 1000
+        ))
+        self.last = now
+
+
 class NatterExit(object):
     atexit.register(lambda : NatterExit._atexit[0]())
     _atexit = [lambda : None]
@@ -214,10 +315,14 @@ class PortTest(object):
 
 class StunClient(object):
     class ServerUnavailable(Exception):
-        pass
+        def __init__(self, ex, server=None):
+            Exception.__init__(self, ex)
+            self.server = server
+
+    rotate_lock = threading.Lock()
 
     def __init__(self, stun_server_list, source_host="0.0.0.0", source_port=0,
-                 interface=None, udp=False):
+                 interface=None, udp=False, broker=None):
         if not stun_server_list:
             raise ValueError("STUN server list is empty")
         self.stun_server_list = stun_server_list
@@ -225,26 +330,58 @@ class StunClient(object):
         self.source_port = source_port
         self.interface = interface
         self.udp = udp
+        self.broker = broker
+        self.rtt = {}
+        self.last_rtt = None
 
     def get_mapping(self):
+        if self.broker:
+            ret = self._get_mapping_brokered()
+            if ret:
+                return ret
         first = self.stun_server_list[0]
         while True:
             try:
                 return self._get_mapping()
             except StunClient.ServerUnavailable as ex:
                 Logger.warning("stun: STUN server %s is unavailable: %s" % (
-                    addr_to_uri(self.stun_server_list[0], udp = self.udp), ex
+                    addr_to_uri(ex.server, udp = self.udp), ex
                 ))
-                self.stun_server_list.append(self.stun_server_list.pop(0))
+                # the list may be shared by several mappings, rotate it only once
+                with StunClient.rotate_lock:
+                    if self.stun_server_list[0] == ex.server:
+                        self.stun_server_list.append(self.stun_server_list.pop(0))
                 if self.stun_server_list[0] == first:
                     Logger.error("stun: No STUN server is available right now")
                     # force sleep for 10 seconds, then try the next loop
                     time.sleep(10)
 
-    def _get_mapping(self):
+    def _get_mapping_brokered(self):
+        # the broker picks the server and the time to send, the request
+        # itself still goes out from our own port
+        exclude = []
+        while True:
+            ans = self.broker.pick(self.stun_server_list, self.udp, exclude)
+            if not ans or not ans.get("server"):
+                # no broker, or every server is backing off: use the local list
+                return None
+            time.sleep(ans["delay"])
+            try:
+                ret = self._get_mapping(tuple(ans["server"]), ans["ip"])
+            except StunClient.ServerUnavailable as ex:
+                Logger.warning("stun: STUN server %s is unavailable: %s" % (
+                    addr_to_uri(ex.server, udp = self.udp), ex
+                ))
+                self.broker.report(ans["key"], False)
+                exclude.append(ans["key"])
+                continue
+            self.broker.report(ans["key"], True, self.last_rtt)
+            return ret
+
+    def _get_mapping(self, server=None, ipaddr=None):
         # ref: https://www.rfc-editor.org/rfc/rfc5389
         socket_type = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
-        stun_host, stun_port = self.stun_server_list[0]
+        stun_host, stun_port = server or self.stun_server_list[0]
         sock = socket.socket(socket.AF_INET, socket_type)
         socket_set_opt(
             sock,
@@ -254,7 +391,8 @@ class StunClient(object):
             timeout     = 3
         )
         try:
-            sock.connect((stun_host, stun_port))
+            ts = time.time()
+            sock.connect((ipaddr or resolve_host(stun_host), stun_port))
             inner_addr = sock.getsockname()
             self.source_host, self.source_port = inner_addr
             sock.send(struct.pack(
@@ -262,6 +400,8 @@ class StunClient(object):
                 random.getrandbits(32), random.getrandbits(32)
             ))
             buff = sock.recv(1500)
+            self.last_rtt = time.time() - ts
+            self.rtt.setdefault((stun_host, stun_port), Histogram()).observe(self.last_rtt)
             ip = port = 0
             payload = buff[20:]
             while payload:
@@ -283,14 +423,225 @@ class StunClient(object):
             ))
             return inner_addr, outer_addr
         except (OSError, ValueError, struct.error, socket.error) as ex:
-            raise StunClient.ServerUnavailable(ex)
+            raise StunClient.ServerUnavailable(ex, (stun_host, stun_port))
         finally:
             sock.close()
 
 
+class StunBroker(object):
+    # Shares STUN server health, DNS results and request pacing between the
+    # Natter processes of one host, over a Unix socket. The process holding
+    # the lock file serves it and the others are clients; when it exits, the
+    # next request from another process takes over. STUN requests are still
+    # sent by each mapping from its own port, only the choice of server and
+    # the time to send are shared.
+    instance = None
+    rate = 2            # requests per second to one server, from all processes
+    max_delay = 5       # a server booked further ahead than this is skipped
+    backoff_min = 30
+    backoff_max = 600
+
+    def __init__(self, path):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("STUN broker is not supported on this platform")
+        self.path = path
+        self.sock = None
+        self.lock_fd = None
+        self.servers = {}   # "tcp://host:port" => state, only in the serving process
+        self.dns = {}       # host => (ip, expires)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def open(path):
+        if StunBroker.instance is None:
+            StunBroker.instance = StunBroker(path)
+        return StunBroker.instance
+
+    def pick(self, servers, udp=False, exclude=()):
+        # {"server": [host, port], "key": key, "ip": ip, "delay": seconds}, or None
+        return self.request({"cmd": "pick", "servers": servers, "udp": udp, "exclude": list(exclude)})
+
+    def report(self, key, ok, rtt=None):
+        self.request({"cmd": "report", "key": key, "ok": ok, "rtt": rtt})
+
+    def resolve(self, host):
+        ans = self.request({"cmd": "resolve", "host": host})
+        return ans.get("ip") if ans else None
+
+    def request(self, req):
+        for _ in range(2):
+            if self.sock is not None:
+                return self.command(req)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(2)
+                sock.connect(self.path)
+                sock.sendall((json.dumps(req) + "\n").encode())
+                buff = b""
+                while not buff.endswith(b"\n"):
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    buff += data
+                ans = json.loads(buff.decode())
+                return ans if ans.get("ok") else None
+            except (OSError, ValueError, socket.error) as ex:
+                Logger.debug("stun-broker: %s: %s" % (self.path, ex))
+            finally:
+                sock.close()
+            if not self._serve():
+                return None
+        return None
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        os.close(self.lock_fd)
+
+    def _serve(self):
+        # take over if nobody holds the lock, otherwise the broker is starting elsewhere
+        import fcntl
+        import stat
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(self.path):
+                # with the lock held, a socket left here is stale
+                if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    raise OSError("Not a socket: %s" % self.path)
+                os.unlink(self.path)
+            sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            sock.listen(16)
+        except OSError as ex:
+            Logger.error("stun-broker: cannot listen on %s: %s" % (self.path, ex))
+            sock.close()
+            os.close(fd)
+            return False
+        self.sock = sock
+        self.lock_fd = fd
+        atexit.register(self.close)
+        start_daemon_thread(self._accept, args=(sock,))
+        Logger.debug("stun-broker: Serving on %s" % self.path)
+        return True
+
+    def _accept(self, sock):
+        # close() clears self.sock, the thread keeps its own reference
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except (OSError, socket.error) as ex:
+                if not closed_socket_ex(ex):
+                    Logger.error("stun-broker: listening thread is exiting: %s" % ex)
+                return
+            start_daemon_thread(self._handle, args=(conn,))
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(5)
+            buff = b""
+            while b"\n" not in buff and len(buff) < 65536:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                buff += data
+            try:
+                resp = self.command(json.loads(buff.decode()))
+            except (ValueError, LookupError, TypeError) as ex:
+                resp = {"ok": False, "error": str(ex)}
+            conn.sendall((json.dumps(resp) + "\n").encode())
+        except (OSError, socket.error) as ex:
+            Logger.debug("stun-broker: client error: %s" % ex)
+        finally:
+            conn.close()
+
+    def command(self, req):
+        if not isinstance(req, dict):
+            raise ValueError("Request is not a JSON object")
+        cmd = req.get("cmd")
+        if cmd == "pick":
+            return self._pick(req["servers"], req.get("udp"), req.get("exclude", []))
+        elif cmd == "report":
+            self._report(req["key"], req["ok"], req.get("rtt"))
+        elif cmd == "resolve":
+            return {"ok": True, "ip": self._resolve(req["host"])}
+        elif cmd == "status":
+            with self._lock:
+                return {"ok": True, "pid": os.getpid(), "servers": dict((k, dict(v)) for k, v in self.servers.items())}
+        else:
+            raise ValueError("Unknown command: %s" % cmd)
+        return {"ok": True}
+
+    def _pick(self, servers, udp, exclude):
+        # the server free the soonest, the caller's order breaks ties
+        now = time.time()
+        best = None
+        with self._lock:
+            for i, (host, port) in enumerate(servers):
+                key = addr_to_uri((host, port), udp=udp)
+                if key in exclude:
+                    continue
+                ent = self.servers.setdefault(key, {
+                    "next": 0, "fail_until": 0, "failures": 0, "rtt": None, "requests": 0
+                })
+                slot = max(now, ent["next"])
+                if ent["fail_until"] > now or slot - now > self.max_delay:
+                    continue
+                if best is None or slot < best[0]:
+                    best = (slot, i, key)
+            if best is None:
+                return {"ok": True, "server": None}
+            slot, i, key = best
+            self.servers[key]["next"] = slot + 1.0 / self.rate
+            self.servers[key]["requests"] += 1
+        host, port = servers[i]
+        return {"ok": True, "server": [host, port], "key": key, "ip": self._resolve(host), "delay": slot - now}
+
+    def _report(self, key, ok, rtt):
+        with self._lock:
+            ent = self.servers.get(key)
+            if ent is None:
+                return
+            if ok:
+                ent["failures"] = ent["fail_until"] = 0
+                if rtt is not None:
+                    ent["rtt"] = rtt if ent["rtt"] is None else ent["rtt"] * 0.8 + rtt * 0.2
+            else:
+                ent["failures"] += 1
+                backoff = min(self.backoff_min * 2 ** (ent["failures"] - 1), self.backoff_max)
+                ent["fail_until"] = time.time() + backoff
+                Logger.debug("stun-broker: %s backs off for %d seconds" % (key, backoff))
+
+    def _resolve(self, host):
+        if validate_ip(host, err=False):
+            return host
+        now = time.time()
+        with self._lock:
+            ent = self.dns.get(host)
+        if ent and ent[1] > now:
+            return ent[0]
+        ipaddr = try_gethostbyname(host)
+        if ipaddr:
+            with self._lock:
+                self.dns[host] = (ipaddr, now + DnsCache.ttl)
+        return ipaddr
+
+
 class KeepAlive(object):
-    def __init__(self, host, port, source_host, source_port, interface=None, udp=False):
+    def __init__(self, host, port, source_host, source_port, interface=None, udp=False, broker=None):
         self.sock = None
+        self.broker = broker
         self.host = host
         self.port = port
         self.source_host = source_host
@@ -298,6 +649,10 @@ class KeepAlive(object):
         self.interface = interface
         self.udp = udp
         self.reconn = False
+        self.rtt = Histogram()
+        self.last_rtt = None
+        self.failures = 0
+        self._sent_at = None
 
     def __del__(self):
         if self.sock:
@@ -313,7 +668,8 @@ class KeepAlive(object):
             interface   = self.interface,
             timeout     = 3
         )
-        sock.connect((self.host, self.port))
+        ipaddr = self.broker.resolve(self.host) if self.broker else None
+        sock.connect((ipaddr or resolve_host(self.host), self.port))
         if not self.udp:
             Logger.debug("keep-alive: Connected to host %s" % (
                 addr_to_uri((self.host, self.port), udp=self.udp)
@@ -324,14 +680,26 @@ class KeepAlive(object):
         self.sock = sock
 
     def keep_alive(self):
-        if self.sock is None:
-            self._connect()
-        if self.udp:
-            self._keep_alive_udp()
-        else:
-            self._keep_alive_tcp()
+        try:
+            if self.sock is None:
+                self._connect()
+            self._sent_at = time.time()
+            if self.udp:
+                self._keep_alive_udp()
+            else:
+                self._keep_alive_tcp()
+        except (OSError, socket.error):
+            self.failures += 1
+            raise
         Logger.debug("keep-alive: OK")
 
+    def _got_reply(self):
+        # round trip to the first byte of the reply, not to the read timeout
+        if self._sent_at is not None:
+            self.last_rtt = time.time() - self._sent_at
+            self.rtt.observe(self.last_rtt)
+            self._sent_at = None
+
     def reset(self):
         if self.sock is not None:
             self.sock.close()
@@ -350,10 +718,13 @@ class KeepAlive(object):
         ).encode())
         buff = b""
         try:
-            while True:
-                buff = self.sock.recv(4096)
-                if not buff:
+            # the reply to HEAD ends with its headers, do not wait for the read timeout
+            while b"\r\n\r\n" not in buff:
+                data = self.sock.recv(4096)
+                if not data:
                     raise OSError("Keep-alive server closed connection")
+                self._got_reply()
+                buff += data
         except socket.timeout as ex:
             if not buff:
                 raise ex
@@ -366,19 +737,13 @@ class KeepAlive(object):
                 "!HHHHHH", random.getrandbits(16), 0x0100, 0x0001, 0x0000, 0x0000, 0x0000
             ) + b"\x09keepalive\x06natter\x00" + struct.pack("!HH", 0x0001, 0x0001)
         )
-        buff = b""
-        try:
-            while True:
-                buff = self.sock.recv(1500)
-                if not buff:
-                    raise OSError("Keep-alive server closed connection")
-        except socket.timeout as ex:
-            if not buff:
-                raise ex
-            # fix: Keep-alive cause STUN socket timeout on Windows
-            if sys.platform == "win32":
-                self.reset()
-            return
+        buff = self.sock.recv(1500)
+        if not buff:
+            raise OSError("Keep-alive server closed connection")
+        self._got_reply()
+        # fix: Keep-alive cause STUN socket timeout on Windows
+        if sys.platform == "win32":
+            self.reset()
 
 
 class ForwardNone(object):
@@ -397,6 +762,7 @@ class ForwardTestServer(object):
         self.sock_type = None
         self.buff_size = 8192
         self.timeout = 3
+        self.ready_timeout = 5
 
     # Start a socket server for testing purpose
     # target address is ignored
@@ -412,14 +778,15 @@ class ForwardTestServer(object):
         if udp:
             th = start_daemon_thread(self._test_server_run_udp)
         else:
+            self.sock.listen(5)
             th = start_daemon_thread(self._test_server_run_http)
-        time.sleep(1)
-        if not th.is_alive():
-            raise OSError("Test server thread exited too quickly")
+        if not wait_for_listen(port, udp, self.ready_timeout, th.is_alive):
+            if not th.is_alive():
+                raise OSError("Test server thread exited too quickly")
+            raise OSError("Test server is not listening on port %d" % port)
         self.active = True
 
     def _test_server_run_http(self):
-        self.sock.listen(5)
         while self.sock.fileno() != -1:
             try:
                 conn, addr = self.sock.accept()
@@ -622,13 +989,15 @@ class ForwardSudoIptablesSnat(ForwardIptables):
 
 
 class ForwardNftables(object):
-    def __init__(self, snat=False, sudo=False):
+    def __init__(self, snat=False, sudo=False, flowtable=False):
         self.handle = -1
         self.handle_snat = -1
+        self.handles_flow = []
         self.active = False
         self.min_ver = (0, 9, 0)
         self.snat = snat
         self.sudo = sudo
+        self.flowtable = flowtable
         if sudo:
             self.nftables_cmd = ["sudo", "-n", "nft"]
         else:
@@ -703,10 +1072,96 @@ class ForwardNftables(object):
             subprocess.check_output(
                 self.nftables_cmd + ["delete rule ip nat NATTER handle %d" % self.handle]
             )
+            self.handle = -1
         if self.handle_snat > 0:
             subprocess.check_output(
                 self.nftables_cmd + ["delete rule ip nat NATTER_SNAT handle %d" % self.handle_snat]
             )
+            self.handle_snat = -1
+        if self.handles_flow:
+            while self.handles_flow:
+                handle = self.handles_flow.pop()
+                try:
+                    subprocess.check_output(
+                        self.nftables_cmd + ["delete rule ip natter FORWARD handle %d" % handle],
+                        stderr=subprocess.STDOUT
+                    )
+                except subprocess.CalledProcessError as ex:
+                    Logger.error("fwd-nftables: Failed to execute %s: %s" % (ex.cmd, ex.output))
+            self._nftables_flowtable_clean()
+
+    def _nftables_flowtable_clean(self):
+        # The last mapping using the flowtable removes the whole `ip natter` table,
+        # other mappings (possibly in other processes) still have rules in it.
+        try:
+            output = subprocess.check_output(
+                self.nftables_cmd + ["-a", "list chain ip natter FORWARD"],
+                stderr=subprocess.STDOUT
+            ).decode()
+            # the table and chain lines carry a handle too, only rules count
+            for line in output.splitlines():
+                line = line.strip()
+                if re.search(r"# handle [0-9]+$", line) and not line.startswith(("table ", "chain ")):
+                    return
+            Logger.debug("fwd-nftables: Removing Natter flowtable")
+            subprocess.check_output(
+                self.nftables_cmd + ["delete table ip natter"],
+                stderr=subprocess.STDOUT
+            )
+        except (OSError, subprocess.CalledProcessError) as ex:
+            Logger.error("fwd-nftables: Cannot remove Natter flowtable: %s" % (
+                getattr(ex, "output", None) or ex
+            ))
+
+    def _nftables_flowtable_init(self, devices):
+        # A flowtable must live in the same table as the forward chain that
+        # offloads into it, so Natter keeps both in its own `ip natter` table.
+        Logger.debug("fwd-nftables: Creating Natter flowtable on %s" % ", ".join(devices))
+        subprocess.check_output(
+            self.nftables_cmd + ["add table ip natter"]
+        )
+        subprocess.check_output(
+            self.nftables_cmd + [
+                "add flowtable ip natter NATTER_FT "
+                "{ hook ingress priority 0; devices = { %s }; }" % ", ".join(devices)
+            ],
+            stderr=subprocess.STDOUT
+        )
+        subprocess.check_output(
+            self.nftables_cmd + [
+                "add chain ip natter FORWARD "
+                "{ type filter hook forward priority 0; policy accept; }"
+            ]
+        )
+
+    def _nftables_flowtable_add(self, ip, toip, toport, udp=False):
+        devices = []
+        for addr in (ip, toip):
+            # the default route would be picked for 0.0.0.0, not the interface in use
+            if addr == "0.0.0.0":
+                raise OSError("%s does not belong to a single network interface" % addr)
+            dev = route_device(addr)
+            if dev is None:
+                raise OSError("Cannot find the network interface routing to %s" % addr)
+            if dev not in devices:
+                devices.append(dev)
+        self._nftables_flowtable_init(devices)
+        proto = "udp" if udp else "tcp"
+        # match both directions of the DNATed connection
+        for match in (
+            "ip daddr %s %s dport %d" % (toip, proto, toport),
+            "ip saddr %s %s sport %d" % (toip, proto, toport)
+        ):
+            output = subprocess.check_output(self.nftables_cmd + [
+                "--echo", "--handle",
+                "insert rule ip natter FORWARD %s ct state established counter flow add @NATTER_FT" % (
+                    match
+                )
+            ]).decode()
+            m = re.search(r"# handle ([0-9]+)$", output, re.MULTILINE)
+            if not m:
+                raise ValueError("Unknown nftables handle")
+            self.handles_flow.append(int(m.group(1)))
 
     def start_forward(self, ip, port, toip, toport, udp=False):
         if ip != toip:
@@ -738,6 +1193,16 @@ class ForwardNftables(object):
             if not m:
                 raise ValueError("Unknown nftables handle")
             self.handle_snat = int(m.group(1))
+        if self.flowtable:
+            if ip == toip:
+                Logger.warning("fwd-nftables: Flowtable is ignored, target is not a forwarded host")
+            else:
+                try:
+                    self._nftables_flowtable_add(ip, toip, toport, udp)
+                except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+                    Logger.warning("fwd-nftables: Flowtable offload is not available: %s" % (
+                        getattr(ex, "output", None) or ex
+                    ))
         self.active = True
 
     def stop_forward(self):
@@ -771,12 +1236,158 @@ class ForwardSudoNftablesSnat(ForwardNftables):
         super().__init__(snat=True, sudo=True)
 
 
+class ForwardNftablesFlowtable(ForwardNftables):
+    def __init__(self):
+        super().__init__(flowtable=True)
+
+
+class ForwardSudoNftablesFlowtable(ForwardNftables):
+    def __init__(self):
+        super().__init__(sudo=True, flowtable=True)
+
+
+class ForwardNftablesSnatFlowtable(ForwardNftables):
+    def __init__(self):
+        super().__init__(snat=True, flowtable=True)
+
+
+class ForwardSudoNftablesSnatFlowtable(ForwardNftables):
+    def __init__(self):
+        super().__init__(snat=True, sudo=True, flowtable=True)
+
+
+class ProcessSupervisor(object):
+    # Keep an external forwarder process alive: restart it with backoff when
+    # it exits, and kill/restart it when its port stops listening.
+    def __init__(self, name, cmd, port, udp=False, ready_timeout=5):
+        self.name = name
+        self.cmd = cmd
+        self.port = port
+        self.udp = udp
+        self.ready_timeout = ready_timeout
+        self.probe_interval = 10
+        self.probe_failures_max = 2
+        self.backoff_min = 1
+        self.backoff_max = 60
+        self.stable_time = 60
+        self.proc = None
+        self.restarts = 0
+        self.on_error = None
+        self.active = False
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def start(self):
+        self._spawn()
+        if not wait_for_listen(self.port, self.udp, self.ready_timeout, self.is_alive):
+            if not self.is_alive():
+                raise OSError("%s exited too quickly" % self.name)
+            self._kill()
+            raise OSError("%s is not listening on port %d" % (self.name, self.port))
+        self.active = True
+        self._stop_event.clear()
+        start_daemon_thread(self._supervise)
+
+    def stop(self):
+        self.active = False
+        self._stop_event.set()
+        self._kill()
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _spawn(self):
+        with self._lock:
+            self.proc = subprocess.Popen(self.cmd)
+
+    def _kill(self):
+        with self._lock:
+            proc = self.proc
+            if proc is None or proc.poll() is not None:
+                return
+            proc.terminate()
+            try:
+                proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    def _wait_exit(self, proc, timeout):
+        # Returns True if the process exited within timeout
+        if hasattr(os, "pidfd_open"):
+            try:
+                fd = os.pidfd_open(proc.pid)
+            except OSError:
+                fd = None
+            if fd is not None:
+                try:
+                    select.select([fd], [], [], timeout)
+                finally:
+                    os.close(fd)
+                return proc.poll() is not None
+        try:
+            proc.wait(timeout=timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+
+    def _supervise(self):
+        backoff = self.backoff_min
+        probe_failures = 0
+        started_at = time.time()
+        while not self._stop_event.is_set():
+            proc = self.proc
+            exited = self._wait_exit(proc, self.probe_interval)
+            if self._stop_event.is_set():
+                return
+            if not exited:
+                if port_listening(self.port, self.udp) is False:
+                    probe_failures += 1
+                    Logger.warning("fwd-%s: port %d is not listening (%d/%d)" % (
+                        self.name, self.port, probe_failures, self.probe_failures_max
+                    ))
+                else:
+                    probe_failures = 0
+                if probe_failures < self.probe_failures_max:
+                    continue
+                self._kill()
+            else:
+                Logger.error("fwd-%s: %s exited unexpectedly with code %s" % (
+                    self.name, self.name, proc.returncode
+                ))
+            if self.on_error:
+                self.on_error()
+            probe_failures = 0
+            if time.time() - started_at >= self.stable_time:
+                backoff = self.backoff_min
+            # retry the spawn itself, self.proc is still the process that exited
+            while True:
+                Logger.info("fwd-%s: Restarting %s in %d seconds..." % (self.name, self.name, backoff))
+                if self._stop_event.wait(backoff):
+                    return
+                backoff = min(backoff * 2, self.backoff_max)
+                try:
+                    self._spawn()
+                    break
+                except OSError as ex:
+                    Logger.error("fwd-%s: cannot restart %s: %s" % (self.name, self.name, ex))
+            if self._stop_event.is_set():
+                self._kill()
+                return
+            started_at = time.time()
+            self.restarts += 1
+            if wait_for_listen(self.port, self.udp, self.ready_timeout, self.is_alive):
+                Logger.info("fwd-%s: %s restarted (%d restarts)" % (self.name, self.name, self.restarts))
+
+
 class ForwardGost(object):
     def __init__(self):
         self.active = False
         self.min_ver = (2, 3)
-        self.proc = None
+        self.supervisor = None
         self.udp_timeout = 60
+        self.ready_timeout = 5
+        self.on_error = None
         if not self._gost_check():
             raise OSError("gost >= %s not available" % str(self.min_ver))
 
@@ -808,17 +1419,17 @@ class ForwardGost(object):
         gost_arg = "-L=%s://:%d/%s:%d" % (proto, port, toip, toport)
         if udp:
             gost_arg += "?ttl=%ds" % self.udp_timeout
-        self.proc = subprocess.Popen(["gost", gost_arg])
-        time.sleep(1)
-        if self.proc.poll() is not None:
-            raise OSError("gost exited too quickly")
+        self.supervisor = ProcessSupervisor(
+            "gost", ["gost", gost_arg], port, udp, self.ready_timeout
+        )
+        self.supervisor.on_error = self.on_error
+        self.supervisor.start()
         self.active = True
 
     def stop_forward(self):
         Logger.debug("fwd-gost: Stopping gost")
-        if self.proc and self.proc.returncode is not None:
-            return
-        self.proc.terminate()
+        if self.supervisor:
+            self.supervisor.stop()
         self.active = False
 
 
@@ -826,9 +1437,11 @@ class ForwardSocat(object):
     def __init__(self):
         self.active = False
         self.min_ver = (1, 7, 2)
-        self.proc = None
         self.udp_timeout = 60
         self.max_children = 128
+        self.ready_timeout = 5
+        self.supervisor = None
+        self.on_error = None
         if not self._socat_check():
             raise OSError("socat >= %s not available" % str(self.min_ver))
 
@@ -861,20 +1474,18 @@ class ForwardSocat(object):
             socat_cmd = ["socat", "-T%d" % self.udp_timeout]
         else:
             socat_cmd = ["socat"]
-        self.proc = subprocess.Popen(socat_cmd + [
+        self.supervisor = ProcessSupervisor("socat", socat_cmd + [
             "%s4-LISTEN:%d,reuseaddr,fork,max-children=%d" % (proto, port, self.max_children),
             "%s4:%s:%d" % (proto, toip, toport)
-        ])
-        time.sleep(1)
-        if self.proc.poll() is not None:
-            raise OSError("socat exited too quickly")
+        ], port, udp, self.ready_timeout)
+        self.supervisor.on_error = self.on_error
+        self.supervisor.start()
         self.active = True
 
     def stop_forward(self):
         Logger.debug("fwd-socat: Stopping socat")
-        if self.proc and self.proc.returncode is not None:
-            return
-        self.proc.terminate()
+        if self.supervisor:
+            self.supervisor.stop()
         self.active = False
 
 
@@ -887,6 +1498,10 @@ class ForwardSocket(object):
         self.buff_size = 8192
         self.udp_timeout = 60
         self.max_threads = 128
+        self.ready_timeout = 5
+        self.stats = {"connections": 0, "sessions": 0, "bytes": 0}
+        self._stats_lock = threading.Lock()
+        self.on_error = None
 
     def __del__(self):
         if self.active:
@@ -909,20 +1524,22 @@ class ForwardSocket(object):
         if udp:
             th = start_daemon_thread(self._socket_udp_recvfrom)
         else:
+            self.sock.listen(5)
             th = start_daemon_thread(self._socket_tcp_listen)
-        time.sleep(1)
-        if not th.is_alive():
-            raise OSError("Socket thread exited too quickly")
+        if not wait_for_listen(port, udp, self.ready_timeout, th.is_alive):
+            if not th.is_alive():
+                raise OSError("Socket thread exited too quickly")
+            raise OSError("Socket is not listening on port %d" % port)
         self.active = True
 
     def _socket_tcp_listen(self):
-        self.sock.listen(5)
         while True:
             try:
                 sock_inbound, _ = self.sock.accept()
             except (OSError, socket.error) as ex:
                 if not closed_socket_ex(ex):
                     Logger.error("fwd-socket: socket listening thread is exiting: %s" % ex)
+                    self._error()
                 return
             sock_outbound = socket.socket(socket.AF_INET, self.sock_type)
             try:
@@ -933,6 +1550,7 @@ class ForwardSocket(object):
                     raise OSError("Too many threads")
                 start_daemon_thread(self._socket_tcp_forward, args=(sock_inbound, sock_outbound))
                 start_daemon_thread(self._socket_tcp_forward, args=(sock_outbound, sock_inbound))
+                self._count("connections")
             except (OSError, socket.error) as ex:
                 Logger.error("fwd-socket: cannot forward port: %s" % ex)
                 sock_inbound.close()
@@ -945,17 +1563,33 @@ class ForwardSocket(object):
                 buff = sock_to_recv.recv(self.buff_size)
                 if buff and sock_to_send.fileno() != -1:
                     sock_to_send.sendall(buff)
+                    self._count("bytes", len(buff))
                 else:
-                    sock_to_recv.close()
-                    sock_to_send.close()
+                    self._socket_tcp_close(sock_to_recv, sock_to_send)
                     return
         except (OSError, socket.error) as ex:
-            if not closed_socket_ex(ex):
+            # one connection ending says nothing about the mapping, no recheck
+            if session_end_ex(ex):
+                Logger.debug("fwd-socket: connection ended: %s" % ex)
+            elif not closed_socket_ex(ex):
                 Logger.error("fwd-socket: socket forwarding thread is exiting: %s" % ex)
-            sock_to_recv.close()
-            sock_to_send.close()
+            self._socket_tcp_close(sock_to_recv, sock_to_send)
             return
 
+    def _count(self, key, n=1):
+        # every forwarding thread updates the same counters
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _socket_tcp_close(self, *socks):
+        # shutdown() wakes up the peer thread blocked in recv(), close() alone does not
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            sock.close()
+
     def _socket_udp_recvfrom(self):
         outbound_socks = {}
         while True:
@@ -965,6 +1599,7 @@ class ForwardSocket(object):
             except (OSError, socket.error) as ex:
                 if not closed_socket_ex(ex):
                     Logger.error("fwd-socket: socket recvfrom thread is exiting: %s" % ex)
+                    self._error()
                 return
             try:
                 if not s:
@@ -974,8 +1609,10 @@ class ForwardSocket(object):
                     if threading.active_count() >= self.max_threads:
                         raise OSError("Too many threads")
                     start_daemon_thread(self._socket_udp_send, args=(self.sock, s, addr))
+                    self._count("sessions")
                 if buff:
                     s.send(buff)
+                    self._count("bytes", len(buff))
                 else:
                     s.close()
                     del outbound_socks[addr]
@@ -991,20 +1628,268 @@ class ForwardSocket(object):
                 buff = outbound_sock.recv(self.buff_size)
                 if buff:
                     server_sock.sendto(buff, client_addr)
+                    self._count("bytes", len(buff))
                 else:
                     outbound_sock.close()
         except (OSError, socket.error) as ex:
-            if not closed_socket_ex(ex):
+            # an idle or refused session ends here, no recheck
+            if session_end_ex(ex):
+                Logger.debug("fwd-socket: UDP session ended: %s" % ex)
+            elif not closed_socket_ex(ex):
                 Logger.error("fwd-socket: socket send thread is exiting: %s" % ex)
             outbound_sock.close()
             return
 
+    def _error(self):
+        # only the listening socket failing may mean the mapping is gone, let the
+        # mapping recheck
+        if self.on_error:
+            self.on_error()
+
     def stop_forward(self):
         Logger.debug("fwd-socket: Stopping socket")
         self.sock.close()
         self.active = False
 
 
+class ForwardBenchmark(object):
+    # Measure a path to an echo server: round-trip latency and echoed
+    # throughput. run() measures a forwarder on loopback, measure() any
+    # address, e.g. a mapped address served by ForwardBenchServer.
+    def __init__(self, udp=False, duration=0.5, rounds=50, streams=1, source_ip=None):
+        self.udp = udp
+        self.duration = duration
+        self.rounds = rounds
+        self.streams = streams
+        self.source_ip = source_ip
+        self.buff_size = 65536
+        self.packet_size = 1400
+        self.timeout = 2
+        self.sock = None
+
+    def run(self, forwarder):
+        echo_port = self.start_echo(("127.0.0.1", 0))
+        fwd_port = get_free_port(self.udp)
+        try:
+            forwarder.start_forward("127.0.0.1", fwd_port, "127.0.0.1", echo_port, udp=self.udp)
+            try:
+                ret = self.measure(("127.0.0.1", fwd_port))
+            finally:
+                forwarder.stop_forward()
+        finally:
+            self.sock.close()
+        return ret["throughput"], ret["latency"]
+
+    def measure(self, addr):
+        if self.udp:
+            latency, latency_p99 = self._latency_udp(addr)
+            throughput, loss = self._throughput_udp(addr, latency)
+        else:
+            latency, latency_p99 = self._latency_tcp(addr)
+            throughput, loss = self._throughput_tcp(addr), None
+        return {
+            "latency": latency, "latency_p99": latency_p99,
+            "throughput": throughput, "loss": loss
+        }
+
+    def start_echo(self, bind_addr):
+        sock_type = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
+        self.sock = socket.socket(socket.AF_INET, sock_type)
+        socket_set_opt(self.sock, reuse=True, bind_addr=bind_addr)
+        if self.udp:
+            start_daemon_thread(self._echo_udp)
+        else:
+            self.sock.listen(16)
+            start_daemon_thread(self._echo_tcp_listen)
+        return self.sock.getsockname()[1]
+
+    def _echo_tcp_listen(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            start_daemon_thread(self._echo_tcp, args=(conn,))
+
+    def _echo_tcp(self, conn):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while True:
+                buff = conn.recv(self.buff_size)
+                if not buff:
+                    break
+                conn.sendall(buff)
+        except (OSError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def _echo_udp(self):
+        while True:
+            try:
+                buff, addr = self.sock.recvfrom(self.buff_size)
+                self.sock.sendto(buff, addr)
+            except (OSError, socket.error):
+                return
+
+    def _connect(self, addr, timeout):
+        sock_type = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
+        sock = socket.socket(socket.AF_INET, sock_type)
+        try:
+            if not self.udp:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            socket_set_opt(
+                sock,
+                bind_addr   = (self.source_ip, 0) if self.source_ip else None,
+                timeout     = timeout
+            )
+            sock.connect(addr)
+        except (OSError, socket.error):
+            sock.close()
+            raise
+        return sock
+
+    def _percentiles(self, samples):
+        samples.sort()
+        return samples[len(samples) // 2], samples[min(len(samples) - 1, len(samples) * 99 // 100)]
+
+    def _latency_tcp(self, addr):
+        sock = self._connect(addr, self.timeout)
+        try:
+            samples = []
+            for _ in range(self.rounds):
+                ts = time.time()
+                sock.sendall(b"x")
+                if not sock.recv(1):
+                    raise OSError("Connection closed by forwarder")
+                samples.append(time.time() - ts)
+            return self._percentiles(samples)
+        finally:
+            sock.close()
+
+    def _throughput_tcp(self, addr):
+        # bulk streams in parallel, each with its own sender thread
+        done = threading.Event()
+        socks = [self._connect(addr, self.timeout) for _ in range(self.streams)]
+        received = [0] * len(socks)
+        errors = []
+        def sender(sock):
+            chunk = b"\0" * self.buff_size
+            try:
+                while not done.is_set():
+                    sock.sendall(chunk)
+            except (OSError, socket.error):
+                pass
+        def receiver(i, sock):
+            # read until EOF, so the connection is closed without a reset
+            try:
+                while True:
+                    buff = sock.recv(self.buff_size)
+                    if not buff:
+                        if not done.is_set():
+                            raise OSError("Connection closed by forwarder")
+                        return
+                    received[i] += len(buff)
+            except (OSError, socket.error) as ex:
+                if not done.is_set():
+                    errors.append(ex)
+        try:
+            threads = []
+            ts = time.time()
+            for i, sock in enumerate(socks):
+                start_daemon_thread(sender, args=(sock,))
+                threads.append(start_daemon_thread(receiver, args=(i, sock)))
+            time.sleep(self.duration)
+            total = sum(received)
+            elapsed = time.time() - ts
+            done.set()
+            # let the data in flight come back first, a forwarder closing a
+            # connection with unread data would reset it
+            deadline = time.time() + self.timeout
+            drained = -1
+            while drained != sum(received) and time.time() < deadline:
+                drained = sum(received)
+                time.sleep(0.1)
+            for sock in socks:
+                try:
+                    sock.shutdown(socket.SHUT_WR)
+                except (OSError, socket.error):
+                    pass
+            for th in threads:
+                th.join(self.timeout)
+        finally:
+            done.set()
+            for sock in socks:
+                sock.close()
+        if errors:
+            raise errors[0]
+        return total / elapsed
+
+    def _latency_udp(self, addr):
+        sock = self._connect(addr, self.timeout)
+        try:
+            samples = []
+            for i in range(self.rounds):
+                ts = time.time()
+                sock.send(struct.pack("!L", i))
+                # skip late replies of earlier rounds
+                while struct.unpack("!L", sock.recv(self.buff_size)[:4])[0] != i:
+                    pass
+                samples.append(time.time() - ts)
+            return self._percentiles(samples)
+        finally:
+            sock.close()
+
+    def _throughput_udp(self, addr, latency=0):
+        # send packet trains of 64, count what comes back
+        sock = self._connect(addr, max(0.05, latency * 2))
+        packet = b"\0" * self.packet_size
+        try:
+            sent = received = 0
+            ts = time.time()
+            while time.time() - ts < self.duration:
+                for _ in range(64):
+                    sock.send(packet)
+                sent += 64
+                try:
+                    for _ in range(64):
+                        sock.recv(self.buff_size)
+                        received += 1
+                except socket.timeout:
+                    pass
+            elapsed = time.time() - ts
+            return received * self.packet_size / elapsed, 1 - float(received) / sent
+        finally:
+            sock.close()
+
+
+class ForwardBenchServer(object):
+    # Echo server on the natter port for `-m bench`, to be measured with
+    # `--bench <mapped address>` from outside. Target address is ignored.
+    def __init__(self):
+        self.bench = None
+        self.ready_timeout = 5
+
+    def start_forward(self, ip, port, toip, toport, udp=False):
+        Logger.debug("fwd-bench: Starting echo server at %s" % addr_to_uri((ip, port), udp=udp))
+        self.bench = ForwardBenchmark(udp=udp)
+        self.bench.start_echo(("", port))
+        if not wait_for_listen(port, udp, self.ready_timeout):
+            self.bench.sock.close()
+            raise OSError("Echo server is not listening on port %d" % port)
+
+    def stop_forward(self):
+        Logger.debug("fwd-bench: Stopping echo server")
+        self.bench.sock.close()
+
+
+def bench_report(ret, udp=False):
+    Logger.info("Latency     p50 %8.2f ms   p99 %8.2f ms" % (ret["latency"] * 1000, ret["latency_p99"] * 1000))
+    Logger.info("Throughput  %8.2f Mbit/s (echoed)" % (ret["throughput"] * 8 / 1e6))
+    if udp:
+        Logger.info("Packet loss %8.2f %%" % (ret["loss"] * 100))
+
+
 class UPnPService(object):
     def __init__(self, device, bind_ip = None, interface = None):
         self.device             = device
@@ -1016,6 +1901,8 @@ class UPnPService(object):
         self._sock_timeout      = 3
         self._bind_ip           = bind_ip
         self._bind_interface    = interface
+        self._conn              = None
+        self._conn_lock         = threading.Lock()
 
     def __repr__(self):
         return "<UPnPService service_type=%s, service_id=%s>" % (
@@ -1041,58 +1928,137 @@ class UPnPService(object):
             raise NotImplementedError("Unsupported service type: %s" % self.service_type)
 
         proto = "UDP" if udp else "TCP"
-        ctl_hostname, ctl_port, ctl_path = split_url(self.control_url)
         descpt = "Natter"
-        content = (
-            "<?xml version=\"1.0\" encoding=\"utf-8\"?>\r\n"
-            "<s:Envelope xmlns:s=\"http://schemas.xmlsoap.org/soap/envelope/\"\r\n"
-            "  s:encodingStyle=\"http://schemas.xmlsoap.org/soap/encoding/\">\r\n"
-            "  <s:Body>\r\n"
-            "    <m:AddPortMapping xmlns:m=\"%s\">\r\n"
-            "      <NewRemoteHost>%s</NewRemoteHost>\r\n"
-            "      <NewExternalPort>%s</NewExternalPort>\r\n"
-            "      <NewProtocol>%s</NewProtocol>\r\n"
-            "      <NewInternalPort>%s</NewInternalPort>\r\n"
-            "      <NewInternalClient>%s</NewInternalClient>\r\n"
-            "      <NewEnabled>1</NewEnabled>\r\n"
-            "      <NewPortMappingDescription>%s</NewPortMappingDescription>\r\n"
-            "      <NewLeaseDuration>%d</NewLeaseDuration>\r\n"
-            "    </m:AddPortMapping>\r\n"
-            "  </s:Body>\r\n"
-            "</s:Envelope>\r\n" % (
-                self.service_type, host, port, proto, dest_port, dest_host, descpt, duration
-            )
-        )
-        content_len = len(content.encode())
-        data = (
+        _, errno, errmsg = self._soap_call("AddPortMapping", [
+            ("NewRemoteHost",               host),
+            ("NewExternalPort",             port),
+            ("NewProtocol",                 proto),
+            ("NewInternalPort",             dest_port),
+            ("NewInternalClient",           dest_host),
+            ("NewEnabled",                  1),
+            ("NewPortMappingDescription",   descpt),
+            ("NewLeaseDuration",            duration)
+        ])
+        if errno or errmsg:
+            Logger.error("upnp: Error from service %s of device %s: [%s] %s" % (
+                self.service_type, self.device, errno, errmsg
+            ))
+            return False
+        return True
+
+    def get_external_ip(self):
+        if not self.is_forward():
+            raise NotImplementedError("Unsupported service type: %s" % self.service_type)
+        r, errno, errmsg = self._soap_call("GetExternalIPAddress")
+        if errno or errmsg:
+            raise ValueError("[%s] %s" % (errno, errmsg))
+        m = re.search(r"<NewExternalIPAddress\s*>([^<]*?)</NewExternalIPAddress\s*>", r)
+        if not m:
+            raise ValueError("Invalid response from service %s" % self.service_type)
+        return m.group(1).strip()
+
+    def get_port_mapping(self, host, port, udp=False):
+        # Returns a dict of the existing mapping, or None if there is no such entry
+        if not self.is_forward():
+            raise NotImplementedError("Unsupported service type: %s" % self.service_type)
+        proto = "UDP" if udp else "TCP"
+        r, errno, errmsg = self._soap_call("GetSpecificPortMappingEntry", [
+            ("NewRemoteHost",       host),
+            ("NewExternalPort",     port),
+            ("NewProtocol",         proto)
+        ])
+        if errno == "714":
+            # NoSuchEntryInArray
+            return None
+        if errno:
+            # Many IGDs answer 401 (Invalid Action) or 602 (Optional Action
+            # Not Implemented) here; treat any other fault as unsupported.
+            raise NotImplementedError("GetSpecificPortMappingEntry: [%s] %s" % (errno, errmsg))
+        if errmsg:
+            raise ValueError("[%s] %s" % (errno, errmsg))
+        entry = {}
+        for key in ("NewInternalPort", "NewInternalClient", "NewEnabled", "NewLeaseDuration"):
+            m = re.search(r"<%s\s*>([^<]*?)</%s\s*>" % (key, key), r)
+            if not m:
+                raise ValueError("Invalid response from service %s" % self.service_type)
+            entry[key] = m.group(1).strip()
+        return {
+            "internal_port":    int(entry["NewInternalPort"]),
+            "internal_client":  entry["NewInternalClient"],
+            "enabled":          entry["NewEnabled"] == "1",
+            "lease_duration":   int(entry["NewLeaseDuration"] or 0)
+        }
+
+    def close(self):
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _soap_call(self, action, args=()):
+        ctl_hostname, ctl_port, ctl_path = split_url(self.control_url)
+        content = (
+            "<?xml version=\"1.0\" encoding=\"utf-8\"?>\r\n"
+            "<s:Envelope xmlns:s=\"http://schemas.xmlsoap.org/soap/envelope/\"\r\n"
+            "  s:encodingStyle=\"http://schemas.xmlsoap.org/soap/encoding/\">\r\n"
+            "  <s:Body>\r\n"
+            "    <m:%s xmlns:m=\"%s\">\r\n"
+            "%s"
+            "    </m:%s>\r\n"
+            "  </s:Body>\r\n"
+            "</s:Envelope>\r\n" % (
+                action, self.service_type,
+                "".join("      <%s>%s</%s>\r\n" % (k, v, k) for k, v in args),
+                action
+            )
+        )
+        content_len = len(content.encode())
+        data = (
             "POST %s HTTP/1.1\r\n"
             "Host: %s:%d\r\n"
             "User-Agent: curl/8.0.0 (Natter)\r\n"
             "Accept: */*\r\n"
-            "SOAPAction: \"%s#AddPortMapping\"\r\n"
+            "SOAPAction: \"%s#%s\"\r\n"
             "Content-Type: text/xml\r\n"
             "Content-Length: %d\r\n"
-            "Connection: close\r\n"
+            "Connection: keep-alive\r\n"
             "\r\n"
-            "%s\r\n" % (ctl_path, ctl_hostname, ctl_port, self.service_type, content_len, content)
+            "%s" % (
+                ctl_path, ctl_hostname, ctl_port, self.service_type, action, content_len, content
+            )
         ).encode()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        socket_set_opt(
-            sock,
-            bind_addr   = (self._bind_ip, 0) if self._bind_ip else None,
-            interface   = self._bind_interface,
-            timeout     = self._sock_timeout
-        )
-        sock.connect((ctl_hostname, ctl_port))
-        sock.sendall(data)
-        response = b""
-        while True:
-            buff = sock.recv(4096)
-            if not buff:
+        with self._conn_lock:
+            # reuse the HTTP connection; if the router has closed it, reconnect once
+            for reused in (self._conn is not None, False):
+                if self._conn is None:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    socket_set_opt(
+                        sock,
+                        bind_addr   = (self._bind_ip, 0) if self._bind_ip else None,
+                        interface   = self._bind_interface,
+                        timeout     = self._sock_timeout
+                    )
+                    try:
+                        sock.connect((ctl_hostname, ctl_port))
+                    except (OSError, socket.error):
+                        sock.close()
+                        raise
+                    self._conn = sock
+                try:
+                    self._conn.sendall(data)
+                    body, keep_alive = http_read_response(self._conn)
+                except (OSError, ValueError, socket.error):
+                    self._conn.close()
+                    self._conn = None
+                    if reused:
+                        Logger.debug("upnp: Connection to %s was closed, reconnecting" % ctl_hostname)
+                        continue
+                    raise
+                if not keep_alive:
+                    self._conn.close()
+                    self._conn = None
                 break
-            response += buff
-        sock.close()
-        r = response.decode("utf-8", "ignore")
+        r = body.decode("utf-8", "ignore")
         errno = errmsg = ""
         m = re.search(r"<errorCode\s*>([^<]*?)</errorCode\s*>", r)
         if m:
@@ -1100,12 +2066,7 @@ class UPnPService(object):
         m = re.search(r"<errorDescription\s*>([^<]*?)</errorDescription\s*>", r)
         if m:
             errmsg = m.group(1).strip()
-        if errno or errmsg:
-            Logger.error("upnp: Error from service %s of device %s: [%s] %s" % (
-                self.service_type, self.device, errno, errmsg
-            ))
-            return False
-        return True
+        return r, errno, errmsg
 
 
 class UPnPDevice(object):
@@ -1117,6 +2078,7 @@ class UPnPDevice(object):
         self._sock_timeout = 3
         self._bind_ip = bind_ip
         self._bind_interface = interface
+        self._lock = threading.Lock()
 
     def __repr__(self):
         return "<UPnPDevice ipaddr=%s>" % (
@@ -1129,12 +2091,27 @@ class UPnPDevice(object):
         services_d = {}     # service_id => UPnPService()
         for url in self.xml_urls:
             sd = self._get_srv_dict(url)
-            services_d.update(sd)
-        self.services.extend(services_d.values())
-        for srv in self.services:
-            if srv.is_forward():
-                self.forward_srv = srv
-                break
+            if sd:
+                services_d.update(sd)
+        self._add_services(services_d)
+
+    def _load_service_url(self, url):
+        # Load services from one description URL, may run in parallel with others.
+        # Returns True if this device now has a forwarding service.
+        sd = self._get_srv_dict(url)
+        if sd:
+            self._add_services(sd)
+        return self.forward_srv is not None
+
+    def _add_services(self, services_d):
+        with self._lock:
+            known_ids = set(srv.service_id for srv in self.services)
+            for srv in services_d.values():
+                if srv.service_id in known_ids:
+                    continue
+                self.services.append(srv)
+                if self.forward_srv is None and srv.is_forward():
+                    self.forward_srv = srv
 
     def _http_get(self, url):
         hostname, port, path = split_url(url)
@@ -1200,9 +2177,10 @@ class UPnPDevice(object):
 
 
 class UPnPClient(object):
-    def __init__(self, bind_ip = None, interface = None):
+    def __init__(self, bind_ip = None, interface = None, use_cache = True):
         self.ssdp_addr          = ("239.255.255.250", 1900)
         self.router             = None
+        self.use_cache          = use_cache
         self._sock_timeout      = 1
         self._fwd_host          = None
         self._fwd_port          = None
@@ -1211,10 +2189,20 @@ class UPnPClient(object):
         self._fwd_udp           = False
         self._fwd_duration      = 0
         self._fwd_started       = False
+        self._renew_at          = 0
+        self._check_at          = 0
+        self._check_supported   = True
+        self.check_interval     = 300
+        self.renew_latency      = Histogram()
         self._bind_ip           = bind_ip
         self._bind_interface    = interface
 
     def discover_router(self):
+        if self.use_cache:
+            router = self._load_cached_router()
+            if router:
+                self.router = router
+                return self.router
         router_l = []
         try:
             devs = self._discover()
@@ -1230,8 +2218,50 @@ class UPnPClient(object):
             self.router = router_l[0]
         else:
             self.router = router_l[0]
+        if self.router and self.use_cache:
+            self._save_cached_router()
         return self.router
 
+    def _cache_key(self):
+        return "%s/%s" % (self._bind_ip or "", self._bind_interface or "")
+
+    def _load_cached_router(self):
+        entry = cache_load("upnp.json").get(self._cache_key())
+        if not isinstance(entry, dict):
+            return None
+        try:
+            dev = UPnPDevice(
+                entry["ipaddr"], set(entry["xml_urls"]),
+                bind_ip=self._bind_ip, interface=self._bind_interface
+            )
+            srv = UPnPService(dev, bind_ip=self._bind_ip, interface=self._bind_interface)
+            srv.service_type    = entry["service_type"]
+            srv.service_id      = entry["service_id"]
+            srv.control_url     = entry["control_url"]
+            # validate with a single cheap SOAP call
+            ext_ip = srv.get_external_ip()
+        except (OSError, socket.error, LookupError, TypeError, ValueError,
+                NotImplementedError) as ex:
+            Logger.debug("upnp: Cached router is not usable: %s" % ex)
+            return None
+        dev.services = [srv]
+        dev.forward_srv = srv
+        Logger.debug("upnp: Using cached router %s, external IP %s" % (dev.ipaddr, ext_ip))
+        return dev
+
+    def _save_cached_router(self):
+        srv = self.router.forward_srv
+        cache = cache_load("upnp.json")
+        cache[self._cache_key()] = {
+            "ipaddr":       self.router.ipaddr,
+            "xml_urls":     sorted(self.router.xml_urls),
+            "service_type": srv.service_type,
+            "service_id":   srv.service_id,
+            "control_url":  srv.control_url,
+            "time":         time.time()
+        }
+        cache_save("upnp.json", cache)
+
     def _discover(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         socket_set_opt(
@@ -1259,54 +2289,122 @@ class UPnPClient(object):
             "\r\n" % self.ssdp_addr
         ).encode()
 
-        sock.sendto(dat01, self.ssdp_addr)
-        sock.sendto(dat02, self.ssdp_addr)
+        # Description fetches start as SSDP replies arrive and run concurrently;
+        # stop as soon as any device exposes a forwarding service.
+        devs_d = {}         # ipaddr => UPnPDevice()
+        fetch_threads = []
+        router_found = threading.Event()
 
-        upnp_urls_d = {}
-        while True:
-            try:
-                buff, addr = sock.recvfrom(4096)
-                m = re.search(r"LOCATION: *(http://[^\[]\S+)\s+", buff.decode("utf-8"))
+        def fetch(dev, location):
+            if dev._load_service_url(location):
+                router_found.set()
+
+        try:
+            sock.sendto(dat01, self.ssdp_addr)
+            sock.sendto(dat02, self.ssdp_addr)
+            deadline = time.time() + self._sock_timeout
+            while not router_found.is_set():
+                time_left = deadline - time.time()
+                if time_left <= 0:
+                    break
+                sock.settimeout(min(time_left, 0.05))
+                try:
+                    buff, addr = sock.recvfrom(4096)
+                except socket.timeout:
+                    continue
+                m = re.search(r"LOCATION: *(http://[^\[]\S+)\s+", buff.decode("utf-8", "ignore"))
                 if not m:
                     continue
                 ipaddr = addr[0]
                 location = m.group(1)
+                dev = devs_d.get(ipaddr)
+                if dev is None:
+                    dev = devs_d[ipaddr] = UPnPDevice(
+                        ipaddr, set(), bind_ip=self._bind_ip, interface=self._bind_interface
+                    )
+                if location in dev.xml_urls:
+                    continue
                 Logger.debug("upnp: Got URL %s" % location)
-                if ipaddr in upnp_urls_d:
-                    upnp_urls_d[ipaddr].add(location)
-                else:
-                    upnp_urls_d[ipaddr] = set([location])
-            except socket.timeout:
-                break
+                dev.xml_urls.add(location)
+                fetch_threads.append(start_daemon_thread(fetch, args=(dev, location)))
+        finally:
+            sock.close()
 
-        devs = []
-        for ipaddr, urls in upnp_urls_d.items():
-            d = UPnPDevice(ipaddr, urls, bind_ip=self._bind_ip, interface=self._bind_interface)
-            d._load_services()
-            devs.append(d)
+        # no router yet: wait for the pending fetches, each bounded by its socket timeout
+        for th in fetch_threads:
+            if router_found.is_set():
+                break
+            while th.is_alive() and not router_found.wait(0.05):
+                pass
 
-        return devs
+        return list(devs_d.values())
 
     def forward(self, host, port, dest_host, dest_port, udp=False, duration=0):
         if not self.router:
             raise RuntimeError("No router is available")
-        self.router.forward_srv.forward_port(host, port, dest_host, dest_port, udp, duration)
         self._fwd_host      = host
         self._fwd_port      = port
         self._fwd_dest_host = dest_host
         self._fwd_dest_port = dest_port
         self._fwd_udp       = udp
         self._fwd_duration  = duration
+        self._add_mapping()
         self._fwd_started   = True
 
     def renew(self):
+        # Called every keep-alive loop; only talks to the router when the
+        # lease is half used, or when it is time to verify a mapping.
         if not self._fwd_started:
             raise RuntimeError("UPnP forward not started")
-        self.router.forward_srv.forward_port(
+        now = time.time()
+        if now >= self._renew_at:
+            self._add_mapping()
+            self.renew_latency.observe(time.time() - now)
+            Logger.debug("upnp: OK, lease renewed")
+        elif now >= self._check_at and not self._check_supported:
+            # The router cannot look mappings up, so add it again instead
+            self._add_mapping()
+            self.renew_latency.observe(time.time() - now)
+            Logger.debug("upnp: OK, mapping re-added")
+        elif now >= self._check_at:
+            try:
+                entry = self.router.forward_srv.get_port_mapping(
+                    self._fwd_host, self._fwd_port, self._fwd_udp
+                )
+            except NotImplementedError as ex:
+                Logger.warning(
+                    "upnp: Cannot verify port mapping (%s), re-adding it every %d seconds instead"
+                    % (ex, self.check_interval)
+                )
+                self._check_supported = False
+                self._add_mapping()
+                self.renew_latency.observe(time.time() - now)
+                return
+            if entry is None or not entry["enabled"] or \
+                    entry["internal_client"] != self._fwd_dest_host or \
+                    entry["internal_port"] != self._fwd_dest_port:
+                Logger.warning("upnp: Port mapping is lost or modified, adding it again")
+                self._add_mapping()
+            else:
+                self._check_at = now + self.check_interval
+            self.renew_latency.observe(time.time() - now)
+            Logger.debug("upnp: OK")
+
+    def _add_mapping(self):
+        ok = self.router.forward_srv.forward_port(
             self._fwd_host, self._fwd_port, self._fwd_dest_host,
             self._fwd_dest_port, self._fwd_udp, self._fwd_duration
         )
-        Logger.debug("upnp: OK")
+        now = time.time()
+        if not ok:
+            # retry on the next loop
+            self._renew_at = self._check_at = now
+            return
+        if self._fwd_duration > 0:
+            self._renew_at = now + self._fwd_duration / 2.0
+        else:
+            self._renew_at = float("inf")
+        self._check_at = now + self.check_interval
 
 
 class NatterExitException(Exception):
@@ -1317,6 +2415,61 @@ class NatterRetryException(Exception):
     pass
 
 
+def http_read_response(sock):
+    # Read one HTTP/1.x response, returns (body, keep_alive)
+    response = b""
+    while b"\r\n\r\n" not in response:
+        buff = sock.recv(4096)
+        if not buff:
+            raise ValueError("Invalid response from HTTP server")
+        response += buff
+    head, body = response.split(b"\r\n\r\n", 1)
+    lines = head.decode("utf-8", "ignore").split("\r\n")
+    if not lines[0].startswith("HTTP/"):
+        raise ValueError("Invalid response from HTTP server")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    keep_alive = headers.get("connection", "").lower() != "close" and \
+        not lines[0].startswith("HTTP/1.0")
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        data, body = body, b""
+        while True:
+            while b"\r\n" not in data:
+                buff = sock.recv(4096)
+                if not buff:
+                    raise ValueError("Invalid response from HTTP server")
+                data += buff
+            size_line, data = data.split(b"\r\n", 1)
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            while len(data) < size + 2:
+                buff = sock.recv(4096)
+                if not buff:
+                    raise ValueError("Invalid response from HTTP server")
+                data += buff
+            if size == 0:
+                # trailers are not expected from IGD routers
+                return body, keep_alive
+            body += data[:size]
+            data = data[size + 2:]
+    if "content-length" in headers:
+        length = int(headers["content-length"])
+        while len(body) < length:
+            buff = sock.recv(4096)
+            if not buff:
+                raise ValueError("Invalid response from HTTP server")
+            body += buff
+        return body[:length], keep_alive
+    # no framing: read until the server closes
+    while True:
+        buff = sock.recv(4096)
+        if not buff:
+            return body, False
+        body += buff
+
+
 def socket_set_opt(sock, reuse=False, bind_addr=None, interface=None, timeout=-1):
     if reuse:
         if hasattr(socket, "SO_REUSEADDR"):
@@ -1344,6 +2497,81 @@ def start_daemon_thread(target, args=()):
     return th
 
 
+def port_listening(port, udp=False):
+    # Returns True/False, or None if it cannot be determined on this platform
+    if udp:
+        fpaths, listen_state = ("/proc/net/udp", "/proc/net/udp6"), "07"
+    else:
+        fpaths, listen_state = ("/proc/net/tcp", "/proc/net/tcp6"), "0A"
+    has_procfs = False
+    for fpath in fpaths:
+        if not os.path.isfile(fpath):
+            continue
+        has_procfs = True
+        fin = open(fpath, "r")
+        lines = fin.read().splitlines()[1:]
+        fin.close()
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4 or fields[3] != listen_state:
+                continue
+            if int(fields[1].rsplit(":", 1)[1], 16) == port:
+                return True
+    if has_procfs:
+        return False
+    if udp:
+        return None
+    # fallback: connect probe
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(0.5)
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+    except (OSError, socket.error):
+        return False
+    finally:
+        sock.close()
+
+
+def wait_for_listen(port, udp=False, timeout=5, alive=None):
+    # Poll until the port is listening, `alive()` returns False, or timeout
+    deadline = time.time() + timeout
+    delay = 0.01
+    while True:
+        if alive is not None and not alive():
+            return False
+        listening = port_listening(port, udp)
+        if listening:
+            return True
+        if listening is None:
+            # cannot probe: give the forwarder a grace period, as before
+            time.sleep(min(1, max(0, deadline - time.time())))
+            return alive is None or alive()
+        if time.time() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
+def get_free_port(udp=False):
+    sock_type = socket.SOCK_DGRAM if udp else socket.SOCK_STREAM
+    sock = socket.socket(socket.AF_INET, sock_type)
+    try:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def session_end_ex(ex):
+    # the normal end of a forwarded session: idle timeout or the peer going away
+    if isinstance(ex, socket.timeout):
+        return True
+    for name in ("ECONNRESET", "EPIPE", "ECONNREFUSED", "ETIMEDOUT"):
+        if hasattr(errno, name) and getattr(ex, "errno", None) == getattr(errno, name):
+            return True
+    return False
+
+
 def closed_socket_ex(ex):
     if not hasattr(ex, "errno"):
         return False
@@ -1353,6 +2581,8 @@ def closed_socket_ex(ex):
         return True
     if hasattr(errno, "EBADF") and ex.errno == errno.EBADF:
         return True
+    if hasattr(errno, "ENOTSOCK") and ex.errno == errno.ENOTSOCK:
+        return True
     if hasattr(errno, "WSAEBADF") and ex.errno == errno.WSAEBADF:
         return True
     if hasattr(errno, "WSAEINTR") and ex.errno == errno.WSAEINTR:
@@ -1374,7 +2604,7 @@ def fix_codecs(codec_list = ["utf-8", "idna"]):
         codecs.register(search_codec)
 
 
-def check_docker_network():
+def check_docker_network(timeout=2):
     if not sys.platform.startswith("linux"):
         return
     if not os.path.exists("/.dockerenv"):
@@ -1385,9 +2615,19 @@ def check_docker_network():
     macaddr = fo.read().strip()
     fo.close()
     hostname = socket.gethostname()
-    try:
-        ipaddr = socket.gethostbyname(hostname)
-    except socket.gaierror:
+    # a container that passed once does not change its network mode
+    cache_key = "%s %s" % (macaddr, hostname)
+    if cache_load("docker-check.json").get("passed") == cache_key:
+        return
+    # resolving the hostname can hang on a broken resolver, do not wait for it
+    result = []
+    th = start_daemon_thread(lambda: result.append(try_gethostbyname(hostname)))
+    th.join(timeout)
+    if not result:
+        Logger.warning("check-docket-network: Cannot resolve hostname `%s` in %d seconds" % (hostname, timeout))
+        return
+    ipaddr = result[0]
+    if ipaddr is None:
         Logger.warning("check-docket-network: Cannot resolve hostname `%s`" % hostname)
         return
     docker_macaddr = "02:42:" + ":".join(["%02x" % int(x) for x in ipaddr.split(".")])
@@ -1402,6 +2642,75 @@ def check_docker_network():
     uname_r_sfx = uname_r.rsplit("-").pop()
     if uname_r_sfx.lower() in ["linuxkit", "wsl2"] and hostname.lower() == "docker-desktop":
         raise RuntimeError("Network from Docker Desktop is not supported.")
+    cache_save("docker-check.json", {"passed": cache_key})
+
+
+def check_nat_cache(udp_modes, max_age=86400):
+    # `natter-check.py --cache` leaves its result here, warn about a known bad NAT
+    dat = cache_load("natter-check.json")
+    if not isinstance(dat.get("timestamp"), (int, float)):
+        return
+    age = time.time() - dat["timestamp"]
+    if not 0 <= age <= max_age:
+        return
+    for udp_mode in sorted(set(udp_modes)):
+        entry = dat.get("udp" if udp_mode else "tcp")
+        if not isinstance(entry, dict) or entry.get("status") != "FAIL":
+            continue
+        Logger.warning("natter-check: %s NAT type is %s (checked %d minutes ago), the mapping may not be reachable" % (
+            "UDP" if udp_mode else "TCP", entry.get("nat_name"), age // 60
+        ))
+
+
+def try_gethostbyname(hostname):
+    # gethostbyname() returning None instead of raising, for use in threads
+    try:
+        return socket.gethostbyname(hostname)
+    except (OSError, socket.error):
+        return None
+
+
+class DnsCache(object):
+    # process-wide cache, mappings sharing STUN and keep-alive servers resolve them once
+    ttl = 300
+    lock = threading.Lock()
+    entries = {}
+
+
+def resolve_host(host):
+    if validate_ip(host, err=False):
+        return host
+    now = time.time()
+    with DnsCache.lock:
+        ent = DnsCache.entries.get(host)
+    if ent and ent[1] > now:
+        return ent[0]
+    ipaddr = socket.gethostbyname(host)
+    with DnsCache.lock:
+        DnsCache.entries[host] = (ipaddr, now + DnsCache.ttl)
+    return ipaddr
+
+
+def route_device(ipaddr):
+    # longest prefix match against the kernel's IPv4 routing table
+    fpath = "/proc/net/route"
+    if not os.path.isfile(fpath):
+        return None
+    ip, = struct.unpack("=L", socket.inet_aton(ipaddr))
+    best_dev = None
+    best_bits = -1
+    fin = open(fpath, "r")
+    lines = fin.read().splitlines()[1:]
+    fin.close()
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+        dev, dest, mask = fields[0], int(fields[1], 16), int(fields[7], 16)
+        bits = bin(mask).count("1")
+        if ip & mask == dest and bits > best_bits:
+            best_dev, best_bits = dev, bits
+    return best_dev
 
 
 def split_url(url):
@@ -1478,11 +2787,1434 @@ def validate_filepath(s, err=True):
     return False
 
 
+def cache_path(name):
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "natter", name)
+
+
+def cache_load(name):
+    try:
+        fin = open(cache_path(name), "r")
+        try:
+            dat = json.load(fin)
+        finally:
+            fin.close()
+    except (OSError, IOError, ValueError):
+        return {}
+    return dat if isinstance(dat, dict) else {}
+
+
+def cache_save(name, dat):
+    fpath = cache_path(name)
+    tmp_path = "%s.%d.tmp" % (fpath, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        fout = open(tmp_path, "w")
+        try:
+            json.dump(dat, fout)
+        finally:
+            fout.close()
+        os.rename(tmp_path, fpath)
+    except (OSError, IOError) as ex:
+        Logger.debug("cache: Cannot write %s: %s" % (fpath, ex))
+
+
+def forward_impl(method):
+    # None stands for automatic selection
+    if method == "none":
+        ForwardImpl = ForwardNone
+    elif method == "test":
+        ForwardImpl = ForwardTestServer
+    elif method == "bench":
+        ForwardImpl = ForwardBenchServer
+    elif method == "iptables":
+        ForwardImpl = ForwardIptables
+    elif method == "sudo-iptables":
+        ForwardImpl = ForwardSudoIptables
+    elif method == "iptables-snat":
+        ForwardImpl = ForwardIptablesSnat
+    elif method == "sudo-iptables-snat":
+        ForwardImpl = ForwardSudoIptablesSnat
+    elif method == "nftables":
+        ForwardImpl = ForwardNftables
+    elif method == "sudo-nftables":
+        ForwardImpl = ForwardSudoNftables
+    elif method == "nftables-snat":
+        ForwardImpl = ForwardNftablesSnat
+    elif method == "sudo-nftables-snat":
+        ForwardImpl = ForwardSudoNftablesSnat
+    elif method == "nftables-flowtable":
+        ForwardImpl = ForwardNftablesFlowtable
+    elif method == "sudo-nftables-flowtable":
+        ForwardImpl = ForwardSudoNftablesFlowtable
+    elif method == "nftables-snat-flowtable":
+        ForwardImpl = ForwardNftablesSnatFlowtable
+    elif method == "sudo-nftables-snat-flowtable":
+        ForwardImpl = ForwardSudoNftablesSnatFlowtable
+    elif method == "socat":
+        ForwardImpl = ForwardSocat
+    elif method == "gost":
+        ForwardImpl = ForwardGost
+    elif method == "socket":
+        ForwardImpl = ForwardSocket
+    elif method in ("auto", "auto-bench"):
+        ForwardImpl = None
+    else:
+        raise ValueError("Unknown method name: %s" % method)
+    return ForwardImpl
+
+
+def forward_auto_select(udp=False, remote_target=False, benchmark=False, max_age=7*86400):
+    # Returns (method, forwarder) of the best working forward method on this host
+    candidates = [
+        ("nftables",        ForwardNftables),
+        ("iptables",        ForwardIptables),
+        ("sudo-nftables",   ForwardSudoNftables),
+        ("sudo-iptables",   ForwardSudoIptables),
+        ("gost",            ForwardGost),
+        ("socat",           ForwardSocat),
+        ("socket",          ForwardSocket)
+    ]
+    kernel_methods = ("nftables", "iptables", "sudo-nftables", "sudo-iptables")
+    if remote_target:
+        fpath = "/proc/sys/net/ipv4/ip_forward"
+        ip_forward = False
+        if os.path.isfile(fpath):
+            fin = open(fpath, "r")
+            ip_forward = fin.read().strip() == "1"
+            fin.close()
+        if not ip_forward:
+            candidates = [c for c in candidates if c[0] not in kernel_methods]
+    if os.path.exists("/.dockerenv"):
+        Logger.debug("fwd-auto: Running in Docker, kernel methods need `--cap-add=NET_ADMIN`")
+
+    cache_key = "%s/%s/%s" % (socket.gethostname(), "udp" if udp else "tcp",
+                              "remote" if remote_target else "local")
+    cache = cache_load("forward-auto.json")
+    entry = cache.get(cache_key)
+    if isinstance(entry, dict) and time.time() - entry.get("time", 0) < max_age and \
+            (entry.get("benchmark") or not benchmark):
+        for name, cls in candidates:
+            if name != entry.get("method"):
+                continue
+            try:
+                forwarder = cls()
+            except (OSError, subprocess.CalledProcessError) as ex:
+                Logger.debug("fwd-auto: Cached method %s is not available: %s" % (name, ex))
+                break
+            Logger.info("Forward method `auto` selected %s (cached)" % name)
+            return name, forwarder
+
+    available = []
+    for name, cls in candidates:
+        try:
+            forwarder = cls()
+        except (OSError, subprocess.CalledProcessError) as ex:
+            Logger.debug("fwd-auto: %s is not available: %s" % (name, ex))
+            continue
+        Logger.debug("fwd-auto: %s is available" % name)
+        available.append((name, forwarder))
+        if not benchmark:
+            break
+    if not available:
+        raise OSError("No forward method is available")
+
+    selected = available[0]
+    if benchmark:
+        best_score = None
+        for name, forwarder in available:
+            try:
+                throughput, latency = ForwardBenchmark(udp=udp).run(forwarder)
+            except (OSError, ValueError, subprocess.CalledProcessError, socket.error) as ex:
+                Logger.debug("fwd-auto: %s benchmark failed: %s" % (name, ex))
+                continue
+            Logger.info("Benchmark %-14s %10.2f MB/s  %8.3f ms" % (
+                name, throughput / 1048576, latency * 1000
+            ))
+            score = (throughput, -latency)
+            if best_score is None or score > best_score:
+                best_score = score
+                selected = name, forwarder
+        if best_score is None:
+            raise OSError("No forward method passed the benchmark")
+
+    cache[cache_key] = {"method": selected[0], "benchmark": benchmark, "time": time.time()}
+    cache_save("forward-auto.json", cache)
+    Logger.info("Forward method `auto` selected %s" % selected[0])
+    return selected
+
+
+def metric_labels(labels, **extra):
+    items = list(labels.items()) + sorted(extra.items())
+    if not items:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (
+        k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    ) for k, v in items)
+
+
 def ip_normalize(ipaddr):
     return socket.inet_ntoa(socket.inet_aton(ipaddr))
 
 
-def natter_main(show_title = True):
+class NotifyRunner(object):
+    # Runs the notification script in its own thread, so a slow script never
+    # delays keep-alive. Only the latest address is kept while the script is
+    # running, and a failed or timed out call is retried with backoff unless
+    # a newer address arrives first.
+    plugins = {}
+    plugin_lock = threading.Lock()
+    runners = {}
+    runners_lock = threading.Lock()
+
+    def __init__(self, path, plugin=None, emit=None, name=None):
+        self.path = path
+        self.plugin = plugin
+        self.emit = emit or EventStream.emit
+        self.name = name
+        self.timeout = 60
+        self.retries = 3
+        self.backoff = 5
+        self.backoff_max = 300
+        self._pending = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @staticmethod
+    def get(path, plugin=None, emit=None, name=None):
+        # One runner per mapping name, kept across restarts of the mapping, so
+        # calls for an old and a new address never overlap or run out of order.
+        with NotifyRunner.runners_lock:
+            runner = NotifyRunner.runners.get((name, path))
+            if runner is None:
+                runner = NotifyRunner(path, plugin=plugin, emit=emit, name=name)
+                NotifyRunner.runners[(name, path)] = runner
+            else:
+                runner.plugin = plugin
+                runner.emit = emit or EventStream.emit
+            return runner
+
+    @staticmethod
+    def load_plugin(name):
+        # a module name on sys.path, or a path to a .py file; loaded once per
+        # process and shared by all mappings
+        import importlib
+        import importlib.util
+        with NotifyRunner.plugin_lock:
+            if name in NotifyRunner.plugins:
+                return NotifyRunner.plugins[name]
+            if name.endswith(".py") or os.sep in name:
+                validate_filepath(name)
+                mod_name = re.sub(r"\W", "_", os.path.splitext(os.path.basename(name))[0])
+                spec = importlib.util.spec_from_file_location("natter_plugin_" + mod_name, name)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+            else:
+                module = importlib.import_module(name)
+            if not callable(getattr(module, "on_mapping", None)):
+                raise ValueError("Plugin %s has no on_mapping(protocol, inner, outer)" % name)
+            Logger.debug("Loaded plugin %s from %s" % (name, getattr(module, "__file__", "?")))
+            NotifyRunner.plugins[name] = module
+            return module
+
+    def submit(self, cmd):
+        with self._cond:
+            self._pending = cmd
+            self._stopped = False
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = start_daemon_thread(self._run)
+
+    def stop(self):
+        # Drop the pending call and any retry. A call already running is not
+        # interrupted, the thread ends after it.
+        with self._cond:
+            self._pending = None
+            self._stopped = True
+            self._cond.notify()
+
+    def _next(self, timeout=None):
+        with self._cond:
+            if self._pending is None and not self._stopped:
+                self._cond.wait(timeout)
+            cmd, self._pending = self._pending, None
+            return cmd
+
+    def _run(self):
+        Logger.set_tag(self.name)
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopped:
+                    self._cond.wait()
+                if self._pending is None:
+                    self._thread = None
+                    return
+                cmd, self._pending = self._pending, None
+            failures = 0
+            while not self._call(cmd):
+                failures += 1
+                if failures > self.retries:
+                    Logger.error("Notification script failed %d times, giving up" % failures)
+                    break
+                delay = min(self.backoff * 2 ** (failures - 1), self.backoff_max)
+                Logger.info("Retry notification script after %d seconds..." % delay)
+                newer = self._next(delay)
+                if newer is not None:
+                    # coalesce: a newer address replaces the failed one
+                    cmd, failures = newer, 0
+                elif self._stopped:
+                    break
+
+    def _call(self, cmd):
+        if self.plugin:
+            return self._call_plugin(cmd)
+        Logger.info("Calling script: %s" % self.path)
+        outer = "%s:%s" % (cmd[4], cmd[5])
+        ts = time.time()
+        try:
+            proc = subprocess.Popen(cmd, shell=False)
+        except OSError as ex:
+            Logger.error("Cannot call notification script: %s" % ex)
+            self.emit("hook", state="failed", outer=outer, error=str(ex))
+            return False
+        try:
+            ret = proc.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            Logger.error("Notification script timed out after %d seconds" % self.timeout)
+            self.emit("hook", state="timeout", outer=outer)
+            return False
+        if ret != 0:
+            Logger.error("Notification script exited with code %d" % ret)
+            self.emit("hook", state="failed", outer=outer, code=ret)
+            return False
+        self.emit("hook", state="done", outer=outer, duration=round(time.time() - ts, 3))
+        return True
+
+    def _call_plugin(self, cmd):
+        # runs in this thread; a plugin cannot be killed, so it should use
+        # timeouts of its own for network calls
+        Logger.info("Calling %s" % self.path)
+        outer = "%s:%s" % (cmd[4], cmd[5])
+        ts = time.time()
+        try:
+            self.plugin.on_mapping(cmd[1], (cmd[2], int(cmd[3])), (cmd[4], int(cmd[5])))
+        except Exception as ex:
+            Logger.error("Notification plugin failed: %s: %s" % (type(ex).__name__, ex))
+            self.emit("hook", state="failed", outer=outer, error=str(ex))
+            return False
+        self.emit("hook", state="done", outer=outer, duration=round(time.time() - ts, 3))
+        return True
+
+
+class NatterMapping(object):
+    # One exposed port: STUN, keep-alive, forwarder, UPnP and notification.
+    # natter_main() drives a single mapping, NatterScheduler drives many.
+    def __init__(self, args, name=None):
+        self.name = name
+        self.udp_mode = args.u
+        self.upnp_enabled = args.U
+        self.interval = args.k
+        stun_list = args.s
+        keepalive_srv = args.h
+        self.notify_sh = args.e
+        bind_ip = args.i
+        bind_interface = None
+        bind_port = args.b
+        method = args.m
+        to_ip = args.t
+        to_port = args.p
+        self.keep_retry = args.r
+        self.exit_when_changed = args.q
+        self.max_stale = args.max_stale
+        self.broker = StunBroker.open(args.stun_broker) if args.stun_broker else None
+
+        validate_positive(self.interval)
+        validate_positive(self.max_stale)
+        # confirmed at most once a loop
+        self.max_stale = max(self.max_stale, self.interval)
+        if stun_list:
+            for stun_srv in stun_list:
+                validate_addr_str(stun_srv)
+        validate_addr_str(keepalive_srv)
+        self.plugin = None
+        if self.notify_sh and self.notify_sh.startswith("plugin:"):
+            self.plugin = NotifyRunner.load_plugin(self.notify_sh[len("plugin:"):])
+        elif self.notify_sh:
+            validate_filepath(self.notify_sh)
+        if not validate_ip(bind_ip, err=False):
+            bind_interface = bind_ip
+            bind_ip = "0.0.0.0"
+        validate_port(bind_port)
+        validate_ip(to_ip)
+        validate_port(to_port)
+
+        # Normalize IPv4 in dotted-decimal notation
+        #   e.g. 10.1 -> 10.0.0.1
+        bind_ip = ip_normalize(bind_ip)
+        to_ip = ip_normalize(to_ip)
+
+        if not stun_list:
+            stun_list = [
+                "fwa.lifesizecloud.com",
+                "global.turn.twilio.com",
+                "turn.cloudflare.com",
+                "stun.isp.net.au",
+                "stun.nextcloud.com",
+                "stun.freeswitch.org",
+                "stun.voip.blackberry.com",
+                "stunserver.stunprotocol.org",
+                "stun.sipnet.com",
+                "stun.radiojar.com",
+                "stun.sonetel.com",
+                "stun.telnyx.com"
+            ]
+            if not self.udp_mode:
+                stun_list = stun_list + [
+                    "turn.cloud-rtc.com:80"
+                ]
+            else:
+                stun_list = [
+                    "stun.miwifi.com",
+                    "stun.chat.bilibili.com",
+                    "stun.hitv.com",
+                    "stun.cdnbye.com",
+                    "stun.douyucdn.cn:18000"
+                ] + stun_list
+
+        if not keepalive_srv:
+            keepalive_srv = "www.baidu.com"
+            if self.udp_mode:
+                keepalive_srv = "119.29.29.29"
+
+        self.stun_srv_list = []
+        for item in stun_list:
+            l = item.split(":", 2) + ["3478"]
+            self.stun_srv_list.append((l[0], int(l[1])),)
+
+        if self.udp_mode:
+            l = keepalive_srv.split(":", 2) + ["53"]
+            self.keepalive_host, self.keepalive_port = l[0], int(l[1])
+        else:
+            l = keepalive_srv.split(":", 2) + ["80"]
+            self.keepalive_host, self.keepalive_port = l[0], int(l[1])
+
+        # forward method defaults
+        if not method:
+            if to_ip == "0.0.0.0" and to_port == 0 and \
+                    bind_ip == "0.0.0.0" and bind_port == 0 and bind_interface is None:
+                method = "test"
+            elif to_ip == "0.0.0.0" and to_port == 0:
+                method = "none"
+            else:
+                method = "socket"
+
+        ForwardImpl = forward_impl(method)
+
+        self.args = args
+        self.method = self.method_conf = method
+        self.ForwardImpl = ForwardImpl
+        self.bind_ip = bind_ip
+        self.bind_port = bind_port
+        self.bind_interface = bind_interface
+        self.to_ip = to_ip
+        self.to_port = to_port
+
+        self.forwarder = None
+        self.forwarding = False
+        self.port_test = PortTest()
+        self.stun = None
+        self.keep_alive = None
+        self.upnp = None
+        self.upnp_ready = False
+        self.natter_addr = None
+        self.outer_addr = None
+        self.to_addr = None
+        self.to_port_follows_outer = False
+        self.need_recheck = False
+        self.last_recheck = None
+        # last time the mapped address was confirmed, by STUN or NAT loopback
+        self.confirmed_at = None
+        self.hairpin = False
+        self.stale = False
+        self.stale_count = 0
+        # rechecks caused by events are not run more often than this
+        self.recheck_gap = 5
+        self.on_wake = None
+        self.on_event = None
+        self.started_at = None
+        self.remaps = 0
+        self.upnp_failures = 0
+        self.wakeup = threading.Event()
+        self.notifier = None
+        self.trace = StartupTrace()
+        # serializes start/step with reconfigure() from other threads
+        self.lock = threading.RLock()
+        self.need_restart = False
+        self.removed = False
+
+    def start(self):
+        with self.lock:
+            self._start()
+
+    def _start(self):
+        udp_mode = self.udp_mode
+        bind_interface = self.bind_interface
+        self.need_recheck = False
+        self.need_restart = False
+        self.stale = False
+
+        self.new_forwarder()
+        ForwardImpl = self.ForwardImpl
+        self.trace.mark("forward init")
+
+        self.stun = StunClient(
+            self.stun_srv_list, self.bind_ip, self.bind_port, udp=udp_mode, interface=bind_interface,
+            broker=self.broker
+        )
+        natter_addr, outer_addr = self.stun.get_mapping()
+        self.trace.mark("stun")
+        # set actual ip and port for keep-alive socket to bind, instead of zero
+        bind_ip, bind_port = natter_addr
+
+        self.keep_alive = KeepAlive(
+            self.keepalive_host, self.keepalive_port, bind_ip, bind_port,
+            udp=udp_mode, interface=bind_interface, broker=self.broker
+        )
+        self.keep_alive.keep_alive()
+        self.trace.mark("keep-alive")
+
+        # get the mapped address again after the keep-alive connection is established
+        outer_addr_prev = outer_addr
+        natter_addr, outer_addr = self.stun.get_mapping()
+        self.trace.mark("stun verify")
+        if outer_addr != outer_addr_prev:
+            Logger.warning("Network is unstable, or not full cone")
+
+        self.natter_addr = natter_addr
+        self.outer_addr = outer_addr
+        self.confirmed_at = time.time()
+        self.hairpin = False
+        self.resolve_target()
+        to_addr = self.to_addr
+        self.start_forward()
+        self.started_at = time.time()
+        self.trace.mark("forward")
+
+        # UPnP
+        self.upnp = None
+        self.upnp_ready = False
+        upnp_router = None
+
+        if self.upnp_enabled:
+            self.upnp = UPnPClient(bind_ip=natter_addr[0], interface=bind_interface)
+            Logger.info()
+            Logger.info("Scanning UPnP Devices...")
+            try:
+                upnp_router = self.upnp.discover_router()
+            except (OSError, socket.error, ValueError) as ex:
+                Logger.error("upnp: failed to discover router: %s" % ex)
+
+        if upnp_router:
+            Logger.info("[UPnP] Found router %s" % upnp_router.ipaddr)
+            try:
+                self.upnp.forward("", bind_port, bind_ip, bind_port, udp=udp_mode, duration=self.interval*3)
+            except (OSError, socket.error, ValueError) as ex:
+                Logger.error("upnp: failed to forward port: %s" % ex)
+                self.emit("upnp", state="failed", router=upnp_router.ipaddr, error=str(ex))
+            else:
+                self.upnp_ready = True
+                self.emit("upnp", state="forwarded", router=upnp_router.ipaddr)
+        if self.upnp_enabled:
+            self.trace.mark("upnp")
+
+        # Display route information
+        self.show_route()
+
+        # Test mode notice
+        if ForwardImpl == ForwardTestServer:
+            Logger.info("Test mode in on.")
+            Logger.info("Please check [ %s://%s ]" % ("udp" if udp_mode else "http", addr_to_str(outer_addr)))
+            Logger.info()
+        elif ForwardImpl == ForwardBenchServer:
+            Logger.info("Bench mode in on.")
+            Logger.info("Please run [ python3 natter.py --bench %s ] on a host outside this network" % (
+                addr_to_uri(outer_addr, udp=udp_mode)
+            ))
+            Logger.info()
+            start_daemon_thread(self.bench_hairpin)
+
+        self.emit("mapping_acquired", **self.addr_fields())
+
+        # Call notification script
+        self.call_notify()
+
+        # Display check results, TCP only
+        if not udp_mode:
+            port_test = self.port_test
+            ret1 = port_test.test_lan(to_addr, info=True)
+            ret2 = port_test.test_lan(natter_addr, info=True)
+            ret3 = port_test.test_lan(outer_addr, source_ip=natter_addr[0], interface=bind_interface, info=True)
+            ret4 = port_test.test_wan(outer_addr, source_ip=natter_addr[0], interface=bind_interface, info=True)
+            for role, scope, addr, ret in (
+                ("target", "lan", to_addr, ret1), ("natter", "lan", natter_addr, ret2),
+                ("outer", "lan", outer_addr, ret3), ("outer", "wan", outer_addr, ret4)
+            ):
+                self.emit(
+                    "port_test", role=role, scope=scope, addr=addr_to_str(addr),
+                    result={1: "open", -1: "closed"}.get(ret, "unknown")
+                )
+            # NAT loopback works, so a self-connect can confirm the mapping on every loop
+            self.hairpin = ret3 == 1
+            if ret1 == -1:
+                Logger.warning("!! Target port is closed !!")
+            elif ret1 == 1 and ret3 == ret4 == -1:
+                Logger.warning("!! Hole punching failed !!")
+            elif ret3 == 1 and ret4 == -1:
+                Logger.warning("!! You may be behind a firewall !!")
+            Logger.info()
+            self.trace.mark("port tests")
+            # retry
+            if self.keep_retry and ret1 == -1:
+                Logger.info("Retry after %d seconds..." % self.interval)
+                self.emit("retry", reason="Target port is closed")
+                time.sleep(self.interval)
+                self.stop()
+                raise NatterRetryException("Target port is closed")
+        # only the first start is traced
+        self.trace.enabled = False
+
+    def step(self):
+        with self.lock:
+            self._step()
+
+    def _step(self):
+        # One keep-alive loop, the caller sleeps for the rest of the interval
+        udp_mode = self.udp_mode
+        if self.need_restart:
+            self.stop()
+            raise NatterRetryException("Forwarder is not running")
+        lan_ret = 0
+        if self.hairpin:
+            lan_ret = self.port_test.test_lan(
+                self.outer_addr, source_ip=self.natter_addr[0], interface=self.bind_interface
+            )
+            if lan_ret == 1:
+                self.confirm()
+            elif lan_ret == -1:
+                Logger.debug("Mapped address is not reachable through NAT loopback")
+                self.need_recheck = True
+        if time.time() - self.confirmed_at >= self.max_stale:
+            self.need_recheck = True
+        if self.need_recheck and time.time() - (self.last_recheck or 0) < self.recheck_gap:
+            Logger.debug("Recheck is deferred to the next loop")
+        elif self.need_recheck:
+            Logger.debug("Start recheck")
+            self.need_recheck = False
+            self.last_recheck = time.time()
+            # a successful self-connect above needs no STUN request
+            if lan_ret != 1:
+                natter_addr_curr, outer_addr_curr = self.stun.get_mapping()
+                if outer_addr_curr != self.outer_addr:
+                    # exit, or retry if the local side has changed as well
+                    if self.exit_when_changed:
+                        self.stop()
+                        Logger.info("Natter is exiting because mapped address has changed")
+                        self.emit("exit", reason="Mapped address has changed")
+                        raise NatterExitException("Mapped address has changed")
+                    if natter_addr_curr != self.natter_addr:
+                        self.stop()
+                        self.emit("retry", reason="Local address has changed")
+                        raise NatterRetryException("Local address has changed")
+                    self.remap(outer_addr_curr)
+                self.confirm()
+        # end of recheck
+        age = time.time() - self.confirmed_at
+        if age >= self.max_stale and not self.stale:
+            # the recheck was deferred or did not confirm the mapping
+            self.stale = True
+            self.stale_count += 1
+            Logger.warning("Mapped address has not been confirmed for %d seconds" % age)
+            self.emit("stale", age=round(age, 3), max_stale=self.max_stale)
+        try:
+            self.keep_alive.keep_alive()
+        except (OSError, socket.error) as ex:
+            if udp_mode:
+                Logger.debug("keep-alive: UDP response not received: %s" % ex)
+            else:
+                Logger.error("keep-alive: connection broken: %s" % ex)
+            self.emit("keep_alive_failed", error=str(ex))
+            self.keep_alive.reset()
+            self.recheck_soon()
+        if self.upnp_ready:
+            try:
+                self.upnp.renew()
+            except (OSError, socket.error, ValueError) as ex:
+                Logger.error("upnp: failed to renew upnp: %s" % ex)
+                self.upnp_failures += 1
+
+    def remap(self, outer_addr):
+        # fast remap: keep the forwarder and its established connections
+        Logger.info("Mapped address has changed: %s -> %s" % (
+            addr_to_uri(self.outer_addr, udp=self.udp_mode), addr_to_uri(outer_addr, udp=self.udp_mode)
+        ))
+        outer_addr_prev = self.outer_addr
+        self.outer_addr = outer_addr
+        self.remaps += 1
+        natter_addr = self.natter_addr
+        if self.to_port_follows_outer and self.to_addr[1] != outer_addr[1]:
+            # target port follows the outer port, only the forwarder target moves
+            self.to_addr = (self.to_addr[0], outer_addr[1])
+            try:
+                self.stop()
+                self.start_forward()
+            except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+                Logger.error("Cannot update forward target: %s" % ex)
+                self.emit("forwarder", state="failed", method=self.method, error=str(ex))
+                raise NatterRetryException("Cannot update forward target")
+        if self.upnp_ready:
+            try:
+                self.upnp.forward(
+                    "", natter_addr[1], natter_addr[0], natter_addr[1],
+                    udp=self.udp_mode, duration=self.interval*3
+                )
+            except (OSError, socket.error, ValueError) as ex:
+                Logger.error("upnp: failed to forward port: %s" % ex)
+        self.show_route()
+        self.emit("mapping_changed", previous=addr_to_str(outer_addr_prev), **self.addr_fields())
+        self.call_notify()
+
+    def args_key(self):
+        # every option except the forward ones, which reconfigure() can change
+        return sorted((k, v) for k, v in vars(self.args).items() if k not in ("t", "p", "m"))
+
+    def new_forwarder(self):
+        if self.ForwardImpl is None:
+            remote_target = self.to_ip not in ("0.0.0.0", "127.0.0.1", self.bind_ip)
+            self.method, self.forwarder = forward_auto_select(
+                self.udp_mode, remote_target, benchmark=(self.method_conf == "auto-bench")
+            )
+            self.ForwardImpl = type(self.forwarder)
+        else:
+            self.method = self.method_conf
+            self.forwarder = self.ForwardImpl()
+
+    def resolve_target(self):
+        natter_addr, outer_addr = self.natter_addr, self.outer_addr
+        to_ip, to_port = self.to_ip, self.to_port
+        # set actual ip of localhost for correct forwarding
+        if socket.inet_aton(to_ip) in [socket.inet_aton("127.0.0.1"), socket.inet_aton("0.0.0.0")]:
+            to_ip = natter_addr[0]
+
+        # if not specified, the target port is set to be the same as the outer port
+        self.to_port_follows_outer = not to_port
+        if not to_port:
+            to_port = outer_addr[1]
+
+        # some exceptions: ForwardNone, ForwardTestServer and ForwardBenchServer are not
+        # real forward methods, so let target ip and port equal to natter's
+        if self.ForwardImpl in (ForwardNone, ForwardTestServer, ForwardBenchServer):
+            to_ip, to_port = natter_addr
+            self.to_port_follows_outer = False
+        self.to_addr = (to_ip, to_port)
+
+    def reconfigure(self, to_ip, to_port, method):
+        # Swap the forwarder behind the same natter port. STUN, keep-alive and
+        # UPnP are left alone, so the mapped address does not change.
+        validate_ip(to_ip)
+        validate_port(to_port)
+        to_ip = ip_normalize(to_ip)
+        ForwardImpl = forward_impl(method)
+        # called from the control or reload thread, tag its log lines too
+        tag = Logger.tag()
+        Logger.set_tag(self.name)
+        try:
+            self._reconfigure(to_ip, to_port, method, ForwardImpl)
+        finally:
+            Logger.local.tag = tag
+
+    def _reconfigure(self, to_ip, to_port, method, ForwardImpl):
+        with self.lock:
+            saved = (
+                self.method, self.method_conf, self.ForwardImpl, self.forwarder,
+                self.to_ip, self.to_port, self.to_addr, self.to_port_follows_outer
+            )
+            self.method_conf, self.ForwardImpl = method, ForwardImpl
+            self.to_ip, self.to_port = to_ip, int(to_port)
+            if not self.forwarding:
+                # not started yet, the next start() uses the new settings
+                return
+            Logger.info("Reloading forward target...")
+            self.stop()
+            try:
+                self.new_forwarder()
+                self.resolve_target()
+                self.start_forward()
+            except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+                Logger.error("Cannot switch forwarder, restoring the previous one: %s" % ex)
+                self.emit("forwarder", state="failed", method=self.method, error=str(ex))
+                (
+                    self.method, self.method_conf, self.ForwardImpl, self.forwarder,
+                    self.to_ip, self.to_port, self.to_addr, self.to_port_follows_outer
+                ) = saved
+                try:
+                    self.start_forward()
+                except (OSError, ValueError, subprocess.CalledProcessError) as ex2:
+                    Logger.error("Cannot restore the previous forwarder: %s" % ex2)
+                    self.need_restart = True
+                    self.wakeup.set()
+                else:
+                    # stop() dropped any pending or retried notification
+                    self.call_notify()
+                raise ValueError("Reload failed: %s" % ex)
+            self.show_route()
+            self.emit("reloaded", **self.addr_fields())
+            self.call_notify()
+
+    def start_forward(self):
+        natter_addr, to_addr = self.natter_addr, self.to_addr
+        self.forwarder.on_error = self.recheck_soon
+        self.forwarder.start_forward(natter_addr[0], natter_addr[1], to_addr[0], to_addr[1], udp=self.udp_mode)
+        self.forwarding = True
+        self.emit(
+            "forwarder", state="started", method=self.method,
+            listen=addr_to_str(natter_addr), target=addr_to_str(to_addr)
+        )
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+        if self.forwarding:
+            self.forwarding = False
+            self.forwarder.stop_forward()
+            self.emit("forwarder", state="stopped", method=self.method)
+
+    def emit(self, event, **fields):
+        if self.name:
+            fields["mapping"] = self.name
+        EventStream.emit(event, **fields)
+        if self.on_event:
+            try:
+                self.on_event(event, dict(fields, event=event, time=round(time.time(), 3)))
+            except Exception as ex:
+                Logger.error("Event callback failed: %s: %s" % (type(ex).__name__, ex))
+
+    def addr_fields(self):
+        return {
+            "protocol": "udp" if self.udp_mode else "tcp",
+            "method": self.method,
+            "inner": addr_to_str(self.to_addr),
+            "natter": addr_to_str(self.natter_addr),
+            "outer": addr_to_str(self.outer_addr)
+        }
+
+    def show_route(self):
+        udp_mode = self.udp_mode
+        Logger.info()
+        route_str = ""
+        if self.ForwardImpl not in (ForwardNone, ForwardTestServer, ForwardBenchServer):
+            route_str += "%s <--%s--> " % (addr_to_uri(self.to_addr, udp=udp_mode), self.method)
+        route_str += "%s <--Natter--> %s" % (
+            addr_to_uri(self.natter_addr, udp=udp_mode), addr_to_uri(self.outer_addr, udp=udp_mode)
+        )
+        Logger.info(route_str)
+        Logger.info()
+
+    def bench_hairpin(self):
+        # rough local figure: reaches the mapped address through the router's NAT loopback
+        Logger.set_tag(self.name)
+        time.sleep(1)
+        try:
+            ret = ForwardBenchmark(
+                udp=self.udp_mode, duration=3, streams=4, source_ip=self.natter_addr[0]
+            ).measure(self.outer_addr)
+        except (OSError, socket.error, struct.error) as ex:
+            Logger.info("Bench through NAT loopback is not available: %s" % ex)
+            return
+        Logger.info("Bench through NAT loopback to %s:" % addr_to_uri(self.outer_addr, udp=self.udp_mode))
+        bench_report(ret, udp=self.udp_mode)
+
+    def request_recheck(self):
+        self.need_recheck = True
+        self.wakeup.set()
+        if self.on_wake:
+            self.on_wake(self)
+
+    def recheck_soon(self):
+        # on keep-alive and forwarder errors: recheck right away, unless a
+        # recheck has just been done, then in the next loop
+        if time.time() - (self.last_recheck or 0) >= self.recheck_gap:
+            self.request_recheck()
+        else:
+            self.need_recheck = True
+
+    def confirm(self):
+        if self.stale:
+            Logger.info("Mapped address is confirmed again")
+        self.confirmed_at = time.time()
+        self.stale = False
+
+    def status(self):
+        ret = {
+            "name": self.name,
+            "protocol": "udp" if self.udp_mode else "tcp",
+            "method": self.method,
+            "state": "running" if self.forwarding else "stopped",
+            "last_recheck": self.last_recheck,
+            "confirmed_at": self.confirmed_at,
+            "keepalive_rtt": self.keep_alive.last_rtt if self.keep_alive else None,
+            "forwarder": dict(getattr(self.forwarder, "stats", {}), active=self.forwarding)
+        }
+        if self.outer_addr:
+            ret.update(self.addr_fields())
+        return ret
+
+    def metrics(self):
+        # (name, type, help, labels, value), histograms are passed as values
+        labels = {"mapping": self.name or "default"}
+        now = time.time()
+        ret = [
+            ("natter_mapping_up", "gauge", "Whether the mapping is forwarding",
+             dict(labels, protocol="udp" if self.udp_mode else "tcp", method=self.method or ""),
+             1 if self.forwarding else 0),
+            ("natter_mapping_uptime_seconds", "gauge", "Seconds since the mapping was established",
+             labels, now - self.started_at if self.forwarding and self.started_at else 0),
+            ("natter_mapping_remaps_total", "counter", "Mapped address changes handled in place",
+             labels, self.remaps),
+            ("natter_mapping_confirmed_age_seconds", "gauge", "Seconds since the mapped address was confirmed",
+             labels, now - self.confirmed_at if self.forwarding and self.confirmed_at else 0),
+            ("natter_mapping_stale_total", "counter", "Times the mapped address went unconfirmed past --max-stale",
+             labels, self.stale_count)
+        ]
+        if self.stun:
+            for server, hist in list(self.stun.rtt.items()):
+                ret.append((
+                    "natter_stun_rtt_seconds", "histogram", "STUN request round-trip time",
+                    dict(labels, server=addr_to_str(server)), hist
+                ))
+        if self.keep_alive:
+            ret.append((
+                "natter_keepalive_rtt_seconds", "histogram", "Keep-alive round-trip time",
+                labels, self.keep_alive.rtt
+            ))
+            ret.append((
+                "natter_keepalive_failures_total", "counter", "Failed keep-alive requests",
+                labels, self.keep_alive.failures
+            ))
+        stats = getattr(self.forwarder, "stats", {})
+        for key in ("connections", "sessions", "bytes"):
+            if key in stats:
+                ret.append((
+                    "natter_forwarder_%s_total" % key, "counter", "Forwarder %s" % key,
+                    dict(labels, method=self.method), stats[key]
+                ))
+        if self.upnp_ready:
+            ret.append((
+                "natter_upnp_renew_seconds", "histogram", "UPnP lease renewal and check latency",
+                labels, self.upnp.renew_latency
+            ))
+            ret.append((
+                "natter_upnp_renew_failures_total", "counter", "Failed UPnP lease renewals",
+                labels, self.upnp_failures
+            ))
+        return ret
+
+    def call_notify(self):
+        if not self.notify_sh:
+            return
+        protocol = "udp" if self.udp_mode else "tcp"
+        inner_ip, inner_port = self.to_addr if self.method else self.natter_addr
+        outer_ip, outer_port = self.outer_addr
+        if self.notifier is None:
+            self.notifier = NotifyRunner.get(self.notify_sh, plugin=self.plugin, emit=self.emit, name=self.name)
+        self.notifier.submit([
+            os.path.abspath(self.notify_sh), protocol, str(inner_ip), str(inner_port),
+            str(outer_ip), str(outer_port)
+        ])
+
+
+class NatterScheduler(object):
+    # Runs many mappings in one process. A timer heap decides which mapping is
+    # due and a small pool of worker threads runs its (blocking) start or step.
+    def __init__(self, mappings, max_workers=16):
+        # imported here, single-mapping mode never needs them
+        import queue
+        self.mappings = mappings
+        self.max_workers = max_workers
+        self.retry_delay = 10
+        self._heap = []         # (due_time, seq, mapping, job)
+        self._seq = 0
+        self._alive = set(mappings)
+        self._workers = 0
+        self._threads = []
+        self._cond = threading.Condition()
+        self._jobs = queue.Queue()
+        # mappings with the same STUN servers share one list, so a server
+        # found unavailable by one mapping is skipped by the others
+        self._stun_lists = {}
+        for mapping in mappings:
+            self._share_stun_list(mapping)
+            mapping.on_wake = self.wake
+
+    def run(self):
+        import heapq
+        for mapping in self.mappings:
+            self._schedule(mapping, "start", 0)
+        self._add_workers()
+        while True:
+            with self._cond:
+                while True:
+                    if not self._alive:
+                        return
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                _, _, mapping, job = heapq.heappop(self._heap)
+            self._jobs.put((mapping, job))
+
+    def wake(self, mapping):
+        # run a pending step now, e.g. after a recheck request
+        import heapq
+        with self._cond:
+            for i, (_, seq, m, job) in enumerate(self._heap):
+                if m is mapping and job == "step":
+                    self._heap[i] = (time.time(), seq, m, job)
+                    heapq.heapify(self._heap)
+                    self._cond.notify()
+                    return
+
+    def reload(self, mappings):
+        # Mappings are matched by name. A mapping whose forward options (-t, -p,
+        # -m) changed keeps running and only swaps its forwarder; any other
+        # change restarts it. New mappings are started, missing ones stopped.
+        current = dict((m.name, m) for m in self.mappings)
+        for new in mappings:
+            old = current.pop(new.name, None)
+            if old is None:
+                Logger.info("Reload: adding mapping %s" % new.name)
+                self._add(new)
+            elif old.args_key() != new.args_key():
+                Logger.info("Reload: restarting mapping %s" % new.name)
+                self._remove(old)
+                self._add(new)
+            elif (old.to_ip, old.to_port, old.method_conf) != (new.to_ip, new.to_port, new.method_conf):
+                Logger.info("Reload: switching forwarder of mapping %s" % new.name)
+                old.args = new.args
+                try:
+                    old.reconfigure(new.to_ip, new.to_port, new.method_conf)
+                except ValueError as ex:
+                    Logger.error("Reload: mapping %s: %s" % (new.name, ex))
+        for old in current.values():
+            Logger.info("Reload: removing mapping %s" % old.name)
+            self._remove(old)
+
+    def stop(self):
+        for mapping in list(self.mappings):
+            try:
+                mapping.stop()
+            except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+                Logger.error("Cannot stop mapping %s: %s" % (mapping.name, ex))
+
+    def shutdown(self, timeout=None):
+        # stop every mapping from another thread, then let run() and the workers return
+        with self._cond:
+            mappings = list(self.mappings)
+        for mapping in mappings:
+            self._remove(mapping)
+        with self._cond:
+            self._cond.notify()
+            threads = list(self._threads)
+        for _ in threads:
+            self._jobs.put((None, "quit"))
+        for th in threads:
+            th.join(timeout)
+
+    def _share_stun_list(self, mapping):
+        key = (mapping.udp_mode, tuple(mapping.stun_srv_list))
+        mapping.stun_srv_list = self._stun_lists.setdefault(key, mapping.stun_srv_list)
+
+    def _add(self, mapping):
+        self._share_stun_list(mapping)
+        mapping.on_wake = self.wake
+        with self._cond:
+            self.mappings.append(mapping)
+            self._alive.add(mapping)
+        self._schedule(mapping, "start", 0)
+        self._add_workers()
+
+    def _remove(self, mapping):
+        # a pending job of a removed mapping is dropped by the worker, the stop
+        # job waits for a step that may be running right now
+        with self._cond:
+            mapping.removed = True
+            self.mappings.remove(mapping)
+            self._alive.discard(mapping)
+        self._jobs.put((mapping, "stop"))
+
+    def _add_workers(self):
+        with self._cond:
+            count = min(self.max_workers, len(self.mappings)) - self._workers
+            self._workers += max(count, 0)
+        for _ in range(count):
+            self._threads.append(start_daemon_thread(self._worker))
+
+    def _schedule(self, mapping, job, delay):
+        import heapq
+        with self._cond:
+            if mapping.removed:
+                return
+            self._seq += 1
+            heapq.heappush(self._heap, (time.time() + delay, self._seq, mapping, job))
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            mapping, job = self._jobs.get()
+            if job == "quit":
+                return
+            Logger.set_tag(mapping.name)
+            ts = time.time()
+            try:
+                if job == "stop":
+                    with mapping.lock:
+                        mapping.stop()
+                elif mapping.removed:
+                    pass
+                elif job == "start":
+                    mapping.start()
+                    self._schedule(mapping, "step", 0)
+                else:
+                    mapping.step()
+                    self._schedule(mapping, "step", mapping.interval - (time.time() - ts))
+            except NatterRetryException:
+                self._schedule(mapping, "start", 0)
+            except NatterExitException:
+                with self._cond:
+                    self._alive.discard(mapping)
+                    self._cond.notify()
+            except (OSError, ValueError, RuntimeError, socket.error, subprocess.CalledProcessError) as ex:
+                Logger.error("Mapping failed: %s, retry after %d seconds" % (ex, self.retry_delay))
+                mapping.emit("error", error=str(ex), retry=self.retry_delay)
+                try:
+                    mapping.stop()
+                except (OSError, ValueError, subprocess.CalledProcessError):
+                    pass
+                self._schedule(mapping, "start", self.retry_delay)
+            except Exception as ex:
+                # a bug, a malformed reply or a failing plugin must not end this
+                # worker and leave the mapping unscheduled
+                import traceback
+                Logger.error("Mapping failed unexpectedly, retry after %d seconds\n%s" % (
+                    self.retry_delay, traceback.format_exc().rstrip()
+                ))
+                mapping.emit("error", error="%s: %s" % (type(ex).__name__, ex), retry=self.retry_delay)
+                try:
+                    mapping.stop()
+                except Exception as ex2:
+                    Logger.error("Cannot stop mapping: %s: %s" % (type(ex2).__name__, ex2))
+                self._schedule(mapping, "start", self.retry_delay)
+            finally:
+                Logger.set_tag(None)
+
+
+class ControlServer(object):
+    # Unix socket taking one command per connection, as a text line
+    # ("status", "recheck [name]") or JSON ({"cmd": "status", "mapping": "name"}),
+    # and answering with one JSON line.
+    instance = None
+
+    def __init__(self, path):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Control socket is not supported on this platform")
+        self.path = path
+        self.mappings = []
+        self.reload = None
+        self.start_time = time.time()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            # remove a socket left by a previous run, but never a regular file
+            if not self._stale(path):
+                raise ValueError("Control socket is in use or not a socket: %s" % path)
+            os.unlink(path)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.listen(5)
+        atexit.register(self.close)
+        start_daemon_thread(self._serve)
+        Logger.debug("control: Listening on %s" % path)
+
+    @staticmethod
+    def open(path):
+        if ControlServer.instance is None:
+            ControlServer.instance = ControlServer(path)
+        return ControlServer.instance
+
+    def attach(self, mappings, reload=None):
+        self.mappings = mappings
+        self.reload = reload
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _stale(self, path):
+        import stat
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return False
+        except (OSError, socket.error):
+            return True
+        finally:
+            sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (OSError, socket.error) as ex:
+                if not closed_socket_ex(ex):
+                    Logger.error("control: listening thread is exiting: %s" % ex)
+                return
+            start_daemon_thread(self._handle, args=(conn,))
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(5)
+            buff = b""
+            while b"\n" not in buff and len(buff) < 4096:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                buff += data
+            try:
+                resp = self.command(buff.decode().strip())
+            except ValueError as ex:
+                resp = {"ok": False, "error": str(ex)}
+            conn.sendall((json.dumps(resp) + "\n").encode())
+        except (OSError, socket.error) as ex:
+            Logger.debug("control: client error: %s" % ex)
+        finally:
+            conn.close()
+
+    def command(self, line):
+        if line.startswith("{"):
+            req = json.loads(line)
+            cmd, name = req.get("cmd"), req.get("mapping")
+            opts = dict((k, str(req[k])) for k in ("t", "p", "m") if k in req)
+        else:
+            # e.g. "reload ssh -t 192.168.1.102 -p 22 -m socket"
+            words = line.split() or [""]
+            cmd, words = words[0], words[1:]
+            name = words.pop(0) if words and not words[0].startswith("-") else None
+            if len(words) % 2 or any(k not in ("-t", "-p", "-m") for k in words[::2]):
+                raise ValueError("Invalid arguments: %s" % " ".join(words))
+            opts = dict((k[1:], v) for k, v in zip(words[::2], words[1::2]))
+        if cmd == "reload" and not opts:
+            if not self.reload:
+                raise ValueError("Nothing to reload without -c, specify -t, -p or -m")
+            self.reload()
+            return {"ok": True}
+        mappings = [m for m in list(self.mappings) if name is None or m.name == name]
+        if not mappings:
+            raise ValueError("No such mapping: %s" % name)
+        if cmd == "status":
+            return {
+                "ok": True, "version": __version__, "pid": os.getpid(),
+                "uptime": time.time() - self.start_time,
+                "mappings": [m.status() for m in mappings]
+            }
+        elif cmd == "recheck":
+            for m in mappings:
+                m.request_recheck()
+        elif cmd == "reload":
+            for m in mappings:
+                m.reconfigure(
+                    opts.get("t", m.to_ip), int(opts.get("p", m.to_port)), opts.get("m", m.method_conf)
+                )
+        elif cmd == "hook":
+            for m in mappings:
+                if m.outer_addr:
+                    m.call_notify()
+        elif cmd == "stop":
+            Logger.info("Natter is exiting by control request")
+            # the SIGTERM handler exits the main thread, forwarders are stopped at exit
+            threading.Timer(0.1, os.kill, args=(os.getpid(), signal.SIGTERM)).start()
+        else:
+            raise ValueError("Unknown command: %s" % cmd)
+        return {"ok": True}
+
+
+class MetricsServer(object):
+    # Serves /metrics in the Prometheus text exposition format
+    instance = None
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.mappings = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        socket_set_opt(self.sock, reuse=True, bind_addr=addr)
+        self.sock.listen(5)
+        start_daemon_thread(self._serve)
+        Logger.debug("metrics: Listening on %s" % addr_to_uri(addr))
+
+    @staticmethod
+    def open(addr):
+        if MetricsServer.instance is None:
+            MetricsServer.instance = MetricsServer(addr)
+        return MetricsServer.instance
+
+    def attach(self, mappings):
+        self.mappings = mappings
+
+    def render(self):
+        families = {}
+        order = []
+        for mapping in [None] + list(self.mappings):
+            if mapping is None:
+                items = [("natter_info", "gauge", "Natter version", {"version": __version__}, 1)]
+            else:
+                items = mapping.metrics()
+            for name, mtype, mhelp, labels, value in items:
+                if name not in families:
+                    families[name] = ["# HELP %s %s" % (name, mhelp), "# TYPE %s %s" % (name, mtype)]
+                    order.append(name)
+                if isinstance(value, Histogram):
+                    families[name].extend(value.expose(name, labels))
+                else:
+                    families[name].append("%s%s %s" % (name, metric_labels(labels), repr(value)))
+        return "".join("\n".join(families[name]) + "\n" for name in order)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (OSError, socket.error) as ex:
+                if not closed_socket_ex(ex):
+                    Logger.error("metrics: listening thread is exiting: %s" % ex)
+                return
+            start_daemon_thread(self._handle, args=(conn,))
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(5)
+            buff = b""
+            while b"\r\n\r\n" not in buff and len(buff) < 8192:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                buff += data
+            request_line = buff.split(b"\r\n", 1)[0].decode("latin-1").split()
+            if len(request_line) >= 2 and request_line[0] == "GET" and \
+                    request_line[1].split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", self.render()
+            else:
+                status, body = "404 Not Found", "Not Found\n"
+            body = body.encode()
+            conn.sendall((
+                "HTTP/1.0 %s\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: close\r\n"
+                "\r\n" % (status, len(body))
+            ).encode() + body)
+        except (OSError, socket.error) as ex:
+            Logger.debug("metrics: client error: %s" % ex)
+        finally:
+            conn.close()
+
+
+class Natter(object):
+    # Library API: runs mappings in background threads of the calling process.
+    #
+    #   import natter
+    #   n = natter.Natter(["-p", "80"], on_event=lambda event, fields: print(event, fields))
+    #   n.start()
+    #   ...
+    #   n.stop()
+    #
+    # config is the command line of one mapping, as a list or a string, or a
+    # dict in the format of the -c config file. defaults are prepended to the
+    # arguments of every mapping. on_event(event, fields) receives the events
+    # of --json-events, from worker threads.
+    def __init__(self, config, defaults=(), on_event=None):
+        self.defaults = list(defaults)
+        self.on_event = on_event
+        self.mappings = self._build(config)
+        self.scheduler = None
+        self.thread = None
+
+    def start(self):
+        if self.scheduler is not None:
+            raise RuntimeError("Natter has already been started")
+        self.scheduler = NatterScheduler(self.mappings)
+        self.thread = start_daemon_thread(self.scheduler.run)
+        atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout=10):
+        # stops the forwarders, the mappings cannot be started again
+        if self.thread is None:
+            return
+        # shutdown() empties the scheduler's list, keep the stopped mappings for status()
+        self.mappings = list(self.scheduler.mappings)
+        self.scheduler.shutdown(timeout)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def wait(self, timeout=None):
+        # returns True once every mapping has exited, e.g. with -q
+        if self.thread is None:
+            return True
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def reload(self, config):
+        # same rules as reloading the -c config file
+        mappings = self._build(config)
+        if self.scheduler is None:
+            self.mappings = mappings
+            return
+        self.scheduler.reload(mappings)
+        self.mappings = self.scheduler.mappings
+
+    def recheck(self, name=None):
+        for mapping in self._select(name):
+            mapping.request_recheck()
+
+    def status(self, name=None):
+        return [mapping.status() for mapping in self._select(name)]
+
+    def _select(self, name):
+        mappings = [m for m in list(self.mappings) if name is None or m.name == name]
+        if name is not None and not mappings:
+            raise ValueError("No such mapping: %s" % name)
+        return mappings
+
+    def _build(self, config):
+        import shlex
+        if isinstance(config, dict):
+            items = natter_parse_config(config, "<config>")
+        elif isinstance(config, str):
+            items = [(None, shlex.split(config))]
+        else:
+            items = [(None, [str(x) for x in config])]
+        mappings = natter_build_mappings(natter_arg_parser(), self.defaults, items, "<config>")
+        for mapping in mappings:
+            mapping.on_event = self.on_event
+        return mappings
+
+
+def natter_arg_parser():
     argp = argparse.ArgumentParser(
         description="Expose your port behind full-cone NAT to the Internet.", add_help=False
     )
@@ -1510,6 +4242,10 @@ def natter_main(show_title = True):
         "-k", type=int, metavar="<interval>", default=15,
         help="seconds between each keep-alive"
     )
+    group.add_argument(
+        "--max-stale", type=int, metavar="<seconds>", default=300,
+        help="longest time the mapped address may go unconfirmed"
+    )
     group.add_argument(
         "-s", metavar="<address>", action="append",
         help="hostname or address to STUN server"
@@ -1520,7 +4256,36 @@ def natter_main(show_title = True):
     )
     group.add_argument(
         "-e", type=str, metavar="<path>", default=None,
-        help="script path for notifying mapped address"
+        help="script path for notifying mapped address, or 'plugin:<module>' "
+             "for an in-process Python plugin"
+    )
+    group.add_argument(
+        "-c", type=str, metavar="<path>", default=None,
+        help="config file of multiple mappings to run in one process"
+    )
+    group.add_argument(
+        "--control", type=str, metavar="<path>", default=None,
+        help="Unix socket path for status queries and commands"
+    )
+    group.add_argument(
+        "--stun-broker", type=str, metavar="<path>", default=None,
+        help="Unix socket shared by Natter processes on this host to spread STUN requests"
+    )
+    group.add_argument(
+        "--metrics", type=str, metavar="<address>", default=None,
+        help="serve Prometheus metrics on [address:]port"
+    )
+    group.add_argument(
+        "--bench", type=str, metavar="<address>", default=None,
+        help="measure latency and throughput to a natter running with '-m bench', then exit"
+    )
+    group.add_argument(
+        "--startup-trace", action="store_true",
+        help="print the time spent in each startup phase"
+    )
+    group.add_argument(
+        "--json-events", type=str, metavar="<fd>", nargs="?", const="stdout", default=None,
+        help="write events as JSON lines to stdout, or to a file descriptor or path"
     )
     group = argp.add_argument_group("bind options")
     group.add_argument(
@@ -1535,7 +4300,7 @@ def natter_main(show_title = True):
     group.add_argument(
         "-m", type=str, metavar="<method>", default=None,
         help="forward method, common values are 'iptables', 'nftables', "
-             "'socat', 'gost' and 'socket'"
+             "'socat', 'gost', 'socket' and 'auto'"
     )
     group.add_argument(
         "-t", type=str, metavar="<address>", default="0.0.0.0",
@@ -1549,130 +4314,83 @@ def natter_main(show_title = True):
         "-r", action="store_true", help="keep retrying until the port of forward target is open"
     )
 
+    return argp
+
+
+def metrics_addr(s):
+    # "9100" listens on localhost only, "0.0.0.0:9100" for remote scraping
+    if ":" not in s:
+        s = "127.0.0.1:" + s
+    validate_addr_str(s)
+    host, port = s.rsplit(":", 1)
+    validate_ip(host)
+    return host, int(port)
+
+
+def natter_bench(uri, udp=False):
+    # client of `-m bench`: tcp://1.2.3.4:5678, udp://1.2.3.4:5678 or 1.2.3.4:5678 with -u
+    m = re.match(r"^(?:(tcp|udp)://)?([^:/]+):(\d+)$", uri)
+    if not m:
+        raise ValueError("Invalid address: %s" % uri)
+    if m.group(1):
+        udp = m.group(1) == "udp"
+    validate_port(m.group(3))
+    addr = (resolve_host(m.group(2)), int(m.group(3)))
+    Logger.info("Measuring %s for 5 seconds..." % addr_to_uri(addr, udp=udp))
+    bench_report(ForwardBenchmark(udp=udp, duration=5, rounds=100, streams=4).measure(addr), udp=udp)
+
+
+def natter_load_config(path):
+    with open(path, "r") as fo:
+        conf = json.load(fo)
+    return natter_parse_config(conf, path)
+
+
+def natter_parse_config(conf, path):
+    # {"mappings": [["-p", "80"], "-u -p 53", {"name": "ssh", "args": ["-p", "22"]}]}
+    import shlex
+    items = conf.get("mappings") if isinstance(conf, dict) else None
+    if not items:
+        raise ValueError("No mappings in config file: %s" % path)
+    mappings = []
+    for i, item in enumerate(items):
+        name = None
+        if isinstance(item, dict):
+            name = item.get("name")
+            item = item.get("args", [])
+        if isinstance(item, str):
+            item = shlex.split(item)
+        if not isinstance(item, list):
+            raise ValueError("Invalid mapping #%d in config file: %s" % (i + 1, path))
+        mappings.append((name or "#%d" % (i + 1), [str(x) for x in item]))
+    return mappings
+
+
+def natter_main(show_title = True):
+    ts = time.time()
+    argp = natter_arg_parser()
     args = argp.parse_args()
     verbose = args.v
-    udp_mode = args.u
-    upnp_enabled = args.U
-    interval = args.k
-    stun_list = args.s
-    keepalive_srv = args.h
-    notify_sh = args.e
-    bind_ip = args.i
-    bind_interface = None
-    bind_port = args.b
-    method = args.m
-    to_ip = args.t
-    to_port = args.p
-    keep_retry = args.r
-    exit_when_changed = args.q
+    trace = StartupTrace(args.startup_trace, ts)
+    trace.mark("arg parse")
 
     sys.tracebacklimit = 0
     if verbose:
         sys.tracebacklimit = None
         Logger.set_level(Logger.DEBUG)
 
-    validate_positive(interval)
-    if stun_list:
-        for stun_srv in stun_list:
-            validate_addr_str(stun_srv)
-    validate_addr_str(keepalive_srv)
-    if notify_sh:
-        validate_filepath(notify_sh)
-    if not validate_ip(bind_ip, err=False):
-        bind_interface = bind_ip
-        bind_ip = "0.0.0.0"
-    validate_port(bind_port)
-    validate_ip(to_ip)
-    validate_port(to_port)
-
-    # Normalize IPv4 in dotted-decimal notation
-    #   e.g. 10.1 -> 10.0.0.1
-    bind_ip = ip_normalize(bind_ip)
-    to_ip = ip_normalize(to_ip)
-
-    if not stun_list:
-        stun_list = [
-            "fwa.lifesizecloud.com",
-            "global.turn.twilio.com",
-            "turn.cloudflare.com",
-            "stun.isp.net.au",
-            "stun.nextcloud.com",
-            "stun.freeswitch.org",
-            "stun.voip.blackberry.com",
-            "stunserver.stunprotocol.org",
-            "stun.sipnet.com",
-            "stun.radiojar.com",
-            "stun.sonetel.com",
-            "stun.telnyx.com"
-        ]
-        if not udp_mode:
-            stun_list = stun_list + [
-                "turn.cloud-rtc.com:80"
-            ]
-        else:
-            stun_list = [
-                "stun.miwifi.com",
-                "stun.chat.bilibili.com",
-                "stun.hitv.com",
-                "stun.cdnbye.com",
-                "stun.douyucdn.cn:18000"
-            ] + stun_list
-
-    if not keepalive_srv:
-        keepalive_srv = "www.baidu.com"
-        if udp_mode:
-            keepalive_srv = "119.29.29.29"
-
-    stun_srv_list = []
-    for item in stun_list:
-        l = item.split(":", 2) + ["3478"]
-        stun_srv_list.append((l[0], int(l[1])),)
-
-    if udp_mode:
-        l = keepalive_srv.split(":", 2) + ["53"]
-        keepalive_host, keepalive_port = l[0], int(l[1])
-    else:
-        l = keepalive_srv.split(":", 2) + ["80"]
-        keepalive_host, keepalive_port = l[0], int(l[1])
-
-    # forward method defaults
-    if not method:
-        if to_ip == "0.0.0.0" and to_port == 0 and \
-                bind_ip == "0.0.0.0" and bind_port == 0 and bind_interface is None:
-            method = "test"
-        elif to_ip == "0.0.0.0" and to_port == 0:
-            method = "none"
-        else:
-            method = "socket"
+    if args.json_events:
+        EventStream.open(args.json_events)
 
-    if method == "none":
-        ForwardImpl = ForwardNone
-    elif method == "test":
-        ForwardImpl = ForwardTestServer
-    elif method == "iptables":
-        ForwardImpl = ForwardIptables
-    elif method == "sudo-iptables":
-        ForwardImpl = ForwardSudoIptables
-    elif method == "iptables-snat":
-        ForwardImpl = ForwardIptablesSnat
-    elif method == "sudo-iptables-snat":
-        ForwardImpl = ForwardSudoIptablesSnat
-    elif method == "nftables":
-        ForwardImpl = ForwardNftables
-    elif method == "sudo-nftables":
-        ForwardImpl = ForwardSudoNftables
-    elif method == "nftables-snat":
-        ForwardImpl = ForwardNftablesSnat
-    elif method == "sudo-nftables-snat":
-        ForwardImpl = ForwardSudoNftablesSnat
-    elif method == "socat":
-        ForwardImpl = ForwardSocat
-    elif method == "gost":
-        ForwardImpl = ForwardGost
-    elif method == "socket":
-        ForwardImpl = ForwardSocket
-    else:
-        raise ValueError("Unknown method name: %s" % method)
+    if args.bench:
+        natter_bench(args.bench, args.u)
+        raise NatterExitException("Bench finished")
+
+    if args.c:
+        return natter_main_multi(argp, args, trace, show_title)
+
+    mapping = NatterMapping(args)
+    mapping.trace = trace
     #
     #  Natter
     #
@@ -1682,153 +4400,104 @@ def natter_main(show_title = True):
             Logger.info("Tips: Use `--help` to see help messages")
 
     check_docker_network()
+    check_nat_cache([mapping.udp_mode])
+    trace.mark("docker check")
 
-    forwarder = ForwardImpl()
-    port_test = PortTest()
-
-    stun = StunClient(stun_srv_list, bind_ip, bind_port, udp=udp_mode, interface=bind_interface)
-    natter_addr, outer_addr = stun.get_mapping()
-    # set actual ip and port for keep-alive socket to bind, instead of zero
-    bind_ip, bind_port = natter_addr
-
-    keep_alive = KeepAlive(keepalive_host, keepalive_port, bind_ip, bind_port, udp=udp_mode, interface=bind_interface)
-    keep_alive.keep_alive()
-
-    # get the mapped address again after the keep-alive connection is established
-    outer_addr_prev = outer_addr
-    natter_addr, outer_addr = stun.get_mapping()
-    if outer_addr != outer_addr_prev:
-        Logger.warning("Network is unstable, or not full cone")
-
-    # set actual ip of localhost for correct forwarding
-    if socket.inet_aton(to_ip) in [socket.inet_aton("127.0.0.1"), socket.inet_aton("0.0.0.0")]:
-        to_ip = natter_addr[0]
-
-    # if not specified, the target port is set to be the same as the outer port
-    if not to_port:
-        to_port = outer_addr[1]
-
-    # some exceptions: ForwardNone and ForwardTestServer are not real forward methods,
-    # so let target ip and port equal to natter's
-    if ForwardImpl in (ForwardNone, ForwardTestServer):
-        to_ip, to_port = natter_addr
-
-    to_addr = (to_ip, to_port)
-    forwarder.start_forward(natter_addr[0], natter_addr[1], to_addr[0], to_addr[1], udp=udp_mode)
-    NatterExit.set_atexit(forwarder.stop_forward)
+    NatterExit.set_atexit(mapping.stop)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda s, f: Logger.warning(
+            "SIGHUP: nothing to reload without -c, use the control socket to change the forward target"
+        ))
+    if args.control:
+        ControlServer.open(args.control).attach([mapping])
+    if args.metrics:
+        MetricsServer.open(metrics_addr(args.metrics)).attach([mapping])
+    mapping.start()
+    #
+    #  Main loop
+    #
+    while True:
+        ts = time.time()
+        mapping.step()
+        sleep_sec = mapping.interval - (time.time() - ts)
+        # a recheck request from the control socket ends the sleep early
+        if sleep_sec > 0 and mapping.wakeup.wait(sleep_sec):
+            mapping.wakeup.clear()
 
-    # UPnP
-    upnp = None
-    upnp_router = None
-    upnp_ready = False
 
-    if upnp_enabled:
-        upnp = UPnPClient(bind_ip=natter_addr[0], interface=bind_interface)
-        Logger.info()
-        Logger.info("Scanning UPnP Devices...")
+def natter_build_mappings(argp, base_argv, items, path):
+    mappings = []
+    for name, item_argv in items:
         try:
-            upnp_router = upnp.discover_router()
-        except (OSError, socket.error, ValueError) as ex:
-            Logger.error("upnp: failed to discover router: %s" % ex)
-
-    if upnp_router:
-        Logger.info("[UPnP] Found router %s" % upnp_router.ipaddr)
+            mapping_args = argp.parse_args(base_argv + item_argv)
+        except SystemExit:
+            # argparse has printed the error
+            raise ValueError("Invalid arguments of mapping %s" % name)
+        if mapping_args.c:
+            raise ValueError("Nested config file is not allowed: %s" % name)
+        mappings.append(NatterMapping(mapping_args, name=name))
+    names = [m.name for m in mappings]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate mapping names in config file: %s" % path)
+    return mappings
+
+
+def natter_quiet(func):
+    # for threads: errors are already logged by func
+    def wrapper():
         try:
-            upnp.forward("", bind_port, bind_ip, bind_port, udp=udp_mode, duration=interval*3)
-        except (OSError, socket.error, ValueError) as ex:
-            Logger.error("upnp: failed to forward port: %s" % ex)
-        else:
-            upnp_ready = True
-
-    # Display route information
-    Logger.info()
-    route_str = ""
-    if ForwardImpl not in (ForwardNone, ForwardTestServer):
-        route_str += "%s <--%s--> " % (addr_to_uri(to_addr, udp=udp_mode), method)
-    route_str += "%s <--Natter--> %s" % (
-        addr_to_uri(natter_addr, udp=udp_mode), addr_to_uri(outer_addr, udp=udp_mode)
-    )
-    Logger.info(route_str)
-    Logger.info()
+            func()
+        except ValueError:
+            pass
+    return wrapper
+
+
+def natter_main_multi(argp, args, trace, show_title = True):
+    # options given on the command line are the defaults of every mapping
+    base_argv = []
+    argv = sys.argv[1:]
+    while argv:
+        item = argv.pop(0)
+        if item == "-c":
+            argv.pop(0)
+        elif not item.startswith("-c"):
+            base_argv.append(item)
+    mappings = natter_build_mappings(argp, base_argv, natter_load_config(args.c), args.c)
+    trace.mark("config")
 
-    # Test mode notice
-    if ForwardImpl == ForwardTestServer:
-        Logger.info("Test mode in on.")
-        Logger.info("Please check [ %s://%s ]" % ("udp" if udp_mode else "http", addr_to_str(outer_addr)))
-        Logger.info()
+    if show_title:
+        Logger.info("Natter v%s" % __version__)
+        Logger.info("Running %d mappings from %s" % (len(mappings), args.c))
 
-    # Call notification script
-    if notify_sh:
-        protocol = "udp" if udp_mode else "tcp"
-        inner_ip, inner_port = to_addr if method else natter_addr
-        outer_ip, outer_port = outer_addr
-        Logger.info("Calling script: %s" % notify_sh)
-        subprocess.call([
-            os.path.abspath(notify_sh), protocol, str(inner_ip), str(inner_port), str(outer_ip), str(outer_port)
-        ], shell=False)
-
-    # Display check results, TCP only
-    if not udp_mode:
-        ret1 = port_test.test_lan(to_addr, info=True)
-        ret2 = port_test.test_lan(natter_addr, info=True)
-        ret3 = port_test.test_lan(outer_addr, source_ip=natter_addr[0], interface=bind_interface, info=True)
-        ret4 = port_test.test_wan(outer_addr, source_ip=natter_addr[0], interface=bind_interface, info=True)
-        if ret1 == -1:
-            Logger.warning("!! Target port is closed !!")
-        elif ret1 == 1 and ret3 == ret4 == -1:
-            Logger.warning("!! Hole punching failed !!")
-        elif ret3 == 1 and ret4 == -1:
-            Logger.warning("!! You may be behind a firewall !!")
-        Logger.info()
-        # retry
-        if keep_retry and ret1 == -1:
-            Logger.info("Retry after %d seconds..." % interval)
-            time.sleep(interval)
-            forwarder.stop_forward()
-            raise NatterRetryException("Target port is closed")
-    #
-    #  Main loop
-    #
-    need_recheck = False
-    cnt = 0
-    while True:
-        # force recheck every 20th loop
-        cnt = (cnt + 1) % 20
-        if cnt == 0:
-            need_recheck = True
-        if need_recheck:
-            Logger.debug("Start recheck")
-            need_recheck = False
-            # check LAN port first
-            if udp_mode or port_test.test_lan(outer_addr, source_ip=natter_addr[0], interface=bind_interface) == -1:
-                # then check through STUN
-                _, outer_addr_curr = stun.get_mapping()
-                if outer_addr_curr != outer_addr:
-                    forwarder.stop_forward()
-                    # exit or retry
-                    if exit_when_changed:
-                        Logger.info("Natter is exiting because mapped address has changed")
-                        raise NatterExitException("Mapped address has changed")
-                    raise NatterRetryException("Mapped address has changed")
-        # end of recheck
-        ts = time.time()
+    check_docker_network()
+    check_nat_cache([mapping.udp_mode for mapping in mappings])
+    trace.mark("docker check")
+    for mapping in mappings:
+        mapping.trace = StartupTrace(args.startup_trace, trace.start)
+        mapping.trace.last = trace.last
+
+    scheduler = NatterScheduler(mappings)
+    NatterExit.set_atexit(scheduler.stop)
+
+    def reload_config():
+        Logger.info("Reloading %s" % args.c)
         try:
-            keep_alive.keep_alive()
-        except (OSError, socket.error) as ex:
-            if udp_mode:
-                Logger.debug("keep-alive: UDP response not received: %s" % ex)
-            else:
-                Logger.error("keep-alive: connection broken: %s" % ex)
-            keep_alive.reset()
-            need_recheck = True
-        if upnp_ready:
-            try:
-                upnp.renew()
-            except (OSError, socket.error) as ex:
-                Logger.error("upnp: failed to renew upnp: %s" % ex)
-        sleep_sec = interval - (time.time() - ts)
-        if sleep_sec > 0:
-            time.sleep(sleep_sec)
+            new_mappings = natter_build_mappings(argp, base_argv, natter_load_config(args.c), args.c)
+        except (OSError, ValueError) as ex:
+            Logger.error("Reload failed, keeping the current mappings: %s" % ex)
+            raise ValueError("Reload failed: %s" % ex)
+        scheduler.reload(new_mappings)
+
+    if hasattr(signal, "SIGHUP"):
+        # the handler interrupts the scheduler loop, do the work elsewhere
+        signal.signal(signal.SIGHUP, lambda s, f: start_daemon_thread(natter_quiet(reload_config)))
+    if args.control:
+        ControlServer.open(args.control).attach(mappings, reload_config)
+    if args.metrics:
+        MetricsServer.open(metrics_addr(args.metrics)).attach(mappings)
+    scheduler.run()
+    scheduler.stop()
+    raise NatterExitException("All mappings have exited")
 
 
 def main():
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Natter unit tests
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import subprocess
+
+NATTER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestJsonEvents(unittest.TestCase):
+    """--json-events on stdout"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="natter-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _run(self, code):
+        proc = subprocess.run(
+            [sys.executable, "-c", code], cwd=NATTER_DIR, timeout=30,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return proc.stdout, proc.stderr
+
+    def test_hook_output_stays_out_of_events(self):
+        hook = os.path.join(self.tmp_dir, "hook.sh")
+        with open(hook, "w") as fout:
+            fout.write("#!/bin/sh\necho \"notify: $@\"\n")
+        os.chmod(hook, 0o755)
+        stdout, stderr = self._run(
+            "import natter\n"
+            "natter.EventStream.open('stdout')\n"
+            "natter.EventStream.emit('before')\n"
+            "runner = natter.NotifyRunner(%r)\n"
+            "runner._call([%r, 'tcp', '127.0.0.1', '80', '203.0.113.10', '14500'])\n"
+            "print('plugin output')\n"
+            "natter.EventStream.emit('after')\n" % (hook, hook)
+        )
+        events = [json.loads(line)["event"] for line in stdout.splitlines()]
+        self.assertEqual(events, ["before", "hook", "after"])
+        self.assertIn("notify: tcp 127.0.0.1 80 203.0.113.10 14500", stderr)
+        self.assertIn("plugin output", stderr)
+
+
+class TestNotifyRunner(unittest.TestCase):
+    """Notification runner lifetime"""
+
+    def setUp(self):
+        sys.path.insert(0, NATTER_DIR)
+        import natter
+        self.natter = natter
+        self.tmp_dir = tempfile.mkdtemp(prefix="natter-test-")
+
+    def tearDown(self):
+        sys.path.remove(NATTER_DIR)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_runner_is_shared_and_stops(self):
+        log = os.path.join(self.tmp_dir, "calls")
+        hook = os.path.join(self.tmp_dir, "hook.sh")
+        with open(hook, "w") as fout:
+            fout.write("#!/bin/sh\necho \"$5\" >> %s\nexit 1\n" % log)
+        os.chmod(hook, 0o755)
+        runner = self.natter.NotifyRunner.get(hook, emit=lambda *a, **k: None, name="test")
+        self.assertIs(runner, self.natter.NotifyRunner.get(hook, emit=lambda *a, **k: None, name="test"))
+        runner.backoff = 0.5
+        runner.submit([hook, "tcp", "127.0.0.1", "80", "203.0.113.10", "14500"])
+        time.sleep(0.2)
+        thread = runner._thread
+        runner.stop()
+        thread.join(5)
+        time.sleep(1)
+        # the failed call is not retried after stop()
+        with open(log) as fin:
+            self.assertEqual(fin.read().split(), ["14500"])
+        self.assertIsNone(runner._thread)
+
+class TestStunBroker(unittest.TestCase):
+    """STUN broker request handling"""
+
+    def setUp(self):
+        sys.path.insert(0, NATTER_DIR)
+        import natter
+        self.natter = natter
+        self.tmp_dir = tempfile.mkdtemp(prefix="natter-test-")
+        self.broker = natter.StunBroker(os.path.join(self.tmp_dir, "broker.sock"))
+        # the first request makes this broker the serving one
+        self.assertIsNotNone(self.broker.request({"cmd": "status"}))
+
+    def tearDown(self):
+        self.broker.close()
+        sys.path.remove(NATTER_DIR)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _send(self, line):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(5)
+            sock.connect(self.broker.path)
+            sock.sendall(line + b"\n")
+            return json.loads(sock.makefile().readline())
+        finally:
+            sock.close()
+
+    def test_request_not_an_object(self):
+        for line in (b"[]", b'"x"', b"1", b"null"):
+            resp = self._send(line)
+            self.assertFalse(resp["ok"], line)
+            self.assertIn("error", resp)
+        self.assertTrue(self._send(b'{"cmd": "status"}')["ok"])
+
+
+
+class TestForwardSocket(unittest.TestCase):
+    """Socket forwarder error reporting"""
+
+    def setUp(self):
+        sys.path.insert(0, NATTER_DIR)
+        import natter
+        self.natter = natter
+        self.errors = []
+
+    def tearDown(self):
+        sys.path.remove(NATTER_DIR)
+
+    def _forwarder(self, port, toport, udp):
+        fwd = self.natter.ForwardSocket()
+        fwd.udp_timeout = 0.5
+        fwd.on_error = lambda: self.errors.append(1)
+        fwd.start_forward("127.0.0.1", port, "127.0.0.1", toport, udp=udp)
+        self.addCleanup(fwd.stop_forward)
+        return fwd
+
+    def test_session_end_is_not_an_error(self):
+        import socket
+        # idle UDP session times out
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind(("127.0.0.1", 0))
+        self.addCleanup(echo.close)
+        fwd_port = self.natter.get_free_port(udp=True)
+        self._forwarder(fwd_port, echo.getsockname()[1], udp=True)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.sendto(b"ping", ("127.0.0.1", fwd_port))
+        # TCP peer resets its connection
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.bind(("127.0.0.1", 0))
+        srv.listen(1)
+        self.addCleanup(srv.close)
+        fwd_port = self.natter.get_free_port()
+        self._forwarder(fwd_port, srv.getsockname()[1], udp=False)
+        conn = socket.create_connection(("127.0.0.1", fwd_port))
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        peer, _ = srv.accept()
+        self.addCleanup(peer.close)
+        conn.close()
+        time.sleep(1.5)
+        self.assertEqual(self.errors, [])
+
+
+
+class TestScheduler(unittest.TestCase):
+    """Multi-mapping scheduler"""
+
+    def setUp(self):
+        sys.path.insert(0, NATTER_DIR)
+        import natter
+        self.natter = natter
+
+    def tearDown(self):
+        sys.path.remove(NATTER_DIR)
+
+    def test_unexpected_exception_is_retried(self):
+        natter = self.natter
+        events = []
+
+        class Mapping(object):
+            name = "test"
+            removed = False
+            interval = 0
+            udp_mode = False
+            stun_srv_list = []
+            lock = threading.Lock()
+            starts = 0
+
+            def start(self):
+                self.starts += 1
+                if self.starts == 1:
+                    raise KeyError("malformed reply")
+
+            def step(self):
+                raise natter.NatterExitException("done")
+
+            def stop(self):
+                pass
+
+            def emit(self, event, **fields):
+                events.append((event, fields))
+
+        mapping = Mapping()
+        scheduler = natter.NatterScheduler([mapping], max_workers=1)
+        scheduler.retry_delay = 0.1
+        th = threading.Thread(target=scheduler.run)
+        th.daemon = True
+        th.start()
+        th.join(5)
+        self.assertFalse(th.is_alive())
+        self.assertEqual(mapping.starts, 2)
+        self.assertEqual(events[0][0], "error")
+        self.assertIn("KeyError", events[0][1]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
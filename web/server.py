@@ -30,6 +30,12 @@ NATTER_PATH = os.environ.get("NATTER_PATH") or os.path.join(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "natter", "natter.py"
 )
 
+# natter-check.py --cache 保存的NAT检测结果，与natter.py的缓存目录一致
+NATTER_CHECK_CACHE = os.environ.get("NATTER_CHECK_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "natter", "natter-check.json"
+)
+
 # 数据存储目录，优先使用环境变量定义的路径
 DATA_DIR = os.environ.get("DATA_DIR") or os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "data"
@@ -2780,6 +2786,17 @@ class NatterHttpHandler(BaseHTTPRequestHandler):
                     self.wfile.write(json.dumps(result).encode())
                 else:
                     self._error(400, "Missing tool parameter")
+            elif path == "/api/nat-check":
+                # 读取natter-check缓存的NAT检测结果，不在此处重新检测
+                try:
+                    with open(NATTER_CHECK_CACHE, "r") as f:
+                        result = json.load(f)
+                except (OSError, ValueError):
+                    result = None
+                self._set_headers()
+                self.wfile.write(
+                    json.dumps({"available": result is not None, "result": result}).encode()
+                )
             elif path == "/api/auth/check":
                 # 检查认证状态
                 if self._authenticate_token():